@@ -12,8 +12,10 @@ class Board(ABC):
 
     sensor = None
 
-    def __init__(self, debug=False):
-        self.sensor = FdsSensor(debug=debug, bus_id=self.BUS_I2C)
+    def __init__(self, debug=False, open_sensor=True):
+        # without the sensor only reset_mcu is usable, the readers keep their own bus
+        if open_sensor:
+            self.sensor = FdsSensor(debug=debug, bus_id=self.BUS_I2C)
 
     @abstractmethod
     def reset_mcu(self):
@@ -47,8 +49,8 @@ class C23(Board):
     BUS_I2C = 1
     reset_pin = 149
 
-    def __init__(self, debug=False, reset_pin=None):
-        super().__init__(debug)
+    def __init__(self, debug=False, reset_pin=None, open_sensor=True):
+        super().__init__(debug, open_sensor)
         if reset_pin is not None:
             self.reset_pin = reset_pin
 
@@ -87,8 +89,8 @@ class NEO(Board):
     BUS_I2C = 1
     reset_pin = 39
 
-    def __init__(self, debug=False, reset_pin=None):
-        super().__init__(debug)
+    def __init__(self, debug=False, reset_pin=None, open_sensor=True):
+        super().__init__(debug, open_sensor)
         if reset_pin is not None:
             self.reset_pin = reset_pin
 
@@ -112,3 +114,6 @@ class NEO(Board):
                 time.sleep(1.0)
         except Exception as e:
             print(e)
+
+
+BOARDS = {board.BOARD_TYPE: board for board in (C23, NEO)}
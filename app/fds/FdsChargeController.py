@@ -4,6 +4,8 @@ from pymodbus.client.sync import ModbusTcpClient as ModbusClient
 import random
 import logging
 from .FdsCommon import FdsCommon as fds
+from ..sensor.modbus_rtu import RtuBusArbiter
+from ..sensor.register_map import CHARGE_CONTROLLER_MAP, RELAY_BOX_MAP
 
 MODBUS_RTU = 0x01
 MODBUS_ETH = 0x02
@@ -58,6 +60,11 @@ class FdsChargeController:
         elif self.communicationType == MODBUS_RTU:
             logging.debug("FdsChargeController: connect RTU called")
 
+            if self.isDebug is False:
+                print("Opening Modbus RTU port %s ..." % self.serialPort)
+                self.client = RtuBusArbiter(self.serialPort)
+                self.client.open()
+
     def get_charge_controller_data(self):
         data = {'type': 'chargecontroller'}
 
@@ -66,33 +73,7 @@ class FdsChargeController:
                 # read registers. Start at 0 for convenience
                 rr = self.client.read_holding_registers(0, 80, unit=CHARGE_CONTROLLER_UNIT)
 
-                # for all indexes, subtract 1 from what's in the manual
-                V_PU_hi, V_PU_lo, I_PU_hi, I_PU_lo = rr.registers
-
-                V_PU = float(V_PU_hi) + float(V_PU_lo)
-                I_PU = float(I_PU_hi) + float(I_PU_lo)
-
-                v_scale = V_PU * 2 ** (-15)
-                i_scale = I_PU * 2 ** (-15)
-                p_scale = V_PU * I_PU * 2 ** (-17)
-
-                # battery sense voltage, filtered
-                data[fds.LABEL_CC_BATTS_V] = rr.registers[24] * v_scale
-                data[fds.LABEL_CC_BATT_SENSED_V] = rr.registers[26] * v_scale
-                data[fds.LABEL_CC_BATTS_I] = rr.registers[28] * i_scale
-                data[fds.LABEL_CC_ARRAY_V] = rr.registers[27] * v_scale
-                data[fds.LABEL_CC_ARRAY_I] = rr.registers[29] * i_scale
-                data[fds.LABEL_CC_STATENUM] = rr.registers[50]
-                data[fds.LABEL_CC_HS_TEMP] = rr.registers[35]
-                data[fds.LABEL_CC_RTS_TEMP] = rr.registers[36]
-                data[fds.LABEL_CC_OUT_POWER] = rr.registers[58] * p_scale
-                data[fds.LABEL_CC_IN_POWER] = rr.registers[59] * p_scale
-                data[fds.LABEL_CC_MINVB_DAILY] = rr.registers[64] * v_scale
-                data[fds.LABEL_CC_MAXVB_DAILY] = rr.registers[65] * v_scale
-                data[fds.LABEL_CC_MINTB_DAILY] = rr.registers[71]
-                data[fds.LABEL_CC_MAXTB_DAILY] = rr.registers[72]
-                data[fds.LABEL_CC_DIPSWITCHES] = bin(rr.registers[48])[::-1][:-2].zfill(8)
-                # led_state            = rr.registers
+                CHARGE_CONTROLLER_MAP.decode(rr.registers, data)
             except ModbusIOException as e:
                 logging.error('Charge Controller: modbusIOException')
                 raise e
@@ -128,26 +109,7 @@ class FdsChargeController:
             try:
                 # read registers. Start at 0 for convenience
                 rr = self.client.read_holding_registers(0, 18, unit=RELAY_BOX_UNIT)
-                v_scale = float(78.421 * 2 ** (-15))
-
-                data[fds.LABEL_RB_VB] = rr.registers[0] * v_scale
-                data[fds.LABEL_RB_ADC_VCH_1] = rr.registers[1] * v_scale
-                data[fds.LABEL_RB_ADC_VCH_2] = rr.registers[2] * v_scale
-                data[fds.LABEL_RB_ADC_VCH_3] = rr.registers[3] * v_scale
-                data[fds.LABEL_RB_ADC_VCH_4] = rr.registers[4] * v_scale
-                data[fds.LABEL_RB_T_MOD] = rr.registers[5]
-                data[fds.LABEL_RB_GLOBAL_FAULTS] = rr.registers[6]
-                data[fds.LABEL_RB_GLOBAL_ALARMS] = rr.registers[7]
-                data[fds.LABEL_RB_HOURMETER_HI] = rr.registers[8]
-                data[fds.LABEL_RB_HOURMETER_LO] = rr.registers[9]
-                data[fds.LABEL_RB_CH_FAULTS_1] = rr.registers[10]
-                data[fds.LABEL_RB_CH_FAULTS_2] = rr.registers[11]
-                data[fds.LABEL_RB_CH_FAULTS_3] = rr.registers[12]
-                data[fds.LABEL_RB_CH_FAULTS_4] = rr.registers[13]
-                data[fds.LABEL_RB_CH_ALARMS_1] = rr.registers[14]
-                data[fds.LABEL_RB_CH_ALARMS_2] = rr.registers[15]
-                data[fds.LABEL_RB_CH_ALARMS_3] = rr.registers[16]
-                data[fds.LABEL_RB_CH_ALARMS_4] = rr.registers[17]
+                RELAY_BOX_MAP.decode(rr.registers, data)
             except ModbusIOException as e:
                 logging.error('RelayBoxRead: modbusIOException')
                 raise e
@@ -0,0 +1,145 @@
+import threading
+import time
+from concurrent.futures import Future
+
+from .commands import resolve
+from ..utils.metrics import metrics
+
+DEFAULT_COALESCE_WINDOW = 0.02  # seconds a command waits for the ones following it
+
+
+def parse_value(value):
+    # true/false, on/off, 1/0
+    if isinstance(value, str):
+        value = value.strip().lower()
+        if value in ('1', 'true', 'on'):
+            return True
+        if value in ('0', 'false', 'off'):
+            return False
+        raise ValueError('Invalid relay value {}'.format(value))
+    return bool(value)
+
+
+# Relay commands of one relay box, written outside of the polling cycle.
+# The commands received within the coalescing window go out as one write_coils over the span of their coils,
+# the coils are read back in the same session and every command is answered with the confirmed state.
+class RelayActuator:
+
+    def __init__(self, reader, window=DEFAULT_COALESCE_WINDOW, on_state=None, write_relays=None):
+        self.reader = reader
+        self.window = window
+        # function(actuator, coil, state) called for the confirmed states
+        self.on_state = on_state
+        # function(reader, start, values) writing the coils and returning all of them read back
+        self.write_relays = write_relays or (lambda reader, start, values: reader.write_relays(start, values))
+        self.condition = threading.Condition()
+        # [(coil, value, received, Future)] in their order of arrival, the last command of a coil wins
+        self.waiters = list()
+        # last confirmed coils, None until read
+        self.state = None
+        self.thread = None
+        self.running = True
+        self.batches = 0
+        self.commands = 0
+
+    def command(self, coil, value, received=None):
+        # Future of {'state': bool, 'relays': [bool]}, with 'superseded' when a later command of the batch won
+        if not 0 <= coil < self.reader.RELAY_COUNT:
+            raise ValueError('Relay {} out of range 0-{}'.format(coil, self.reader.RELAY_COUNT - 1))
+        future = Future()
+        with self.condition:
+            if not self.running:
+                raise RuntimeError('Actuator {} stopped'.format(self.reader.id))
+            self.waiters.append((coil, parse_value(value), time.monotonic() if received is None else received, future))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='relays-{}'.format(self.reader.id), daemon=True)
+                self.thread.start()
+            self.condition.notify()
+        return future
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.waiters:
+                    self.condition.wait()
+                if not self.running:
+                    return
+            # the commands following the first one join its batch
+            time.sleep(self.window)
+            with self.condition:
+                waiters, self.waiters = self.waiters, list()
+            try:
+                self.write(waiters)
+            except Exception as e:
+                # the thread serves the next commands whatever happened to this batch
+                print('RELAYS {}: {}'.format(self.reader.id, e))
+                for _, _, _, future in waiters:
+                    if not future.done():
+                        resolve(future, exception=e)
+
+    def write(self, waiters):
+        # the commands answered by their timeout meanwhile are not written
+        waiters = [waiter for waiter in waiters if not waiter[3].cancelled()]
+        if not waiters:
+            return
+        pending = {coil: value for coil, value, _, _ in waiters}
+
+        start = time.monotonic()
+        try:
+            if self.state is None:
+                self.state = self.write_relays(self.reader, 0, [])
+            # one contiguous write from the first to the last coil commanded, the others kept as they are
+            first, last = min(pending), max(pending)
+            values = [pending.get(coil, self.state[coil]) for coil in range(first, last + 1)]
+            confirmed = self.write_relays(self.reader, first, values)
+        except Exception as e:
+            self.state = None
+            metrics.increment('relays/errors')
+            print('RELAYS {}: {}'.format(self.reader.id, e))
+            for _, _, _, future in waiters:
+                resolve(future, exception=e)
+            return
+
+        now = time.monotonic()
+        metrics.observe('relays/write', (now - start) * 1000.0)
+        metrics.observe('relays/batch_size', len(waiters))
+        self.batches += 1
+        self.commands += len(waiters)
+
+        changed = [coil for coil in range(len(confirmed)) if self.state[coil] != confirmed[coil] or coil in pending]
+        self.state = confirmed
+
+        # the commands are answered before the state messages, whose failure does not undo the write
+        for coil, value, received, future in waiters:
+            metrics.observe('relays/latency', (now - received) * 1000.0)
+            if confirmed[coil] != pending[coil]:
+                resolve(future, exception=ValueError('Relay {} read back {}'.format(coil, confirmed[coil])))
+            elif value != pending[coil]:
+                # overridden by a later command of the same batch, answered with the confirmed state
+                resolve(future, {'state': confirmed[coil], 'relays': confirmed, 'superseded': True})
+            else:
+                resolve(future, {'state': confirmed[coil], 'relays': confirmed})
+
+        for coil in changed:
+            if self.on_state is None:
+                continue
+            try:
+                self.on_state(self, coil, confirmed[coil])
+            except Exception as e:
+                metrics.increment('relays/state_errors')
+                print('RELAYS {}: state of relay {} not published: {}'.format(self.reader.id, coil, e))
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            waiters, self.waiters = self.waiters, list()
+            self.condition.notify()
+        for _, _, _, future in waiters:
+            resolve(future, exception=RuntimeError('Actuator {} stopped'.format(self.reader.id)))
+        if self.thread is not None:
+            self.thread.join()
+
+    def __str__(self):
+        return 'batches={} commands={} relays={}'.format(
+            self.batches, self.commands,
+            '-' if self.state is None else ''.join('1' if state else '0' for state in self.state))
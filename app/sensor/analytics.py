@@ -0,0 +1,245 @@
+import json
+import math
+import os
+import threading
+from collections import deque
+
+DEFAULT_MAX_GAP = 300.0  # seconds, a longer gap between two samples is not integrated
+
+# unit -> divisor turning the integral over seconds into the unit
+INTEGRAL_UNITS = {
+    'Wh': 3600.0,  # of W
+    'kWh': 3600000.0,  # of W
+    'Ah': 3600.0,  # of A
+}
+
+
+def parse_integrals(value):
+    # "inPower=kWh, battsI=Ah" -> {'inPower': 'kWh', 'battsI': 'Ah'}
+    integrals = dict()
+    for item in str(value or '').split(','):
+        if item.strip() == '':
+            continue
+        key, unit = item.split('=')
+        unit = unit.strip()
+        if unit not in INTEGRAL_UNITS:
+            raise ValueError('Unsupported unit {}. Choose among {}'.format(unit, ', '.join(INTEGRAL_UNITS)))
+        integrals[key.strip()] = unit
+    return integrals
+
+
+def parse_keys(value):
+    # "battsV, battsI" -> ['battsV', 'battsI']
+    return [item.strip() for item in str(value or '').split(',') if item.strip()]
+
+
+def parse_windows(value):
+    # "300, 3600" -> [300.0, 3600.0]
+    return sorted(float(item) for item in parse_keys(value))
+
+
+def format_window(window):
+    # 300 -> "5m", 3600 -> "1h"
+    if window % 3600 == 0:
+        return '{:g}h'.format(window / 3600)
+    if window % 60 == 0:
+        return '{:g}m'.format(window / 60)
+    return '{:g}s'.format(window)
+
+
+# Trapezoidal integral of one series, its total in `unit`
+class Integral:
+    __slots__ = ('total', 'timestamp', 'value', 'unit')
+
+    def __init__(self, total=0.0, timestamp=None, value=None, unit=None):
+        self.total = total
+        self.timestamp = timestamp
+        self.value = value
+        self.unit = unit
+
+    def convert(self, unit):
+        # a total restored in another unit of the same key, Wh -> kWh
+        if self.unit is not None and self.unit != unit:
+            self.total = self.total * INTEGRAL_UNITS[self.unit] / INTEGRAL_UNITS[unit]
+        self.unit = unit
+
+    def add(self, timestamp, value, divisor, max_gap):
+        if self.timestamp is not None and 0 < timestamp - self.timestamp <= max_gap:
+            self.total += (self.value + value) / 2.0 * (timestamp - self.timestamp) / divisor
+        if self.timestamp is None or timestamp > self.timestamp:
+            self.timestamp = timestamp
+            self.value = value
+
+
+# Min/max/mean/stddev of the samples of the last `window` seconds, in amortised O(1) per sample:
+# monotonic deques for the extremes, sums shifted by a sample value for the moments. The sums are
+# recomputed, shifted by the oldest sample, once as many samples expired as are left, so neither the
+# rounding of the subtractions nor a drifted shift accumulate.
+class RollingWindow:
+
+    def __init__(self, window):
+        self.window = window
+        self.samples = deque()
+        self.minimums = deque()
+        self.maximums = deque()
+        self.shift = None
+        self.sum = 0.0
+        self.squares = 0.0
+        self.expired = 0
+
+    def add(self, timestamp, value):
+        if self.shift is None:
+            self.shift = value
+        self.samples.append((timestamp, value))
+        shifted = value - self.shift
+        self.sum += shifted
+        self.squares += shifted * shifted
+
+        while self.minimums and self.minimums[-1][1] >= value:
+            self.minimums.pop()
+        self.minimums.append((timestamp, value))
+        while self.maximums and self.maximums[-1][1] <= value:
+            self.maximums.pop()
+        self.maximums.append((timestamp, value))
+        self.expire(timestamp)
+
+    def expire(self, now):
+        start = now - self.window
+        samples = self.samples
+        while samples and samples[0][0] <= start:
+            _, value = samples.popleft()
+            shifted = value - self.shift
+            self.sum -= shifted
+            self.squares -= shifted * shifted
+            self.expired += 1
+        while self.minimums and self.minimums[0][0] <= start:
+            self.minimums.popleft()
+        while self.maximums and self.maximums[0][0] <= start:
+            self.maximums.popleft()
+        if self.expired and self.expired >= len(samples):
+            self.rebase()
+
+    def rebase(self):
+        self.expired = 0
+        self.shift = self.samples[0][1] if self.samples else None
+        self.sum = 0.0
+        self.squares = 0.0
+        for _, value in self.samples:
+            shifted = value - self.shift
+            self.sum += shifted
+            self.squares += shifted * shifted
+
+    def get_stats(self):
+        count = len(self.samples)
+        if not count:
+            return None
+        mean = self.sum / count
+        variance = max(0.0, self.squares / count - mean * mean)
+        return {'min': self.minimums[0][1], 'max': self.maximums[0][1], 'mean': round(mean + self.shift, 6),
+                'stddev': round(math.sqrt(variance), 6), 'count': count}
+
+
+# Incremental analytics of the decoded readings: energy and charge integrated sample by sample,
+# rolling statistics over a few windows. The integrals and the samples of the windows are saved
+# to `path` and restored on start.
+class StreamingAnalytics:
+
+    def __init__(self, path=None, integrals=None, stats=(), windows=(), max_gap=DEFAULT_MAX_GAP):
+        self.path = path
+        # key -> unit
+        self.integrals = integrals or dict()
+        self.stats = list(stats)
+        self.windows = list(windows)
+        self.max_gap = float(max_gap)
+        self.lock = threading.Lock()
+
+        # (device, key) -> Integral
+        self.totals = dict()
+        # (device, key) -> [RollingWindow]
+        self.rolling = dict()
+        self.samples = 0
+        self.load()
+
+    def load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return
+        # [total, timestamp, value, unit], without the unit before it was saved
+        for name, saved_integral in saved.get('integrals', dict()).items():
+            device, _, key = name.partition('/')
+            self.totals[(device, key)] = Integral(*saved_integral)
+        # the samples of the longest window replayed into the windows configured now
+        if not self.windows:
+            return
+        for name, samples in saved.get('windows', dict()).items():
+            device, _, key = name.partition('/')
+            if key not in self.stats:
+                continue
+            windows = self.rolling[(device, key)] = [RollingWindow(window) for window in self.windows]
+            for timestamp, value in samples:
+                for window in windows:
+                    window.add(timestamp, value)
+
+    def save(self):
+        # through a temporary file and a rename, as config.ini
+        if not self.path:
+            return
+        with self.lock:
+            integrals = {'{}/{}'.format(device, key):
+                         [integral.total, integral.timestamp, integral.value, integral.unit]
+                         for (device, key), integral in self.totals.items()}
+            windows = {'{}/{}'.format(device, key): list(max(rolling, key=lambda window: window.window).samples)
+                       for (device, key), rolling in self.rolling.items() if rolling}
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump({'integrals': integrals, 'windows': windows}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
+
+    def record(self, data):
+        timestamp = data.timestamp
+        with self.lock:
+            for key, value in data.value.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                unit = self.integrals.get(key)
+                if unit is not None:
+                    integral = self.totals.get((data.key, key))
+                    if integral is None:
+                        integral = self.totals[(data.key, key)] = Integral(unit=unit)
+                    elif integral.unit != unit:
+                        integral.convert(unit)
+                    integral.add(timestamp, value, INTEGRAL_UNITS[unit], self.max_gap)
+                if key in self.stats:
+                    windows = self.rolling.get((data.key, key))
+                    if windows is None:
+                        windows = self.rolling[(data.key, key)] = [RollingWindow(window) for window in self.windows]
+                    for window in windows:
+                        window.add(timestamp, value)
+                    self.samples += 1
+
+    def get_report(self, now=None):
+        # device -> {'integrals': {"<key>_<unit>": total}, 'stats': {"<window>": {key: stats}}}
+        report = dict()
+        with self.lock:
+            for (device, key), integral in self.totals.items():
+                integrals = report.setdefault(device, {'integrals': dict(), 'stats': dict()})['integrals']
+                unit = integral.unit or self.integrals.get(key, 'total')
+                integrals['{}_{}'.format(key, unit)] = round(integral.total, 6)
+            for (device, key), windows in self.rolling.items():
+                stats = report.setdefault(device, {'integrals': dict(), 'stats': dict()})['stats']
+                for window in windows:
+                    if now is not None:
+                        window.expire(now)
+                    values = window.get_stats()
+                    if values is not None:
+                        stats.setdefault(format_window(window.window), dict())[key] = values
+        return report
+
+    def __str__(self):
+        return 'ANALYTICS: integrals={} series={} samples={}'.format(len(self.totals), len(self.rolling), self.samples)
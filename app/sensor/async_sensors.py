@@ -0,0 +1,276 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pymodbus.client.asynchronous.async_io import AsyncioModbusTcpClient
+from pymodbus.exceptions import ModbusIOException
+
+from .modbus_reader import ModbusReader
+from .reader import SensorValue, get_timestamp
+from .sensors import Sensors
+from ..utils.metrics import metrics
+
+
+# One asyncio Modbus TCP client per gateway, shared by all the units behind it
+class AsyncModbusConnection:
+
+    def __init__(self, ip_address, port):
+        self.ip_address = ip_address
+        self.port = port
+        self.client = None
+        self.lock = asyncio.Lock()
+
+        self.connects = 0
+        self.reuses = 0
+
+    async def open(self):
+        if self.client is not None and self.client.connected:
+            self.reuses += 1
+            return self.client.protocol
+
+        self.close()
+        self.client = AsyncioModbusTcpClient(self.ip_address, port=self.port, loop=asyncio.get_running_loop())
+        await self.client.connect()
+        if not self.client.connected:
+            self.client = None
+            raise ConnectionError('Unable to connect to Modbus gateway {}:{}'.format(self.ip_address, self.port))
+
+        self.connects += 1
+        return self.client.protocol
+
+    def close(self):
+        if self.client is not None:
+            self.client.stop()
+            self.client = None
+
+
+class AsyncSensors(Sensors):
+
+    def __init__(self, config_file, mqtt_client):
+        super().__init__(config_file, mqtt_client)
+        self.loop = None
+        self.loop_thread = None
+        self.wakeup = None
+        self.modbus_connections = dict()
+        # the blocking reads, and per reader the one still running, left behind by a timeout
+        self.read_executor = ThreadPoolExecutor(thread_name_prefix='blocking-reader')
+        self.inflight = dict()
+
+    def get_connection(self, ip_address, port):
+        key = (ip_address, int(port))
+        if key not in self.modbus_connections:
+            self.modbus_connections[key] = AsyncModbusConnection(ip_address, int(port))
+        return self.modbus_connections[key]
+
+    async def request_registers(self, connection, reader, plan, registers):
+        with metrics.timer('{}/connect'.format(reader.id)):
+            protocol = await connection.open()
+        with metrics.timer('{}/read'.format(reader.id)):
+            for start, count in plan.ranges:
+                rr = await protocol.read_holding_registers(start, count, unit=reader.unit_id)
+                if rr.isError():
+                    raise ModbusIOException(str(rr))
+                registers[start:start + count] = rr.registers
+        return registers
+
+    async def read_modbus(self, reader, groups):
+        groups = groups or reader.get_groups()
+        timestamp = get_timestamp()
+        registers, plan = reader.prepare_read(groups)
+        connection = self.get_connection(reader.ip_address, reader.port)
+        # units behind the same gateway are queued, different gateways run concurrently
+        async with connection.lock:
+            try:
+                # the timeout covers this unit's transaction only, not the wait for the gateway
+                await asyncio.wait_for(self.request_registers(connection, reader, plan, registers),
+                                       self.configurations['READ_TIMEOUT'])
+            except ModbusIOException:
+                reader.cache.clear()
+                raise
+            except BaseException:
+                # timed out or cancelled: a late response would be matched to the next request
+                reader.cache.clear()
+                connection.close()
+                raise
+        reader.cache.store(registers, plan.registers)
+
+        data = {'type': reader.DEVICE_TYPE}
+        with metrics.timer('{}/decode'.format(reader.id)):
+            reader.decode_registers(registers, data, groups)
+        return SensorValue(reader.id, data, timestamp)
+
+    async def request_coils(self, connection, reader, start, values):
+        protocol = await connection.open()
+        if values:
+            rr = await protocol.write_coils(start, values, unit=reader.unit_id)
+            if rr.isError():
+                raise ModbusIOException(str(rr))
+        rr = await protocol.read_coils(0, reader.RELAY_COUNT, unit=reader.unit_id)
+        if rr.isError():
+            raise ModbusIOException(str(rr))
+        return list(rr.bits[:reader.RELAY_COUNT])
+
+    async def write_coils(self, reader, start, values):
+        connection = self.get_connection(reader.ip_address, reader.port)
+        # queued with the reads of the units behind the gateway
+        async with connection.lock:
+            try:
+                return await asyncio.wait_for(self.request_coils(connection, reader, start, values),
+                                              self.configurations['READ_TIMEOUT'])
+            except ModbusIOException:
+                raise
+            except BaseException:
+                connection.close()
+                raise
+
+    def write_relays(self, reader, start, values):
+        # on the relay thread: the coils go through the gateway connection and lock of the reads
+        if reader.produce_dummy_data or reader.pool is not self.modbus_pool or self.loop is None \
+                or self.loop.is_closed():
+            return super().write_relays(reader, start, values)
+        future = asyncio.run_coroutine_threadsafe(self.write_coils(reader, start, values), self.loop)
+        try:
+            return future.result(self.configurations['COMMAND_TIMEOUT'])
+        except BaseException:
+            future.cancel()
+            raise
+
+    async def read_value(self, reader, groups):
+        if isinstance(reader, ModbusReader) \
+                and not reader.produce_dummy_data and reader.pool is self.modbus_pool:
+            return await self.read_modbus(reader, groups)
+
+        # smbus2, the RTU arbiter and the other readers are blocking: keep them off the event loop.
+        # A timeout cannot interrupt the thread, the read goes on in the background until the bus answers
+        future = self.loop.run_in_executor(self.read_executor, reader.read, groups or None)
+        future.add_done_callback(lambda future: future.cancelled() or future.exception())
+        self.inflight[reader.id] = future
+        return await asyncio.wait_for(asyncio.shield(future), self.configurations['READ_TIMEOUT'])
+
+    async def read_reader_async(self, reader, groups):
+        inflight = self.inflight.get(reader.id)
+        if inflight is not None and not inflight.done():
+            # still stuck on the previous read: no other thread queued behind it
+            metrics.increment('{}/skipped_busy'.format(reader.id))
+            print('{}: previous read still running, skipped'.format(reader.id))
+            return
+
+        start = time.monotonic()
+        try:
+            data = await self.read_value(reader, groups)
+            self.record_health(reader)
+            self.read_and_publish(data)
+        except (asyncio.TimeoutError, ModbusIOException) as e:
+            metrics.increment('{}/timeouts'.format(reader.id))
+            self.record_health(reader, e)
+            print('{}: read timeout after {}s'.format(reader.id, self.configurations['READ_TIMEOUT']))
+        except Exception as e:
+            metrics.increment('{}/errors'.format(reader.id))
+            self.record_health(reader, e)
+            print(e)
+        finally:
+            self.reading_times[reader.id] = time.monotonic() - start
+            metrics.observe('{}/total'.format(reader.id), self.reading_times[reader.id] * 1000.0)
+
+    async def read_async(self):
+        self.apply_changes()
+        start = time.monotonic()
+        tasks = self.get_due_readers()
+
+        if not tasks:
+            return
+        metrics.observe('cycle/lateness', self.scheduler.lateness * 1000.0)
+
+        await asyncio.gather(*[self.read_reader_async(reader, groups) for reader, groups in tasks])
+        self.publisher.flush()
+
+        cycle_time = time.monotonic() - start
+        metrics.observe('cycle/duration', cycle_time * 1000.0)
+        print('READING TIMES: {} cycle={:.3f}s'.format(
+            ' '.join('{}={:.3f}s'.format(reader.id, self.reading_times.get(reader.id, 0)) for reader, _ in tasks),
+            cycle_time))
+        self.observe_wire_bytes(tasks)
+
+        self.publish_telemetry()
+        self.publish_analytics()
+
+    def start_outbox(self):
+        # paho is driven by the event loop, so is the replay
+        pass
+
+    async def replay_async(self):
+        while True:
+            store_and_forward = self.store_and_forward
+            await asyncio.sleep(store_and_forward.step() if store_and_forward is not None else 1.0)
+
+    def call_on_loop(self, function, *args):
+        # paho is driven by the event loop: the other threads hand their publishes over to it
+        if self.loop is None or threading.get_ident() == self.loop_thread:
+            function(*args)
+            return
+        try:
+            self.loop.call_soon_threadsafe(function, *args)
+        except RuntimeError as e:
+            # the loop is closed
+            print('{} not run: {}'.format(getattr(function, '__name__', function), e))
+
+    def publish_response(self, topic, payload):
+        self.call_on_loop(super().publish_response, topic, payload)
+
+    def publish_relay_state(self, actuator, coil, state):
+        self.call_on_loop(super().publish_relay_state, actuator, coil, state)
+
+    def change_property(self, key, value, value_type):
+        future = super().change_property(key, value, value_type)
+        if self.wakeup is not None:
+            # called by a command worker
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+        return future
+
+    async def run_async(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.wakeup = asyncio.Event()
+        mqtt_task = self.mqtt_client.start_asyncio(self.loop)
+        replay_task = self.loop.create_task(self.replay_async())
+
+        try:
+            while True:
+                await self.read_async()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self.scheduler.get_wait_time())
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+        finally:
+            mqtt_task.cancel()
+            replay_task.cancel()
+            self.close_connections()
+
+    def close_connections(self):
+        for connection in self.modbus_connections.values():
+            connection.close()
+
+    def start(self):
+        asyncio.run(self.run_async())
+
+    def stop(self):
+        self.mqtt_client.client.disconnect()
+        # the asyncio clients belong to the loop, closed already when it is
+        if self.loop is None or not self.loop.is_closed():
+            self.call_on_loop(self.close_connections)
+        self.read_executor.shutdown(wait=False)
+        self.modbus_pool.close_all()
+        if self.rtu_buses is not None:
+            self.rtu_buses.close_all()
+        if self.commands is not None:
+            self.commands.stop()
+        for actuator in self.actuators.values():
+            actuator.stop()
+        if self.store_and_forward is not None:
+            self.store_and_forward.stop()
+        if self.history is not None:
+            self.history.close()
+        if self.analytics is not None:
+            self.analytics.save()
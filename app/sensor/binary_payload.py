@@ -0,0 +1,198 @@
+import json
+import struct
+import time
+import zlib
+
+# Device snapshots packed after a schema derived from the device's fields:
+#
+#   schema id (uint32), timestamp seconds (uint32) and milliseconds (uint16), presence bitmap
+#   (1 bit per schema field), the numbers present packed little-endian, then the strings present
+#   as uint8 length + utf-8. The labels missing from a partial read travel as the comma separated
+#   string field MISSING_FIELD.
+#
+# Schemas are announced as JSON on their own topic, consumers keep them by id.
+HEADER = struct.Struct('<IIH')
+
+CODE_BOOL = '?'
+CODE_INT = 'i'
+CODE_FLOAT = 'f'
+CODE_DOUBLE = 'd'
+CODE_STRING = 's'
+# a field only moves to a wider code, so the schema of a device settles after a few cycles
+CODES = (CODE_BOOL, CODE_INT, CODE_FLOAT, CODE_DOUBLE, CODE_STRING)
+RANKS = {code: rank for rank, code in enumerate(CODES)}
+
+DEFAULT_SCHEMA_INTERVAL = 300  # seconds between announcements of an unchanged schema
+
+MISSING_FIELD = '_missing'
+
+
+def get_code(value):
+    if isinstance(value, bool):
+        return CODE_BOOL
+    if isinstance(value, int):
+        return CODE_INT if -2 ** 31 <= value < 2 ** 31 else CODE_DOUBLE
+    if isinstance(value, float):
+        return CODE_FLOAT
+    return CODE_STRING
+
+
+class Schema:
+
+    def __init__(self, device, device_type, fields):
+        # fields: [(key, code)]
+        self.device = device
+        self.device_type = device_type
+        self.fields = list(fields)
+        self.index = {key: position for position, (key, _) in enumerate(self.fields)}
+        self.codes = [code for _, code in self.fields]
+        self.ranks = {key: RANKS[code] for key, code in self.fields}
+        self.bitmap_size = (len(self.fields) + 7) // 8
+        # layout of a snapshot holding every field
+        self.full_bitmap = bytes(bytearray(
+            sum(1 << bit for bit in range(8) if byte * 8 + bit < len(self.fields)) for byte in range(self.bitmap_size)))
+        self.numbers = [key for key, code in self.fields if code != CODE_STRING]
+        self.strings = [key for key, code in self.fields if code == CODE_STRING]
+        self.full_struct = struct.Struct('<' + ''.join(code for code in self.codes if code != CODE_STRING))
+        self.id = zlib.crc32(self.dumps(with_id=False).encode())
+        self.announced = None
+
+    def dumps(self, with_id=True):
+        schema = {'device': self.device, 'type': self.device_type, 'fields': self.fields}
+        if with_id:
+            schema['id'] = self.id
+        return json.dumps(schema, separators=(',', ':'))
+
+    def accepts(self, device_type, values):
+        if device_type != self.device_type:
+            return False
+        ranks = self.ranks
+        for key, value in values.items():
+            rank = ranks.get(key)
+            if rank is None or RANKS[get_code(value)] > rank:
+                return False
+        return True
+
+    def widen(self, device_type, values):
+        # a schema holding the fields of this one and of values
+        codes = dict(self.fields) if device_type == self.device_type else dict()
+        for key, value in values.items():
+            code = get_code(value)
+            if key not in codes or RANKS[code] > RANKS[codes[key]]:
+                codes[key] = code
+        return Schema(self.device, device_type, codes.items())
+
+
+class BinaryEncoder:
+
+    def __init__(self, schema_interval=DEFAULT_SCHEMA_INTERVAL):
+        self.schema_interval = schema_interval
+        # device -> Schema
+        self.schemas = dict()
+
+    def encode(self, snapshot):
+        # device snapshot -> (schema to announce or None, payload)
+        device, device_type, values = snapshot['device'], snapshot['type'], snapshot['values']
+        if snapshot.get('missing'):
+            values = dict(values)
+            values[MISSING_FIELD] = ','.join(snapshot['missing'])
+        schema = self.schemas.get(device)
+        if schema is None:
+            schema = self.schemas[device] = Schema(device, device_type, ()).widen(device_type, values)
+        elif not schema.accepts(device_type, values):
+            schema = self.schemas[device] = schema.widen(device_type, values)
+
+        now = time.monotonic()
+        announce = None
+        if schema.announced is None or now - schema.announced >= self.schema_interval:
+            schema.announced = now
+            announce = schema
+
+        return announce, pack(schema, snapshot['timestamp'], values)
+
+
+def pack_string(value):
+    encoded = str(value).encode()[:255]
+    return struct.pack('<B', len(encoded)) + encoded
+
+
+def pack_header(schema, timestamp):
+    seconds, milliseconds = divmod(int(round(timestamp * 1000)), 1000)
+    return HEADER.pack(schema.id, seconds, milliseconds)
+
+
+def pack(schema, timestamp, values):
+    if len(values) == len(schema.fields):
+        # every field present, the usual case without report by exception
+        return b''.join([pack_header(schema, timestamp), schema.full_bitmap,
+                         schema.full_struct.pack(*[values[key] for key in schema.numbers])] +
+                        [pack_string(values[key]) for key in schema.strings])
+
+    bitmap = bytearray(schema.bitmap_size)
+    numbers = list()
+    formats = ['<']
+    strings = list()
+    for key, position in schema.index.items():
+        if key not in values:
+            continue
+        bitmap[position >> 3] |= 1 << (position & 7)
+        code = schema.codes[position]
+        if code == CODE_STRING:
+            strings.append(pack_string(values[key]))
+        else:
+            formats.append(code)
+            numbers.append(values[key])
+    return b''.join([pack_header(schema, timestamp), bytes(bitmap),
+                     struct.pack(''.join(formats), *numbers)] + strings)
+
+
+# Decoding helper for the consumers of the binary payloads
+class BinaryDecoder:
+
+    def __init__(self):
+        # schema id -> Schema
+        self.schemas = dict()
+
+    def add_schema(self, payload):
+        schema = json.loads(payload) if isinstance(payload, (str, bytes)) else payload
+        decoded = Schema(schema['device'], schema['type'], [tuple(field) for field in schema['fields']])
+        if decoded.id != schema['id']:
+            raise ValueError('Schema {} does not match its fields'.format(schema['id']))
+        self.schemas[decoded.id] = decoded
+        return decoded
+
+    def decode(self, payload):
+        # payload -> {'device', 'type', 'timestamp', 'values'}, as published in the device mode
+        schema_id, timestamp, milliseconds = HEADER.unpack_from(payload)
+        if milliseconds:
+            timestamp = timestamp + milliseconds / 1000.0
+        schema = self.schemas.get(schema_id)
+        if schema is None:
+            raise KeyError('Unknown schema {}, wait for its announcement'.format(schema_id))
+
+        offset = HEADER.size
+        bitmap = payload[offset:offset + schema.bitmap_size]
+        offset += schema.bitmap_size
+        present = [position for position in range(len(schema.fields)) if bitmap[position >> 3] & (1 << (position & 7))]
+
+        numeric = [position for position in present if schema.codes[position] != CODE_STRING]
+        numbers = struct.Struct('<' + ''.join(schema.codes[position] for position in numeric))
+        values = dict()
+        for position, value in zip(numeric, numbers.unpack_from(payload, offset)):
+            if schema.codes[position] == CODE_FLOAT:
+                # float32 round trip of the decimals the readers round to
+                value = float('{:.7g}'.format(value))
+            values[schema.fields[position][0]] = value
+        offset += numbers.size
+
+        for position in present:
+            if schema.codes[position] == CODE_STRING:
+                length = payload[offset]
+                values[schema.fields[position][0]] = payload[offset + 1:offset + 1 + length].decode()
+                offset += 1 + length
+
+        snapshot = {'device': schema.device, 'type': schema.device_type, 'timestamp': timestamp,
+                    'values': {key: values[key] for key, _ in schema.fields if key in values and key != MISSING_FIELD}}
+        if MISSING_FIELD in values:
+            snapshot['missing'] = values[MISSING_FIELD].split(',')
+        return snapshot
@@ -0,0 +1,80 @@
+import random
+import time
+
+STATE_CLOSED = 'closed'  # read on every cycle
+STATE_OPEN = 'open'  # skipped until the backoff elapses
+STATE_HALF_OPEN = 'half_open'  # one probing read, closes on success and reopens with a longer backoff on failure
+
+DEFAULT_FAILURES = 3
+DEFAULT_BACKOFF = 10.0  # seconds before the first probe
+DEFAULT_MAX_BACKOFF = 600.0
+DEFAULT_JITTER = 0.2  # +/- fraction of the backoff, so that devices down together are not probed together
+
+
+# Health of one reader: after `failures` failed reads in a row the reader is left out of the polling
+# cycles, then probed after a backoff doubling on every failed probe up to max_backoff.
+class CircuitBreaker:
+
+    def __init__(self, failures=DEFAULT_FAILURES, backoff=DEFAULT_BACKOFF, max_backoff=DEFAULT_MAX_BACKOFF,
+                 jitter=DEFAULT_JITTER, rng=None):
+        self.failures = failures
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.rng = rng or random.Random()
+
+        self.state = STATE_CLOSED
+        self.consecutive_failures = 0
+        self.current_backoff = 0.0
+        self.retry_at = 0.0
+        self.opened_at = None
+        self.skipped = 0
+        self.probes = 0
+
+    def is_available(self):
+        return self.state == STATE_CLOSED
+
+    def allow(self, now=None):
+        # whether the reader is read on this cycle
+        if self.state != STATE_OPEN:
+            return True
+        now = time.monotonic() if now is None else now
+        if now < self.retry_at:
+            self.skipped += 1
+            return False
+        self.state = STATE_HALF_OPEN
+        self.probes += 1
+        return True
+
+    def record_success(self):
+        # True when the reader came back
+        recovered = self.state != STATE_CLOSED
+        self.state = STATE_CLOSED
+        self.consecutive_failures = 0
+        self.current_backoff = 0.0
+        self.opened_at = None
+        return recovered
+
+    def record_failure(self, now=None):
+        # True when the reader just became unavailable
+        now = time.monotonic() if now is None else now
+        self.consecutive_failures += 1
+        if self.state == STATE_CLOSED and self.consecutive_failures < self.failures:
+            return False
+
+        opened = self.state == STATE_CLOSED
+        if opened:
+            self.opened_at = now
+            self.current_backoff = self.backoff
+        else:
+            self.current_backoff = min(self.max_backoff, self.current_backoff * 2)
+        self.state = STATE_OPEN
+        self.retry_at = now + self.current_backoff * (1 + self.rng.uniform(-self.jitter, self.jitter))
+        return opened
+
+    def get_retry_in(self, now=None):
+        now = time.monotonic() if now is None else now
+        return max(0.0, self.retry_at - now) if self.state == STATE_OPEN else 0.0
+
+    def __str__(self):
+        return '{} failures={} retry_in={:.1f}s'.format(self.state, self.consecutive_failures, self.get_retry_in())
@@ -0,0 +1,209 @@
+import heapq
+import itertools
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+
+from ..utils.metrics import metrics
+
+DEFAULT_WORKERS = 1
+DEFAULT_QUEUE_SIZE = 100
+DEFAULT_TIMEOUT = 10.0  # seconds from reception to response
+
+STATUS_OK = 'ok'
+STATUS_ERROR = 'error'
+STATUS_TIMEOUT = 'timeout'
+STATUS_EXPIRED = 'expired'  # waited in the queue past its deadline, never executed
+STATUS_BUSY = 'busy'  # queue full
+
+
+def resolve(future, result=None, exception=None):
+    # the future of a command may have been cancelled by its timeout meanwhile
+    try:
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
+
+
+class Command:
+    __slots__ = ('topic', 'channel', 'module', 'name', 'payload', 'received', 'deadline', 'future', 'replied')
+
+    def __init__(self, topic, payload, received, timeout):
+        # /<channel>/<module>/<name>/request
+        _, self.channel, self.module, self.name, _ = topic.split('/')
+        self.topic = topic
+        self.payload = payload
+        self.received = received
+        self.deadline = received + timeout
+        # Future returned by the handler, cancelled on timeout
+        self.future = None
+        # a command is answered once: by its handler or by its timeout, whichever comes first
+        self.replied = False
+
+    def get_id(self):
+        # correlation id chosen by the requester
+        return self.payload.get('id') if isinstance(self.payload, dict) else None
+
+    def get_response_topic(self):
+        return '/{}/{}/{}/response'.format(self.channel, self.module, self.name)
+
+    def remaining(self):
+        return max(0.0, self.deadline - time.monotonic())
+
+
+# Takes the /configurations, /actuators and /data requests off the paho network thread:
+# the MQTT callback only queues the message, workers run the handlers and publish the responses.
+# A watchdog answers `timeout` at the deadline of the commands still running and drops their late result.
+class CommandProcessor:
+
+    def __init__(self, handlers, respond, workers=DEFAULT_WORKERS, queue_size=DEFAULT_QUEUE_SIZE,
+                 timeout=DEFAULT_TIMEOUT):
+        # handlers: channel -> function(command) returning the response payload,
+        # or a Future of it answered when done without holding the worker
+        self.handlers = handlers
+        self.respond = respond
+        self.timeout = timeout
+        self.commands = queue.Queue(queue_size)
+        self.threads = list()
+        self.workers = 0
+        self.lock = threading.Lock()
+        # [(deadline, sequence, command)] of the commands being handled
+        self.deadlines = list()
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.running = True
+        self.watchdog = threading.Thread(target=self.watch, name='command-watchdog', daemon=True)
+        self.watchdog.start()
+        self.resize(workers, queue_size)
+
+    def resize(self, workers, queue_size):
+        self.commands.maxsize = queue_size
+        while len(self.threads) < workers:
+            thread = threading.Thread(target=self.run, name='command-{}'.format(len(self.threads)), daemon=True)
+            self.threads.append(thread)
+            thread.start()
+        while len(self.threads) > max(1, workers):
+            # the surplus workers leave after the commands already queued
+            self.threads.pop()
+            self.commands.put(None)
+        self.workers = len(self.threads)
+
+    def get_queue_depth(self):
+        return self.commands.qsize()
+
+    def submit(self, message):
+        # called on the paho thread: no parsing nor I/O beyond the queueing
+        received = time.monotonic()
+        try:
+            command = Command(message.topic, json.loads(message.payload), received, self.timeout)
+        except Exception as e:
+            metrics.increment('commands/invalid')
+            print('COMMAND {}: {}'.format(message.topic, e))
+            return False
+
+        try:
+            self.commands.put_nowait(command)
+        except queue.Full:
+            metrics.increment('commands/rejected')
+            self.reply(command, STATUS_BUSY, error='{} commands waiting'.format(self.commands.maxsize))
+            return False
+        metrics.set_gauge('commands/queue_depth', self.commands.qsize())
+        return True
+
+    def run(self):
+        while True:
+            command = self.commands.get()
+            if command is None:
+                return
+            self.process(command)
+
+    def process(self, command):
+        if time.monotonic() > command.deadline:
+            metrics.increment('commands/expired')
+            self.reply(command, STATUS_EXPIRED, error='expired in the queue')
+            return
+
+        handler = self.handlers.get('/' + command.channel)
+        self.arm(command)
+        try:
+            if handler is None:
+                raise ValueError('No handler for {}'.format(command.channel))
+            response = handler(command)
+        except Exception as e:
+            if self.reply(command, STATUS_ERROR, error=str(e)):
+                metrics.increment('commands/errors')
+        else:
+            if isinstance(response, Future):
+                command.future = response
+                response.add_done_callback(lambda future: self.complete(command, future))
+                if command.replied:
+                    # timed out while the handler ran
+                    response.cancel()
+            elif not self.reply(command, STATUS_OK, response):
+                metrics.increment('commands/late')
+
+    def complete(self, command, future):
+        # on the thread resolving the future
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            if self.reply(command, STATUS_ERROR, error=str(future.exception())):
+                metrics.increment('commands/errors')
+        elif not self.reply(command, STATUS_OK, future.result()):
+            metrics.increment('commands/late')
+
+    def arm(self, command):
+        with self.condition:
+            heapq.heappush(self.deadlines, (command.deadline, next(self.sequence), command))
+            self.condition.notify()
+
+    def watch(self):
+        # answers the commands not done by their deadline and cancels their future
+        while True:
+            with self.condition:
+                while self.running and (not self.deadlines or self.deadlines[0][0] > time.monotonic()):
+                    self.condition.wait(self.deadlines[0][0] - time.monotonic() if self.deadlines else None)
+                if not self.running:
+                    return
+                _, _, command = heapq.heappop(self.deadlines)
+            if self.reply(command, STATUS_TIMEOUT, error='not done after {:g}s'.format(self.timeout)):
+                metrics.increment('commands/timeouts')
+                if command.future is not None:
+                    command.future.cancel()
+
+    def reply(self, command, status, response=None, error=None):
+        # False when the command was already answered
+        with self.lock:
+            if command.replied:
+                return False
+            command.replied = True
+
+        payload = dict(command.payload) if isinstance(command.payload, dict) else {'request': command.payload}
+        if response:
+            payload.update(response)
+        payload['id'] = command.get_id()
+        payload['status'] = status
+        if error is not None:
+            payload['error'] = error
+
+        elapsed = (time.monotonic() - command.received) * 1000.0
+        metrics.observe('commands/latency', elapsed)
+        metrics.observe('commands/{}'.format(command.channel), elapsed)
+        self.respond(command.get_response_topic(), json.dumps(payload))
+        return True
+
+    def stop(self):
+        for _ in self.threads:
+            self.commands.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = list()
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.watchdog.join()
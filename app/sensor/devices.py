@@ -0,0 +1,75 @@
+from collections import OrderedDict, namedtuple
+
+from .modbus_pool import DEFAULT_MODBUS_PORT
+
+DEVICE_CHARGE_CONTROLLER = 'charge_controller'
+DEVICE_RELAY_BOX = 'relay_box'
+DEVICE_TYPES = (DEVICE_CHARGE_CONTROLLER, DEVICE_RELAY_BOX)
+
+TRANSPORT_TCP = 'tcp'
+TRANSPORT_RTU = 'rtu'
+
+# for RTU devices the address is the serial port and the port its baud rate (None for RS485_BAUDRATE)
+Device = namedtuple('Device', ['id', 'type', 'transport', 'address', 'port', 'unit_id'])
+
+
+def parse_devices(value, default_port=DEFAULT_MODBUS_PORT):
+    # "cc1=charge_controller@192.168.2.253/1, cc3=charge_controller@192.168.3.253:5020/2, rb=relay_box@192.168.2.253/9"
+    # a serial port instead of a gateway is read with Modbus RTU: "cc4=charge_controller@/dev/ttymxc2:19200/1"
+    devices = OrderedDict()
+    if not value:
+        return devices
+
+    for item in str(value).split(','):
+        if item.strip() == '':
+            continue
+        device_id, definition = [part.strip() for part in item.split('=')]
+        device_type, address = [part.strip() for part in definition.split('@')]
+        gateway, unit_id = address.rsplit('/', 1)
+        gateway, _, port = gateway.partition(':')
+        transport = TRANSPORT_RTU if gateway.startswith('/') else TRANSPORT_TCP
+
+        if device_type not in DEVICE_TYPES:
+            raise ValueError('Unknown device type {} for {}, choose one of {}'.format(
+                device_type, device_id, ', '.join(DEVICE_TYPES)))
+        if device_id in devices:
+            raise ValueError('Duplicated device id {}'.format(device_id))
+
+        if port:
+            port = int(port)
+        else:
+            port = default_port if transport == TRANSPORT_TCP else None
+
+        devices[device_id] = Device(device_id, device_type, transport, gateway, port, int(unit_id, 0))
+
+    return devices
+
+
+def check_serial_lines(devices, default_baudrate):
+    # the devices of a serial port share its line settings: a different baud rate on one of them is an error
+    baudrates = OrderedDict()
+    for device in devices.values():
+        if device.transport == TRANSPORT_RTU:
+            baudrates.setdefault(device.address, OrderedDict())[device.id] = device.port or default_baudrate
+    for address, rates in baudrates.items():
+        if len(set(rates.values())) > 1:
+            raise ValueError('Devices on {} declare different baud rates ({}), one serial line has one setting'.format(
+                address, ', '.join('{}={}'.format(device_id, rate) for device_id, rate in rates.items())))
+
+
+def format_devices(devices):
+    return ', '.join('{}={}@{}{}/{}'.format(device.id, device.type, device.address,
+                                            '' if device.port is None else ':{}'.format(device.port), device.unit_id)
+                     for device in devices.values())
+
+
+def legacy_devices(configurations):
+    # cc1, cc2 and rb behind MODBUS_IP, a unit of 0 disables the device
+    devices = OrderedDict()
+    for device_id, device_type, key in (('cc1', DEVICE_CHARGE_CONTROLLER, 'CHARGE_CONTROLLER_1_MODBUS_UNIT'),
+                                        ('cc2', DEVICE_CHARGE_CONTROLLER, 'CHARGE_CONTROLLER_2_MODBUS_UNIT'),
+                                        ('rb', DEVICE_RELAY_BOX, 'RELAY_BOX_MODBUS_UNIT')):
+        if configurations[key]:
+            devices[device_id] = Device(device_id, device_type, TRANSPORT_TCP, configurations['MODBUS_IP'],
+                                        configurations['MODBUS_PORT'], int(configurations[key]))
+    return devices
@@ -1,13 +1,15 @@
-from datetime import datetime
+import time
 
 import smbus2
+from smbus2 import i2c_msg
 import struct
 import logging
 import random
 
 # I2C addressed of Arduinos MCU connected
 from ..fds.FdsCommon import FdsCommon as fds
-from ..sensor.reader import Reader, SensorValue
+from ..sensor.reader import Reader, SensorValue, get_timestamp
+from ..utils.metrics import metrics
 
 TEMP_1_REGISTER = 0x10  # DS18D20 ( onewire, D5 )
 TEMP_2_REGISTER = 0x14  # DS18D20 ( onewire, D5 )
@@ -56,31 +58,107 @@ ARDUINO_DOUBLE_SIZE = 8
 
 DECIMALS = 1
 
+# I2C transfer modes
+I2C_MODE_BYTE = 'byte'  # one read_byte_data per register byte
+I2C_MODE_BLOCK = 'block'  # read_i2c_block_data, 32 bytes per SMBus transfer
+I2C_MODE_RDWR = 'rdwr'  # one combined write/read i2c_rdwr message per span
+
+SMBUS_BLOCK_MAX = 32
+
+DEFAULT_BUDGET = 0.5  # seconds per read, the channels left are reported missing
+DEFAULT_RETRIES = 1  # of a failed register before the adapter is reopened
+
+# label, first register, struct format ( little endian as on the AVR )
+FIELD_FLOAT = '<f'
+FIELD_INT = '<h'
+FIELD_BOOLEAN = 'B'
+
+ALL_FIELDS = [
+    (TEMP_1_LABEL, TEMP_1_REGISTER, FIELD_FLOAT),
+    (TEMP_2_LABEL, TEMP_2_REGISTER, FIELD_FLOAT),
+    (TEMP_3_LABEL, TEMP_3_REGISTER, FIELD_FLOAT),
+    (PRESSURE_IN_LABEL, PRESSURE_IN_REGISTER, FIELD_FLOAT),
+    # out/middle are swapped in the legacy reader, keep the published values unchanged
+    (PRESSURE_OUT_LABEL, PRESSURE_MIDDLE_REGISTER, FIELD_FLOAT),
+    (PRESSURE_MIDDLE_LABEL, PRESSURE_OUT_REGISTER, FIELD_FLOAT),
+    (FLUX_IN_LABEL, FLUX_IN_REGISTER, FIELD_INT),
+    (FLUX_OUT_LABEL, FLUX_OUT_REGISTER, FIELD_INT),
+    (CC_CURRENT_LABEL, CC_CURRENT_REGISTER, FIELD_FLOAT),
+    (AC1_CURRENT_LABEL, AC1_CURRENT_REGISTER, FIELD_FLOAT),
+    (AC2_CURRENT_LABEL, AC2_CURRENT_REGISTER, FIELD_FLOAT),
+    (DHT11_AIR_LABEL, DHT11_AIR_REGISTER, FIELD_FLOAT),
+    (DHT11_HUMIDITY_LABEL, DHT11_HUMIDITY_REGISTER, FIELD_FLOAT),
+    (FLOODING_STATUS_LABEL, FLOODING_STATUS_REGISTER, FIELD_BOOLEAN),
+    (WATER_LEVEL_LABEL, WATER_LEVEL_REGISTER, FIELD_INT),
+]
+
+# the fields published by get_all_data
+DEFAULT_LABELS = [
+    TEMP_1_LABEL,
+    TEMP_2_LABEL,
+    PRESSURE_IN_LABEL,
+    PRESSURE_OUT_LABEL,
+    PRESSURE_MIDDLE_LABEL,
+    FLUX_IN_LABEL,
+    FLUX_OUT_LABEL,
+    CC_CURRENT_LABEL,
+    AC1_CURRENT_LABEL,
+    AC2_CURRENT_LABEL
+]
+
+# contiguous register spans of the Arduino map, [start, end)
+BLOCK_SPANS = [
+    (0x10, 0x4C),
+    (0x50, 0x58),
+    (0x60, 0x61),
+    (0x70, 0x72),
+]
+
 
 class McuArduinoReader(Reader):
 
-    def __init__(self, id, i2c_bus=DEFAULT_I2C_BUS, i2c_address=DEFAULT_I2C_ADDR, produce_dummy_data=False):
+    def __init__(self, id, i2c_bus=DEFAULT_I2C_BUS, i2c_address=DEFAULT_I2C_ADDR, produce_dummy_data=False,
+                 i2c_mode=I2C_MODE_BYTE, labels=None, bus=None, budget=DEFAULT_BUDGET, retries=DEFAULT_RETRIES):
 
         self.id = id
         self.produce_dummy_data = produce_dummy_data
         self.bus = None
         self.i2c_bus = i2c_bus
         self.i2c_address = i2c_address
-
-        if self.produce_dummy_data == False:
+        self.i2c_mode = i2c_mode
+        self.labels = labels or DEFAULT_LABELS
+        self.fields = [field for field in ALL_FIELDS if field[0] in self.labels]
+        self.transactions = 0
+        self.budget = budget
+        self.retries = retries
+        # labels not read on the last cycle
+        self.missing = []
+        self.recovered = False
+        self.recoveries = 0
+
+        # only a bus opened here is reopened by recover_bus
+        self.owns_bus = bus is None and self.produce_dummy_data == False
+        if bus is not None:
+            # an already opened SMBus-compatible object
+            self.bus = bus
+        elif self.produce_dummy_data == False:
             self.bus = smbus2.SMBus(self.i2c_bus)
 
     def is_connected(self, arduino_address):
         # print("Arduino ", str(arduinoAddress), " isConnected")
         return True
 
+    def read_byte_data(self, dev, reg):
+        self.transactions += 1
+        return self.bus.read_byte_data(dev, reg)
+
     def read4_bytes_float(self, dev, start_reg, n_bytes=None):
         value = [0, 0, 0, 0]
 
-        value[0] = self.bus.read_byte_data(dev, start_reg)
-        value[1] = self.bus.read_byte_data(dev, start_reg + 1)
-        value[2] = self.bus.read_byte_data(dev, start_reg + 2)
-        value[3] = self.bus.read_byte_data(dev, start_reg + 3)
+        value[0] = self.read_byte_data(dev, start_reg)
+        value[1] = self.read_byte_data(dev, start_reg + 1)
+        value[2] = self.read_byte_data(dev, start_reg + 2)
+        value[3] = self.read_byte_data(dev, start_reg + 3)
 
         b = struct.pack('4B', *value)
         value = struct.unpack('<f', b)
@@ -90,8 +168,8 @@ class McuArduinoReader(Reader):
     def read2_bytes_integer(self, dev, start_reg, n_bytes=None):
         value = [0, 0]
 
-        value[0] = self.bus.read_byte_data(dev, start_reg)
-        value[1] = self.bus.read_byte_data(dev, start_reg + 1)
+        value[0] = self.read_byte_data(dev, start_reg)
+        value[1] = self.read_byte_data(dev, start_reg + 1)
 
         b = struct.pack('BB', value[0], value[1])
         value = struct.unpack('<h', b)
@@ -99,16 +177,114 @@ class McuArduinoReader(Reader):
         return value[0]
 
     def read1_byte_boolean(self, dev, start_reg):
-        value = self.bus.read_byte_data(dev, start_reg)
+        value = self.read_byte_data(dev, start_reg)
+        return value
+
+    def read_block(self, dev, start_reg, length):
+        if self.i2c_mode == I2C_MODE_RDWR:
+            # register pointer write and repeated-start read in a single transfer
+            write = i2c_msg.write(dev, [start_reg])
+            read = i2c_msg.read(dev, length)
+            self.transactions += 1
+            self.bus.i2c_rdwr(write, read)
+            return bytes(read)
+
+        buffer = bytearray()
+        while len(buffer) < length:
+            chunk = min(SMBUS_BLOCK_MAX, length - len(buffer))
+            self.transactions += 1
+            buffer.extend(self.bus.read_i2c_block_data(dev, start_reg + len(buffer), chunk))
+        return bytes(buffer)
+
+    def decode_field(self, buffer, offset, fmt):
+        value = struct.unpack_from(fmt, buffer, offset)[0]
+        if fmt == FIELD_FLOAT:
+            return round(value, DECIMALS)
         return value
 
+    def read_field(self, dev, register, fmt):
+        if fmt == FIELD_FLOAT:
+            return self.read4_bytes_float(dev, register, ARDUINO_FLOAT_SIZE)
+        elif fmt == FIELD_INT:
+            return self.read2_bytes_integer(dev, register, ARDUINO_INT_SIZE)
+        return self.read1_byte_boolean(dev, register)
+
+    def recover_bus(self):
+        # reopening the adapter drops a transfer left half done, the i2c driver clocks SCL to free a stuck slave
+        self.recovered = True
+        self.recoveries += 1
+        metrics.increment('{}/i2c_recoveries'.format(self.id))
+        if not self.owns_bus:
+            return
+        try:
+            self.bus.close()
+        except Exception as e:
+            logging.warning('MCU: closing i2c-{} failed: {}'.format(self.i2c_bus, e))
+        self.bus = smbus2.SMBus(self.i2c_bus)
+
+    def attempt(self, read, deadline):
+        # the same transfer up to retries times more, then once after reopening the adapter (once per cycle)
+        attempts = 0
+        while True:
+            try:
+                return read()
+            except Exception:
+                if self.is_expired(deadline):
+                    raise
+                if attempts < self.retries:
+                    attempts += 1
+                elif not self.recovered:
+                    self.recover_bus()
+                else:
+                    raise
+
+    def is_expired(self, deadline):
+        return deadline is not None and time.monotonic() >= deadline
+
+    def read_fields(self, fields, data, deadline):
+        for label, register, fmt in fields:
+            if self.is_expired(deadline):
+                return
+            try:
+                data[label] = self.attempt(lambda: self.read_field(self.i2c_address, register, fmt), deadline)
+            except Exception as e:
+                logging.warning('MCU: {} not read: {}'.format(label, e))
+
+    def read_fields_block(self, data, deadline=None):
+        for span_start, span_end in BLOCK_SPANS:
+            fields = [field for field in self.fields if span_start <= field[1] < span_end]
+            if not fields or self.is_expired(deadline):
+                continue
+
+            # fetch from the first to the last byte actually needed in the span
+            first = min(register for _, register, _ in fields)
+            last = max(register + struct.calcsize(fmt) for _, register, fmt in fields)
+
+            try:
+                buffer = self.read_block(self.i2c_address, first, last - first)
+                for label, register, fmt in fields:
+                    data[label] = self.decode_field(buffer, register - first, fmt)
+            except Exception as e:
+                logging.warning('MCU: block read 0x{:02X}-0x{:02X} failed, reading per register: {}'.format(
+                    first, last - 1, e))
+                self.read_fields(fields, data, deadline)
+
+    def get_bus_id(self):
+        return 'i2c-{}'.format(self.i2c_bus)
+
     def generate_dummy(self, values, data):
         for val in values:
             data[val] = round(random.uniform(0, 255), DECIMALS)
 
-    def read(self) -> SensorValue:
-        data = self.get_all_data()
-        return SensorValue(self.id, data, int(datetime.now().timestamp()))
+    def read(self, groups=None) -> SensorValue:
+        self.transactions = 0
+        timestamp = get_timestamp()
+        with metrics.timer('{}/read'.format(self.id)):
+            data = self.get_all_data()
+        metrics.set_gauge('{}/i2c_transactions'.format(self.id), self.transactions)
+        print('MCU: {} I2C transactions ({}){}'.format(
+            self.transactions, self.i2c_mode, ' missing {}'.format(', '.join(self.missing)) if self.missing else ''))
+        return SensorValue(self.id, data, timestamp, list(self.missing) or None)
 
     # External MCU
     def get_temperature1(self):
@@ -212,21 +388,21 @@ class McuArduinoReader(Reader):
                 AC2_CURRENT_LABEL
             ], data)
         else:
-            try:
-                data[TEMP_1_LABEL] = self.get_temperature1()
-                data[TEMP_2_LABEL] = self.get_temperature2()
-                data[PRESSURE_IN_LABEL] = self.get_pressure_in()
-                data[PRESSURE_OUT_LABEL] = self.get_pressure_middle()
-                data[PRESSURE_MIDDLE_LABEL] = self.get_pressure_out()
-                data[FLUX_IN_LABEL] = self.get_water_flux_in()
-                data[FLUX_OUT_LABEL] = self.get_water_flux_out()
-                data[CC_CURRENT_LABEL] = self.get_cc_current()
-                data[AC1_CURRENT_LABEL] = self.get_ac_current(1)
-                data[AC2_CURRENT_LABEL] = self.get_ac_current(2)
-            except Exception as e:
-                logging.error('Charge Controller: unpredicted exception')
-                print(e)
-                raise e
+            # within the budget, a failed channel is retried on its own and does not cost the others
+            deadline = time.monotonic() + self.budget if self.budget else None
+            self.recovered = False
+            if self.i2c_mode != I2C_MODE_BYTE:
+                self.read_fields_block(data, deadline)
+            else:
+                self.read_fields(self.fields, data, deadline)
+
+            self.missing = [label for label, _, _ in self.fields if label not in data]
+            if len(self.missing) == len(self.fields):
+                raise IOError('MCU: no channel read on i2c-{} 0x{:02X}'.format(self.i2c_bus, self.i2c_address))
+            # published with the reading as its missing labels, the values only hold the channels read
+            metrics.set_gauge('{}/missing_channels'.format(self.id), len(self.missing))
+            if self.missing:
+                metrics.increment('{}/missing'.format(self.id), len(self.missing))
 
         return data
 
@@ -0,0 +1,123 @@
+import logging
+import select
+import threading
+from contextlib import contextmanager
+
+from pymodbus.client.sync import ModbusTcpClient as ModbusClient
+
+DEFAULT_MODBUS_PORT = 502
+
+
+# One persistent socket towards a Modbus TCP gateway.
+# The lock serialises the readers sharing the gateway, so a request/response
+# pair is never interleaved with another unit's transaction.
+class PooledConnection:
+
+    def __init__(self, ip_address, port=DEFAULT_MODBUS_PORT):
+        self.ip_address = ip_address
+        self.port = port
+        self.client = None
+        self.lock = threading.RLock()
+
+        self.connects = 0
+        self.reuses = 0
+        self.reconnects = 0
+        self.failures = 0
+
+    def is_healthy(self):
+        if self.client is None or not self.client.is_socket_open():
+            return False
+
+        sock = self.client.socket
+        try:
+            # a readable idle socket is either closed by the peer or carries stale bytes (a late response
+            # to a timed out request), either way the next transaction would be misread: reconnect
+            readable, _, _ = select.select([sock], [], [], 0)
+            if readable:
+                return False
+        except (OSError, ValueError):
+            return False
+
+        return True
+
+    def open(self):
+        if self.is_healthy():
+            self.reuses += 1
+            return self.client
+
+        if self.client is not None:
+            self.reconnects += 1
+            self.close()
+
+        client = ModbusClient(self.ip_address, self.port)
+        if not client.connect():
+            self.failures += 1
+            raise ConnectionError('Unable to connect to Modbus gateway {}:{}'.format(self.ip_address, self.port))
+
+        self.connects += 1
+        self.client = client
+        return self.client
+
+    def close(self):
+        try:
+            if self.client is not None:
+                self.client.close()
+        except Exception as e:
+            logging.error('Error in Modbus Disconnect: ' + str(e))
+        finally:
+            self.client = None
+
+    def stats(self):
+        return {
+            'connects': self.connects,
+            'reuses': self.reuses,
+            'reconnects': self.reconnects,
+            'failures': self.failures
+        }
+
+
+class ModbusConnectionPool:
+
+    def __init__(self):
+        self.connections = dict()
+        self.lock = threading.Lock()
+
+    def get(self, ip_address, port=DEFAULT_MODBUS_PORT):
+        key = (ip_address, int(port))
+        with self.lock:
+            if key not in self.connections:
+                self.connections[key] = PooledConnection(ip_address, int(port))
+            return self.connections[key]
+
+    @contextmanager
+    def connection(self, ip_address, port=DEFAULT_MODBUS_PORT):
+        pooled = self.get(ip_address, port)
+        with pooled.lock:
+            client = pooled.open()
+            try:
+                yield client
+            except Exception:
+                # the socket may be out of sync after a failed transaction: reconnect on next use
+                pooled.close()
+                raise
+
+    def get_bus_id(self, ip_address, port=DEFAULT_MODBUS_PORT, unit_id=None):
+        # units behind one gateway share its RS485 line
+        return 'tcp://{}:{}'.format(ip_address, port)
+
+    def close_all(self):
+        with self.lock:
+            for pooled in self.connections.values():
+                with pooled.lock:
+                    pooled.close()
+
+    def stats(self):
+        with self.lock:
+            return {'{}:{}'.format(ip, port): pooled.stats() for (ip, port), pooled in self.connections.items()}
+
+    def __str__(self):
+        return 'MODBUS_POOL: {}'.format(self.stats())
+
+
+# shared by every Modbus reader of the process
+default_pool = ModbusConnectionPool()
@@ -1,247 +1,274 @@
 import logging
 import random
-from datetime import datetime
+import time
+from collections import namedtuple
+from datetime import date
 
-from pymodbus.client.sync import ModbusTcpClient as ModbusClient
 from pymodbus.exceptions import ModbusIOException
 
 from ..fds.FdsCommon import FdsCommon as fds
-from ..sensor.reader import SensorValue, Reader
+from ..sensor import read_planner
+from ..sensor.modbus_pool import DEFAULT_MODBUS_PORT, default_pool
+from ..sensor.reader import SensorValue, Reader, get_timestamp
+from ..sensor.register_map import CHARGE_CONTROLLER_MAP, RELAY_BOX_MAP
+from ..utils.metrics import metrics
 
 DEFAULT_CHARGE_CONTROLLER_UNIT = 0x01
 DEFAULT_RELAY_BOX_UNIT = 0x09
-DEFAULT_MODBUS_PORT = 502
 
 DEFAULT_MODBUS_IP = '192.168.2.253'
 DEFAULT_C23_RS485 = '/dev/ttymxc2'  # mxc3 on schematics
 
 DECIMALS = 1
 
+DEFAULT_CACHE_TTL = 3600
+
+# name, register addresses, seconds before a new read (None for the reader TTL),
+# renewed after midnight, address of the register whose change invalidates them
+CacheRule = namedtuple('CacheRule', ['name', 'addresses', 'ttl', 'daily', 'watch'])
+
+
+# Keeps the registers that only change on reboot or once a day,
+# so that the polls of a group fetch its live values only
+class RegisterCache:
+
+    def __init__(self, rules, ttl=DEFAULT_CACHE_TTL):
+        self.rules = rules
+        self.ttl = ttl
+        self.entries = dict()  # rule name -> [{address: value}, read time, read date]
+        self.watched = dict()  # rule name -> last value of the watched register
+
+        self.hits = 0
+        self.misses = 0
+
+    def is_valid(self, rule, entry, now, today):
+        ttl = self.ttl if rule.ttl is None else rule.ttl
+        if ttl and now - entry[1] >= ttl:
+            return False
+        return not rule.daily or entry[2] == today
+
+    def lookup(self, registers, now=None, today=None):
+        # cached values among the registers, one hit or miss per rule involved
+        now = time.monotonic() if now is None else now
+        today = date.today() if today is None else today
+        cached = dict()
+
+        for rule in self.rules:
+            if not any(address in registers for address in rule.addresses):
+                continue
+            entry = self.entries.get(rule.name)
+            if entry is not None and self.is_valid(rule, entry, now, today):
+                self.hits += 1
+                cached.update(entry[0])
+            else:
+                self.misses += 1
+                self.entries.pop(rule.name, None)
+
+        return cached
+
+    def store(self, registers, fetched, now=None, today=None):
+        # registers are indexed by address, fetched are the addresses just read from the device
+        now = time.monotonic() if now is None else now
+        today = date.today() if today is None else today
+        fetched = set(fetched)
+
+        for rule in self.rules:
+            complete = all(address in fetched for address in rule.addresses)
+
+            if rule.watch is not None and rule.watch in fetched:
+                previous = self.watched.get(rule.name)
+                self.watched[rule.name] = registers[rule.watch]
+                if previous is not None and previous != registers[rule.watch] and not complete:
+                    self.entries.pop(rule.name, None)
+
+            if complete:
+                self.entries[rule.name] = [{address: registers[address] for address in rule.addresses}, now, today]
+
+    def clear(self):
+        self.entries.clear()
+        self.watched.clear()
 
-# Modbus reader
-class ModbusChargeControllerReader(Reader):
+    def __str__(self):
+        return 'hits={} misses={} cached={}'.format(self.hits, self.misses, ','.join(self.entries))
+
+
+# Modbus reader: the register groups of REGISTER_MAP read through the pooled gateway socket,
+# with the registers of CACHED_REGISTERS kept between the polls
+class ModbusReader(Reader):
+    DEVICE_TYPE = None
+    DEVICE_NAME = 'Modbus device'
+    DEFAULT_UNIT = None
+
+    # register groups polled at their own rate
+    REGISTER_MAP = None
+    MAX_REGISTERS_PER_REQUEST = read_planner.MAX_REGISTERS_PER_REQUEST
+    CACHED_REGISTERS = ()
 
     def __init__(self,
                  id,
                  ip_address=DEFAULT_MODBUS_IP,
-                 unit_id=DEFAULT_CHARGE_CONTROLLER_UNIT,
-                 produce_dummy_data=False):
+                 unit_id=None,
+                 produce_dummy_data=False,
+                 port=DEFAULT_MODBUS_PORT,
+                 pool=None,
+                 max_gap=read_planner.DEFAULT_MAX_GAP,
+                 cache_ttl=DEFAULT_CACHE_TTL):
 
         self.id = id
         self.ip_address = ip_address
-        self.unit_id = unit_id
+        self.port = port
+        self.unit_id = self.DEFAULT_UNIT if unit_id is None else unit_id
         self.produce_dummy_data = produce_dummy_data
-        self.client = None
+        self.pool = pool if pool is not None else default_pool
+        self.max_gap = max_gap
+        self.read_plans = dict()
+        self.last_plan = None
+        # a TTL of 0 disables the cache
+        self.cache = RegisterCache(self.CACHED_REGISTERS if cache_ttl else (), cache_ttl)
 
     def connect(self):
-        try:
-            print("Connect modbus...")
-            self.client = ModbusClient(self.ip_address, DEFAULT_MODBUS_PORT)
-            self.client.connect()
-        except Exception as e:
-            err = 'Error in Modbus Connect: ' + str(e)
-            self.client = None
-            raise e
+        # opens (or reuses) the pooled socket towards the gateway
+        with self.pool.connection(self.ip_address, self.port):
+            pass
 
     def generate_dummy(self, values, data):
         for val in values:
             data[val] = round(random.uniform(0, 60), DECIMALS)
 
-    def get_charge_controller_data(self):
-        data = {'type': 'charge_controller'}
+    def generate_dummy_data(self, groups, data):
+        self.generate_dummy([label for group in groups for label in self.REGISTER_MAP.get_labels(group)], data)
 
-        if self.produce_dummy_data == True:
-            self.generate_dummy([
-                fds.LABEL_CC_BATTS_V,
-                fds.LABEL_CC_BATT_SENSED_V,
-                fds.LABEL_CC_BATTS_I,
-                fds.LABEL_CC_ARRAY_V,
-                fds.LABEL_CC_ARRAY_I,
-                fds.LABEL_CC_STATENUM,
-                fds.LABEL_CC_HS_TEMP,
-                fds.LABEL_CC_RTS_TEMP,
-                fds.LABEL_CC_OUT_POWER,
-                fds.LABEL_CC_IN_POWER,
-                fds.LABEL_CC_MINVB_DAILY,
-                fds.LABEL_CC_MAXVB_DAILY,
-                fds.LABEL_CC_MINTB_DAILY,
-                fds.LABEL_CC_MAXTB_DAILY,
-            ], data)
+    def get_data(self, groups=None):
+        data = {'type': self.DEVICE_TYPE}
+        groups = groups or self.get_groups()
 
-            data[fds.LABEL_CC_DIPSWITCHES] = bin(0x02)[::-1][:-2].zfill(8)
+        if self.produce_dummy_data == True:
+            self.generate_dummy_data(groups, data)
         else:
             try:
-                # print('sono entrato dio merdoso!')
-                self.connect()
-                # read registers. Start at 0 for convenience
-                rr = self.client.read_holding_registers(0, 80, unit=self.unit_id)
-
-                # for all indexes, subtract 1 from what's in the manual
-                V_PU_hi = rr.registers[0]
-                V_PU_lo = rr.registers[1]
-                I_PU_hi = rr.registers[2]
-                I_PU_lo = rr.registers[3]
-
-                V_PU = float(V_PU_hi) + float(V_PU_lo)
-                I_PU = float(I_PU_hi) + float(I_PU_lo)
-
-                v_scale = V_PU * 2 ** (-15)
-                i_scale = I_PU * 2 ** (-15)
-                p_scale = V_PU * I_PU * 2 ** (-17)
-
-                # battery sense voltage, filtered
-                data[fds.LABEL_CC_BATTS_V] = round(rr.registers[24] * v_scale, DECIMALS)
-                data[fds.LABEL_CC_BATT_SENSED_V] = round(rr.registers[26] * v_scale, DECIMALS)
-                data[fds.LABEL_CC_BATTS_I] = round(rr.registers[28] * i_scale, DECIMALS)
-                data[fds.LABEL_CC_ARRAY_V] = round(rr.registers[27] * v_scale, DECIMALS)
-                data[fds.LABEL_CC_ARRAY_I] = round(rr.registers[29] * i_scale, DECIMALS)
-                data[fds.LABEL_CC_STATENUM] = round(rr.registers[50], DECIMALS)
-                data[fds.LABEL_CC_HS_TEMP] = round(rr.registers[35], DECIMALS)
-                data[fds.LABEL_CC_RTS_TEMP] = round(rr.registers[36], DECIMALS)
-                data[fds.LABEL_CC_OUT_POWER] = round(rr.registers[58] * p_scale, DECIMALS)
-                data[fds.LABEL_CC_IN_POWER] = round(rr.registers[59] * p_scale, DECIMALS)
-                data[fds.LABEL_CC_MINVB_DAILY] = round(rr.registers[64] * v_scale, DECIMALS)
-                data[fds.LABEL_CC_MAXVB_DAILY] = round(rr.registers[65] * v_scale, DECIMALS)
-                data[fds.LABEL_CC_MINTB_DAILY] = round(rr.registers[71], DECIMALS)
-                data[fds.LABEL_CC_MAXTB_DAILY] = round(rr.registers[72], DECIMALS)
-                data[fds.LABEL_CC_DIPSWITCHES] = bin(rr.registers[48])[::-1][:-2].zfill(8)
-                # led_state            = rr.registers
+                registers, plan = self.prepare_read(groups)
+                connect_start = time.perf_counter()
+                with self.pool.connection(self.ip_address, self.port) as client:
+                    metrics.observe('{}/connect'.format(self.id), (time.perf_counter() - connect_start) * 1000.0)
+                    with metrics.timer('{}/read'.format(self.id)):
+                        read_planner.read_registers(client, plan, self.unit_id, registers)
+                self.cache.store(registers, plan.registers)
+
+                with metrics.timer('{}/decode'.format(self.id)):
+                    self.decode_registers(registers, data, groups)
             except ModbusIOException as e:
-                logging.error('Charge Controller: modbusIOException' + str(e))
+                logging.error('{}: modbusIOException {}'.format(self.DEVICE_NAME, e))
+                # the device may have rebooted
+                self.cache.clear()
                 raise e
             except Exception as e:
-                logging.error('Charge Controller: unpredicted exception' + str(e))
+                logging.error('{}: unpredicted exception: {}'.format(self.DEVICE_NAME, e))
+                self.cache.clear()
                 raise e
-            finally:
-                self.disconnect()
 
         return data
 
-    def read(self) -> SensorValue:
-        data = self.get_charge_controller_data()
-        return SensorValue(self.id, data, int(datetime.now().timestamp()))
+    def decode_registers(self, registers, data, groups=None):
+        return self.REGISTER_MAP.decode(registers, data, groups)
 
-    def disconnect(self):
-        try:
-            self.client.close()
-        except Exception as e:
-            err = 'Error in Modbus Disconnect: ' + str(e)
-            raise e
-        finally:
-            self.client = None
+    def prepare_read(self, groups):
+        # address-indexed registers holding the cached values, and the plan reading the others
+        needed = self.REGISTER_MAP.get_registers(groups)
+        cached = self.cache.lookup(needed)
 
-    def __str__(self):
-        return 'MODBUS_READER ID: {}, IP: {}'.format(self.id, self.ip_address)
+        registers = [0] * (needed[-1] + 1)
+        for address, value in cached.items():
+            registers[address] = value
 
+        self.last_plan = self.get_read_plan(needed, [address for address in needed if address not in cached])
+        return registers, self.last_plan
 
-# Modbus reader
-class ModbusRelayBoxReader(Reader):
+    def get_read_plan(self, needed, fetched):
+        key = (tuple(needed), tuple(fetched))
+        plan = self.read_plans.get(key)
+        if plan is None:
+            plan = self.read_plans[key] = read_planner.ReadPlan(
+                fetched, self.max_gap, self.MAX_REGISTERS_PER_REQUEST, baseline=needed)
+        return plan
 
-    def __init__(self,
-                 id,
-                 ip_address=DEFAULT_MODBUS_IP,
-                 unit_id=DEFAULT_RELAY_BOX_UNIT,
-                 produce_dummy_data=False):
+    def get_groups(self):
+        return self.REGISTER_MAP.get_groups()
 
-        self.id = id
-        self.ip_address = ip_address
-        self.unit_id = unit_id
-        self.produce_dummy_data = produce_dummy_data
-        self.client = None
+    def read(self, groups=None) -> SensorValue:
+        timestamp = get_timestamp()
+        data = self.get_data(groups)
+        return SensorValue(self.id, data, timestamp)
 
-        # self.connect()
+    def get_bus_id(self):
+        return self.pool.get_bus_id(self.ip_address, self.port, self.unit_id)
 
-    def connect(self):
-        try:
-            print("Connect modbus...")
-            self.client = ModbusClient(self.ip_address, DEFAULT_MODBUS_PORT)
-            self.client.connect()
-        except Exception as e:
-            err = 'Error in Modbus Connect: ' + str(e)
-            self.client = None
-            print(err)
+    def disconnect(self):
+        # closes the shared socket: the next read of any reader on the gateway reconnects
+        self.cache.clear()
+        connection = self.pool.get(self.ip_address, self.port)
+        with connection.lock:
+            connection.close()
 
-    def generate_dummy(self, values, data):
-        for val in values:
-            data[val] = round(random.uniform(0, 60), DECIMALS)
+    def __str__(self):
+        return 'MODBUS_READER ID: {}, IP: {}'.format(self.id, self.ip_address)
 
-    def get_relay_box_data(self):
-        data = {'type': 'relay_box'}
 
-        if self.produce_dummy_data == True:
-            self.generate_dummy([
-                fds.LABEL_RB_VB,
-                fds.LABEL_RB_ADC_VCH_1,
-                fds.LABEL_RB_ADC_VCH_2,
-                fds.LABEL_RB_ADC_VCH_3,
-                fds.LABEL_RB_ADC_VCH_4,
-                fds.LABEL_RB_T_MOD,
-                fds.LABEL_RB_GLOBAL_FAULTS,
-                fds.LABEL_RB_GLOBAL_ALARMS,
-                fds.LABEL_RB_HOURMETER_HI,
-                fds.LABEL_RB_HOURMETER_LO,
-                fds.LABEL_RB_CH_FAULTS_1,
-                fds.LABEL_RB_CH_FAULTS_2,
-                fds.LABEL_RB_CH_FAULTS_3,
-                fds.LABEL_RB_CH_FAULTS_4,
-                fds.LABEL_RB_CH_ALARMS_1,
-                fds.LABEL_RB_CH_ALARMS_2,
-                fds.LABEL_RB_CH_ALARMS_3,
-                fds.LABEL_RB_CH_ALARMS_4
-            ], data)
+class ModbusChargeControllerReader(ModbusReader):
+    DEVICE_TYPE = 'charge_controller'
+    DEVICE_NAME = 'Charge Controller'
+    DEFAULT_UNIT = DEFAULT_CHARGE_CONTROLLER_UNIT
 
+    REGISTER_MAP = CHARGE_CONTROLLER_MAP
+
+    # V_PU/I_PU and the dipswitches change on reboot, the daily stats at midnight or with the charge state
+    CACHED_REGISTERS = (
+        CacheRule('scale', (0, 1, 2, 3), None, False, None),
+        CacheRule('dipswitches', (48,), None, False, None),
+        CacheRule('daily', (64, 65, 71, 72), None, True, 50),
+    )
+
+    def generate_dummy_data(self, groups, data):
+        self.generate_dummy([label for group in groups for label in self.REGISTER_MAP.get_labels(group)
+                             if label != fds.LABEL_CC_DIPSWITCHES], data)
+
+        if 'dipswitches' in groups:
             data[fds.LABEL_CC_DIPSWITCHES] = bin(0x02)[::-1][:-2].zfill(8)
 
-        else:
-            try:
-                self.connect()
-                # read registers. Start at 0 for convenience
-                rr = self.client.read_holding_registers(0, 18, unit=self.unit_id)
-
-                v_scale = float(78.421 * 2 ** (-15))
-
-                data[fds.LABEL_RB_VB] = round(rr.registers[0] * v_scale, DECIMALS)
-                data[fds.LABEL_RB_ADC_VCH_1] = round(rr.registers[1] * v_scale, DECIMALS)
-                data[fds.LABEL_RB_ADC_VCH_2] = round(rr.registers[2] * v_scale, DECIMALS)
-                data[fds.LABEL_RB_ADC_VCH_3] = round(rr.registers[3] * v_scale, DECIMALS)
-                data[fds.LABEL_RB_ADC_VCH_4] = round(rr.registers[4] * v_scale, DECIMALS)
-                data[fds.LABEL_RB_T_MOD] = rr.registers[5]
-                data[fds.LABEL_RB_GLOBAL_FAULTS] = rr.registers[6]
-                data[fds.LABEL_RB_GLOBAL_ALARMS] = rr.registers[7]
-                data[fds.LABEL_RB_HOURMETER_HI] = rr.registers[8]
-                data[fds.LABEL_RB_HOURMETER_LO] = rr.registers[9]
-                data[fds.LABEL_RB_CH_FAULTS_1] = rr.registers[10]
-                data[fds.LABEL_RB_CH_FAULTS_2] = rr.registers[11]
-                data[fds.LABEL_RB_CH_FAULTS_3] = rr.registers[12]
-                data[fds.LABEL_RB_CH_FAULTS_4] = rr.registers[13]
-                data[fds.LABEL_RB_CH_ALARMS_1] = rr.registers[14]
-                data[fds.LABEL_RB_CH_ALARMS_2] = rr.registers[15]
-                data[fds.LABEL_RB_CH_ALARMS_3] = rr.registers[16]
-                data[fds.LABEL_RB_CH_ALARMS_4] = rr.registers[17]
-                # led_state            = rr.registers
-            except ModbusIOException as e:
-                logging.error('Relay Box: modbusIOException' + str(e))
-                raise e
-            except Exception as e:
-                logging.error('Relay Box: unpredicted exception: ' + str(e))
-                raise e
-            finally:
-                self.disconnect()
 
-        return data
+class ModbusRelayBoxReader(ModbusReader):
+    DEVICE_TYPE = 'relay_box'
+    DEVICE_NAME = 'Relay Box'
+    DEFAULT_UNIT = DEFAULT_RELAY_BOX_UNIT
 
-    def read(self) -> SensorValue:
-        data = self.get_relay_box_data()
-        return SensorValue(self.id, data, int(datetime.now().timestamp()))
+    REGISTER_MAP = RELAY_BOX_MAP
+    RELAY_COUNT = 8
 
-    def disconnect(self):
-        try:
-            self.client.close()
-        except Exception as e:
-            err = 'Error in Modbus Disconnect: ' + str(e)
-            raise e
-        finally:
-            self.client = None
+    def __init__(self, id, *args, **kwargs):
+        super().__init__(id, *args, **kwargs)
+        self.dummy_relays = [False] * self.RELAY_COUNT
+
+    def write_relays(self, start, values):
+        # writes the coils from start, then reads every relay back in the same pooled session
+        if self.produce_dummy_data == True:
+            self.dummy_relays[start:start + len(values)] = values
+            return list(self.dummy_relays)
+
+        with self.pool.connection(self.ip_address, self.port) as client:
+            if values:
+                rr = client.write_coils(start, values, unit=self.unit_id)
+                if rr.isError():
+                    raise ModbusIOException(str(rr))
+            rr = client.read_coils(0, self.RELAY_COUNT, unit=self.unit_id)
+            if rr.isError():
+                raise ModbusIOException(str(rr))
+        return list(rr.bits[:self.RELAY_COUNT])
+
+    def read_relays(self):
+        return self.write_relays(0, [])
+
+    def generate_dummy_data(self, groups, data):
+        super().generate_dummy_data(groups, data)
+        data[fds.LABEL_CC_DIPSWITCHES] = bin(0x02)[::-1][:-2].zfill(8)
 
     def __str__(self):
         return 'MODBUS RELAY BOX READER ID: {}, IP: {}'.format(self.id, self.ip_address)
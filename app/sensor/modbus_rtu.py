@@ -0,0 +1,241 @@
+import queue
+import struct
+import threading
+import time
+from concurrent.futures import Future
+
+import serial
+from pymodbus.exceptions import ModbusIOException
+from pymodbus.factory import ClientDecoder
+from pymodbus.bit_read_message import ReadCoilsRequest
+from pymodbus.bit_write_message import WriteMultipleCoilsRequest, WriteSingleCoilRequest
+from pymodbus.register_read_message import ReadHoldingRegistersRequest
+from pymodbus.utilities import computeCRC
+
+DEFAULT_RS485_PORT = '/dev/ttymxc2'  # mxc3 on schematics
+DEFAULT_BAUDRATE = 9600
+DEFAULT_PARITY = serial.PARITY_NONE
+DEFAULT_STOPBITS = serial.STOPBITS_ONE
+DEFAULT_RESPONSE_TIMEOUT = 1.0
+
+# functions answering with a byte count, the others (writes) echo 4 bytes
+BYTE_COUNT_FUNCTIONS = (0x01, 0x02, 0x03, 0x04)
+
+
+def get_char_time(baudrate, parity=DEFAULT_PARITY, stopbits=DEFAULT_STOPBITS, bytesize=8):
+    # start bit, data bits, parity bit, stop bits
+    return (1 + bytesize + (0 if parity == serial.PARITY_NONE else 1) + stopbits) / float(baudrate)
+
+
+def get_frame_gap(baudrate, parity=DEFAULT_PARITY, stopbits=DEFAULT_STOPBITS):
+    # 3.5 characters of silence between frames, fixed to 1.75 ms above 19200 baud
+    if baudrate > 19200:
+        return 0.00175
+    return 3.5 * get_char_time(baudrate, parity, stopbits)
+
+
+def build_frame(request):
+    frame = struct.pack('>BB', request.unit_id, request.function_code) + request.encode()
+    return frame + struct.pack('>H', computeCRC(frame))
+
+
+# Owns one RS485 port and serialises the requests of every unit wired to it.
+# Callers queue requests and get futures: the bus thread sends each frame right after the
+# 3.5-character silence following the previous one, without waiting for the callers to come back.
+class RtuBusArbiter:
+
+    def __init__(self, port=DEFAULT_RS485_PORT, baudrate=DEFAULT_BAUDRATE, parity=DEFAULT_PARITY,
+                 stopbits=DEFAULT_STOPBITS, timeout=DEFAULT_RESPONSE_TIMEOUT):
+        self.port = port
+        self.baudrate = baudrate
+        self.parity = parity
+        self.stopbits = stopbits
+        self.timeout = timeout
+        self.frame_gap = get_frame_gap(baudrate, parity, stopbits)
+
+        self.serial = None
+        self.lock = threading.RLock()
+        self.requests = queue.Queue()
+        self.thread = None
+        self.decoder = ClientDecoder()
+        self.last_frame_end = 0.0
+
+        self.transactions = 0
+        self.failures = 0
+        self.queued_max = 0
+
+    def open(self):
+        with self.lock:
+            self.open_port()
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='rtu-{}'.format(self.port), daemon=True)
+                self.thread.start()
+
+    def open_port(self):
+        with self.lock:
+            if self.serial is None:
+                self.serial = serial.Serial(self.port, self.baudrate, parity=self.parity, stopbits=self.stopbits,
+                                            timeout=self.timeout)
+            return self.serial
+
+    def close(self):
+        with self.lock:
+            if self.serial is not None:
+                self.serial.close()
+                self.serial = None
+
+    def stop(self):
+        if self.thread is not None:
+            self.requests.put(None)
+            self.thread.join()
+            self.thread = None
+        self.close()
+
+    def submit(self, request):
+        self.open()
+        future = Future()
+        self.requests.put((request, future))
+        self.queued_max = max(self.queued_max, self.requests.qsize())
+        return future
+
+    def execute(self, request):
+        return self.submit(request).result()
+
+    def read_holding_registers(self, address, count=1, unit=0):
+        return self.execute(ReadHoldingRegistersRequest(address, count, unit=unit))
+
+    def read_coils(self, address, count=1, unit=0):
+        return self.execute(ReadCoilsRequest(address, count, unit=unit))
+
+    def write_coil(self, address, value, unit=0):
+        return self.execute(WriteSingleCoilRequest(address, value, unit=unit))
+
+    def write_coils(self, address, values, unit=0):
+        return self.execute(WriteMultipleCoilsRequest(address, values, unit=unit))
+
+    def run(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+            request, future = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(self.transaction(request))
+            except Exception as e:
+                self.failures += 1
+                future.set_exception(e)
+
+    def transaction(self, request):
+        with self.lock:
+            port = self.open_port()
+
+            silence = self.last_frame_end + self.frame_gap - time.perf_counter()
+            if silence > 0:
+                time.sleep(silence)
+
+            try:
+                # leftovers of a timed out response
+                port.reset_input_buffer()
+                port.write(build_frame(request))
+                # returns once the frame is on the wire
+                port.flush()
+                response = self.read_frame(port, request)
+            finally:
+                self.last_frame_end = time.perf_counter()
+
+        self.transactions += 1
+        return response
+
+    def read_frame(self, port, request):
+        header = port.read(2)
+        if len(header) < 2:
+            raise ModbusIOException('No response from unit {} on {}'.format(request.unit_id, self.port))
+
+        unit, function_code = struct.unpack('>BB', header)
+        if function_code & 0x80:
+            body = port.read(3)
+        elif function_code in BYTE_COUNT_FUNCTIONS:
+            byte_count = port.read(1)
+            body = byte_count + port.read(byte_count[0] + 2) if byte_count else b''
+        else:
+            body = port.read(6)
+
+        frame = header + body
+        if len(frame) < 5 or struct.unpack('>H', frame[-2:])[0] != computeCRC(frame[:-2]):
+            raise ModbusIOException('Invalid response from unit {} on {}: {}'.format(
+                request.unit_id, self.port, frame.hex()))
+        if unit != request.unit_id:
+            raise ModbusIOException('Response from unit {} instead of {} on {}'.format(
+                unit, request.unit_id, self.port))
+
+        response = self.decoder.decode(frame[1:-2])
+        response.unit_id = unit
+        return response
+
+    def stats(self):
+        return {
+            'transactions': self.transactions,
+            'failures': self.failures,
+            'queued_max': self.queued_max
+        }
+
+
+# One arbiter per serial port, with the interface of the Modbus TCP connection pool
+class RtuBusPool:
+
+    def __init__(self, baudrate=DEFAULT_BAUDRATE, parity=DEFAULT_PARITY, stopbits=DEFAULT_STOPBITS,
+                 timeout=DEFAULT_RESPONSE_TIMEOUT):
+        self.baudrate = baudrate
+        self.parity = parity
+        self.stopbits = stopbits
+        self.timeout = timeout
+        self.buses = dict()
+        self.lock = threading.Lock()
+
+    def get(self, port, baudrate=None):
+        with self.lock:
+            bus = self.buses.get(port)
+            if bus is not None and bus.baudrate != (baudrate or self.baudrate):
+                # the devices of a port agree on its baud rate (see devices.check_serial_lines):
+                # a different one comes from a configuration change, the port is reopened with it
+                bus.stop()
+                bus = None
+            if bus is None:
+                bus = self.buses[port] = RtuBusArbiter(port, baudrate or self.baudrate, self.parity, self.stopbits,
+                                                       self.timeout)
+            return bus
+
+    def connection(self, port, baudrate=None):
+        return RtuConnection(self.get(port, baudrate))
+
+    def get_bus_id(self, port, baudrate=None, unit_id=None):
+        # the arbiter queues the units of a port: readers do not need to be serialised by the caller
+        return 'rtu://{}/{}'.format(port, unit_id)
+
+    def close_all(self):
+        with self.lock:
+            for bus in self.buses.values():
+                bus.stop()
+            self.buses.clear()
+
+    def stats(self):
+        with self.lock:
+            return {port: bus.stats() for port, bus in self.buses.items()}
+
+    def __str__(self):
+        return 'RTU_BUSES: {}'.format(self.stats())
+
+
+class RtuConnection:
+
+    def __init__(self, bus):
+        self.bus = bus
+
+    def __enter__(self):
+        self.bus.open()
+        return self.bus
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
@@ -0,0 +1,181 @@
+import json
+import threading
+
+from json.encoder import encode_basestring_ascii
+
+from . import binary_payload
+from .reader import get_timestamp, get_type_name
+from ..utils import IIoT
+
+PUBLISH_MODE_FIELD = 'field'  # one message per value on /sensors/<client>/<device_type>_<key> (legacy)
+PUBLISH_MODE_DEVICE = 'device'  # one message per device snapshot on /sensors/<client>/devices/<device>
+PUBLISH_MODE_CYCLE = 'cycle'  # one message per polling cycle on /sensors/<client>/devices
+# one packed message per device snapshot on /sensors/<client>/binary/<device>,
+# its schema on /sensors/<client>/schemas/<device>
+PUBLISH_MODE_BINARY = 'binary'
+
+PUBLISH_MODES = (PUBLISH_MODE_FIELD, PUBLISH_MODE_DEVICE, PUBLISH_MODE_CYCLE, PUBLISH_MODE_BINARY)
+
+# labels of the channels missing from a partial read, next to the values of the snapshot
+MISSING_KEY = 'missing'
+
+
+def parse_modes(value):
+    # "field, device" -> ['field', 'device']
+    modes = [mode.strip() for mode in str(value).split(',') if mode.strip() != '']
+    for mode in modes:
+        if mode not in PUBLISH_MODES:
+            raise ValueError('Unsupported publish mode {}. Choose among {}'.format(mode, ', '.join(PUBLISH_MODES)))
+    return modes or [PUBLISH_MODE_FIELD]
+
+
+def compact_dumps(payload):
+    return json.dumps(payload, separators=(',', ':'))
+
+
+def encode_float(value):
+    # json.dumps spells the non finite values NaN and Infinity
+    return float.__repr__(value) if value - value == 0 else json.dumps(value)
+
+
+# same text as json.dumps, without going through the encoder for the usual types
+VALUE_ENCODERS = {int: int.__repr__, float: encode_float, str: encode_basestring_ascii}
+
+
+# Topic and payload template of one field in the field mode, built the first time the field is seen.
+# The payloads are the json.dumps of {"sensor", "value_type", "value", "timestamp"}.
+class FieldPlan:
+    __slots__ = ('topic', 'sensor', 'prefixes')
+
+    def __init__(self, topic, sensor):
+        self.topic = topic
+        self.sensor = sensor
+        # value type -> payload up to the value
+        self.prefixes = dict()
+
+    def get_prefix(self, value_type):
+        prefix = self.prefixes.get(value_type)
+        if prefix is None:
+            prefix = self.prefixes[value_type] = '{{"sensor": {}, "value_type": {}, "value": '.format(
+                encode_basestring_ascii(self.sensor), encode_basestring_ascii(get_type_name(value_type)))
+        return prefix
+
+
+class Publisher:
+
+    def __init__(self, mqtt_client, modes=None, report_by_exception=None,
+                 schema_interval=binary_payload.DEFAULT_SCHEMA_INTERVAL):
+        self.mqtt_client = mqtt_client
+        self.modes = modes or [PUBLISH_MODE_FIELD]
+        self.report_by_exception = report_by_exception
+        self.encoder = binary_payload.BinaryEncoder(schema_interval)
+        # device type -> {key: FieldPlan}, (mode, device) -> topic
+        self.field_plans = dict()
+        self.topics = dict()
+        self.snapshots = list()
+        self.lock = threading.Lock()
+
+    def get_field_topic(self, sensor):
+        return '{}/{}/{}'.format(IIoT.MqttChannels.sensors, self.mqtt_client.client_id, sensor)
+
+    def get_field_plans(self, device_type):
+        plans = self.field_plans.get(device_type)
+        if plans is None:
+            plans = self.field_plans[device_type] = dict()
+        return plans
+
+    def add_field_plan(self, plans, device_type, key):
+        sensor = '{}_{}'.format(device_type, key)
+        plan = plans[key] = FieldPlan(self.get_field_topic(sensor), sensor)
+        return plan
+
+    def publish_fields(self, data):
+        device_type = data.value['type']
+        plans = self.get_field_plans(device_type)
+        suffix = ', "timestamp": {}}}'.format(json.dumps(data.timestamp))
+        publish = self.mqtt_client.publish
+        for key, value in data.value.items():
+            if key == 'type':
+                continue
+            plan = plans.get(key) or self.add_field_plan(plans, device_type, key)
+            value_type = type(value)
+            publish(plan.topic, plan.get_prefix(value_type) + VALUE_ENCODERS.get(value_type, json.dumps)(value) + suffix)
+        if data.missing:
+            # "<device_type>_missing", the labels comma separated
+            plan = plans.get(MISSING_KEY) or self.add_field_plan(plans, device_type, MISSING_KEY)
+            publish(plan.topic, plan.get_prefix(str) + encode_basestring_ascii(','.join(data.missing)) + suffix)
+
+    def get_device_topic(self, device=None):
+        if device is None:
+            return '{}/{}/devices'.format(IIoT.MqttChannels.sensors, self.mqtt_client.client_id)
+        return '{}/{}/devices/{}'.format(IIoT.MqttChannels.sensors, self.mqtt_client.client_id, device)
+
+    def get_binary_topic(self, device):
+        return '{}/{}/binary/{}'.format(IIoT.MqttChannels.sensors, self.mqtt_client.client_id, device)
+
+    def get_schema_topic(self, device):
+        return '{}/{}/schemas/{}'.format(IIoT.MqttChannels.sensors, self.mqtt_client.client_id, device)
+
+    def get_topic(self, mode, device):
+        topic = self.topics.get((mode, device))
+        if topic is None:
+            if mode == PUBLISH_MODE_BINARY:
+                topic = self.get_binary_topic(device)
+            elif mode == PUBLISH_MODE_DEVICE:
+                topic = self.get_device_topic(device)
+            else:
+                topic = self.get_schema_topic(device)
+            self.topics[(mode, device)] = topic
+        return topic
+
+    def get_snapshot(self, data):
+        values = {key: value for key, value in data.value.items() if key != 'type'}
+        snapshot = {
+            'device': data.key,
+            'type': data.value['type'],
+            'timestamp': data.timestamp,
+            'values': values
+        }
+        if data.missing:
+            snapshot[MISSING_KEY] = list(data.missing)
+        return snapshot
+
+    def publish(self, data):
+        if self.report_by_exception is not None:
+            data = self.report_by_exception.filter(data)
+            if data is None:
+                return
+
+        if PUBLISH_MODE_FIELD in self.modes:
+            self.publish_fields(data)
+
+        snapshot = None
+        if PUBLISH_MODE_DEVICE in self.modes:
+            snapshot = self.get_snapshot(data)
+            self.mqtt_client.publish(self.get_topic(PUBLISH_MODE_DEVICE, data.key), compact_dumps(snapshot))
+
+        if PUBLISH_MODE_CYCLE in self.modes:
+            snapshot = snapshot or self.get_snapshot(data)
+            # readers may run on a worker pool
+            with self.lock:
+                self.snapshots.append(snapshot)
+
+        if PUBLISH_MODE_BINARY in self.modes:
+            snapshot = snapshot or self.get_snapshot(data)
+            with self.lock:
+                schema, payload = self.encoder.encode(snapshot)
+            if schema is not None:
+                self.mqtt_client.publish(self.get_topic('schema', data.key), schema.dumps())
+            self.mqtt_client.publish(self.get_topic(PUBLISH_MODE_BINARY, data.key), payload)
+
+    def flush(self):
+        # called once at the end of every polling cycle
+        with self.lock:
+            snapshots = self.snapshots
+            self.snapshots = list()
+
+        if snapshots:
+            self.mqtt_client.publish(self.get_device_topic(), compact_dumps({
+                'timestamp': get_timestamp(),
+                'devices': snapshots
+            }))
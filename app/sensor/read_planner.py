@@ -0,0 +1,63 @@
+from pymodbus.exceptions import ModbusIOException
+from pymodbus.register_read_message import ReadHoldingRegistersRequest
+
+# Plans the Modbus reads of a cycle: the registers to decode are merged into the fewest
+# read_holding_registers requests, reading through gaps of at most max_gap unused registers.
+#
+# Sizes are those of the RTU frames on the RS485 side of the gateway, the slow part of the trip:
+# address, function, start, count, CRC for the request, address, function, byte count, data, CRC for the response.
+REQUEST_BYTES = 8
+RESPONSE_BYTES = 5
+
+# a new request costs about as much as ten registers at 9600 baud, silent intervals included
+DEFAULT_MAX_GAP = 10
+MAX_REGISTERS_PER_REQUEST = 125
+
+
+def plan_reads(registers, max_gap=DEFAULT_MAX_GAP, max_count=MAX_REGISTERS_PER_REQUEST):
+    # register addresses -> [(start, count)]
+    ranges = list()
+    for address in sorted(set(registers)):
+        if ranges:
+            start, count = ranges[-1]
+            if address - (start + count) <= max_gap and address - start < max_count:
+                ranges[-1] = (start, address - start + 1)
+                continue
+        ranges.append((address, 1))
+    return ranges
+
+
+def wire_bytes(ranges):
+    return sum(REQUEST_BYTES + RESPONSE_BYTES + 2 * count for _, count in ranges)
+
+
+class ReadPlan:
+
+    def __init__(self, registers, max_gap=DEFAULT_MAX_GAP, max_count=MAX_REGISTERS_PER_REQUEST, baseline=None):
+        self.registers = sorted(set(registers))
+        self.ranges = plan_reads(self.registers, max_gap, max_count)
+        self.bytes = wire_bytes(self.ranges)
+
+        # compared with one request spanning all the registers decoded, cached ones included
+        baseline = sorted(baseline or self.registers)
+        self.saved = wire_bytes([(baseline[0], baseline[-1] - baseline[0] + 1)]) - self.bytes if baseline else 0
+
+    def __str__(self):
+        return '{} ({} bytes, {} saved)'.format(
+            ' '.join('{}-{}'.format(start, start + count - 1) for start, count in self.ranges), self.bytes, self.saved)
+
+
+def read_registers(client, plan, unit, registers):
+    # fills the address-indexed registers
+    if hasattr(client, 'submit'):
+        # the RTU arbiter queues the whole plan, the next frame goes out as soon as the bus is free
+        futures = [client.submit(ReadHoldingRegistersRequest(start, count, unit=unit)) for start, count in plan.ranges]
+        responses = [future.result() for future in futures]
+    else:
+        responses = [client.read_holding_registers(start, count, unit=unit) for start, count in plan.ranges]
+
+    for (start, count), rr in zip(plan.ranges, responses):
+        if rr.isError():
+            raise ModbusIOException(str(rr))
+        registers[start:start + count] = rr.registers
+    return registers
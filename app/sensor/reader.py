@@ -4,12 +4,31 @@ from datetime import datetime
 from random import randrange
 
 
+# value_type of the legacy field payloads
+TYPE_NAMES = {bool: 'bool', int: 'int', float: 'float', str: 'string'}
+
+
+def get_timestamp():
+    # acquisition time, epoch seconds to the millisecond
+    return round(datetime.now().timestamp(), 3)
+
+
+def get_type_name(value_type):
+    name = TYPE_NAMES.get(value_type)
+    if name is None:
+        name = TYPE_NAMES[value_type] = str(value_type).split("'")[1]
+    return name
+
+
 class SensorValue:
+    __slots__ = ('key', 'value', 'timestamp', 'missing')
 
-    def __init__(self, key, value, timestamp):
+    def __init__(self, key, value, timestamp, missing=None):
         self.key = key
         self.value = value
         self.timestamp = timestamp
+        # labels of the channels a partial read could not get, published with the values
+        self.missing = missing
 
     def format(self):
         return json.dumps({
@@ -33,15 +52,9 @@ class SensorValue:
 
         for key, value in self.value.items():
             if key != 'type':
-
-                value_type = str(type(value)).split("'")[1]
-
-                if value_type == 'str':
-                    value_type = 'string'
-
                 value_obj = {
                     "sensor": '{}_{}'.format(device_type, key),
-                    "value_type": value_type,
+                    "value_type": get_type_name(type(value)),
                     "value": value,
                     "timestamp": self.timestamp
                 }
@@ -53,14 +66,22 @@ class SensorValue:
 class Reader(ABC):
 
     @abstractmethod
-    def read(self) -> SensorValue:
+    def read(self, groups=None) -> SensorValue:
         pass
 
+    def get_groups(self):
+        # register groups that can be polled at their own rate, empty when the reader is read as a whole
+        return []
+
+    def get_bus_id(self):
+        # readers returning the same bus id share a transport and are never polled concurrently
+        return None
+
 
 class DummyReader(Reader):
 
     def __init__(self, key):
         self.key = key
 
-    def read(self) -> SensorValue:
-        return SensorValue(self.key, randrange(10, 100), int(datetime.now().timestamp()))
+    def read(self, groups=None) -> SensorValue:
+        return SensorValue(self.key, randrange(10, 100), get_timestamp())
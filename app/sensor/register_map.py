@@ -0,0 +1,168 @@
+import re
+from collections import OrderedDict, namedtuple
+
+from ..fds.FdsCommon import FdsCommon as fds
+
+TYPE_UINT16 = 'uint16'
+TYPE_INT16 = 'int16'
+TYPE_BITS = 'bits'  # dipswitch string, bit 1 first
+
+DECIMALS = 1
+
+# label, register address, type, name of the scale (None for raw values), decimals of the scaled value
+Field = namedtuple('Field', ['label', 'address', 'type', 'scale', 'decimals'])
+
+SCALE_REGISTER = re.compile(r'r\[(\d+)\]')
+
+
+def field(label, address, type=TYPE_UINT16, scale=None, decimals=DECIMALS):
+    return Field(label, address, type, scale, decimals)
+
+
+def format_bits(value):
+    return bin(value)[::-1][:-2].zfill(8)
+
+
+# Decoder compiled for one combination of register groups: the fields are turned once into the
+# source of a flat function, one assignment per field and one per scale, so that a poll costs
+# the index lookups and arithmetic only, without per-field branching or table walks.
+class RegisterDecoder:
+
+    def __init__(self, fields, scales):
+        lines = ['def decode(r, data):']
+        for name in sorted(set(f.scale for f in fields if f.scale is not None)):
+            lines.append('    scale_{} = {}'.format(name, scales[name]))
+
+        for f in fields:
+            if f.type == TYPE_BITS:
+                value = 'format_bits(r[{}])'.format(f.address)
+            elif f.type == TYPE_INT16:
+                value = '((r[{}] ^ 0x8000) - 0x8000)'.format(f.address)
+            else:
+                value = 'r[{}]'.format(f.address)
+            if f.scale is not None:
+                value = 'round({} * scale_{}, {})'.format(value, f.scale, f.decimals)
+            lines.append('    data[{!r}] = {}'.format(f.label, value))
+
+        lines.append('    return data')
+        self.source = '\n'.join(lines)
+
+        namespace = {'format_bits': format_bits}
+        exec(compile(self.source, '<register decoder>', 'exec'), namespace)
+        self.decode = namespace['decode']
+
+
+# Declarative register map of a Modbus device: fields by register group and scale expressions.
+# A scale expression is evaluated on the registers read, e.g. "(r[0] + r[1]) * 2 ** -15",
+# and the registers it refers to are read together with every group using it.
+class RegisterMap:
+
+    def __init__(self, groups, scales=None):
+        self.groups = OrderedDict(groups)
+        self.scales = dict()
+        self.scale_registers = dict()
+        for name, expression in (scales or dict()).items():
+            # only checks the syntax, the expression is compiled into the decoders
+            compile(expression, '<scale {}>'.format(name), 'eval')
+            self.scales[name] = expression
+            self.scale_registers[name] = [int(address) for address in SCALE_REGISTER.findall(expression)]
+        self.registers = dict()
+        self.decoders = dict()
+
+    def get_groups(self):
+        return list(self.groups.keys())
+
+    def get_labels(self, group):
+        return [f.label for f in self.groups[group]]
+
+    def get_fields(self, groups):
+        return [f for group in groups for f in self.groups[group]]
+
+    def get_registers(self, groups):
+        # every register needed to decode the groups, scale registers included
+        key = tuple(groups)
+        if key not in self.registers:
+            registers = set()
+            for f in self.get_fields(groups):
+                registers.add(f.address)
+                if f.scale is not None:
+                    registers.update(self.scale_registers[f.scale])
+            self.registers[key] = sorted(registers)
+        return self.registers[key]
+
+    def get_span(self, groups):
+        registers = self.get_registers(groups)
+        return registers[0], registers[-1] - registers[0] + 1
+
+    def get_decoder(self, groups):
+        key = tuple(groups)
+        decoder = self.decoders.get(key)
+        if decoder is None:
+            decoder = self.decoders[key] = RegisterDecoder(self.get_fields(groups), self.scales)
+        return decoder
+
+    def decode(self, registers, data, groups=None):
+        return self.get_decoder(groups or self.get_groups()).decode(registers, data)
+
+
+# Morningstar charge controller, for all indexes subtract 1 from what's in the manual
+CHARGE_CONTROLLER_MAP = RegisterMap(
+    groups=[
+        ('live', [
+            # battery sense voltage, filtered
+            field(fds.LABEL_CC_BATTS_V, 24, scale='v'),
+            field(fds.LABEL_CC_BATT_SENSED_V, 26, scale='v'),
+            field(fds.LABEL_CC_BATTS_I, 28, scale='i'),
+            field(fds.LABEL_CC_ARRAY_V, 27, scale='v'),
+            field(fds.LABEL_CC_ARRAY_I, 29, scale='i'),
+            field(fds.LABEL_CC_STATENUM, 50),
+            field(fds.LABEL_CC_HS_TEMP, 35, TYPE_INT16),
+            field(fds.LABEL_CC_RTS_TEMP, 36, TYPE_INT16),
+            field(fds.LABEL_CC_OUT_POWER, 58, scale='p'),
+            field(fds.LABEL_CC_IN_POWER, 59, scale='p'),
+        ]),
+        ('daily', [
+            field(fds.LABEL_CC_MINVB_DAILY, 64, scale='v'),
+            field(fds.LABEL_CC_MAXVB_DAILY, 65, scale='v'),
+            field(fds.LABEL_CC_MINTB_DAILY, 71, TYPE_INT16),
+            field(fds.LABEL_CC_MAXTB_DAILY, 72, TYPE_INT16),
+        ]),
+        ('dipswitches', [
+            field(fds.LABEL_CC_DIPSWITCHES, 48, TYPE_BITS),
+        ]),
+    ],
+    # V_PU = r[0] + r[1], I_PU = r[2] + r[3]
+    scales={
+        'v': '(r[0] + r[1]) * 2 ** -15',
+        'i': '(r[2] + r[3]) * 2 ** -15',
+        'p': '(r[0] + r[1]) * (r[2] + r[3]) * 2 ** -17',
+    })
+
+RELAY_BOX_MAP = RegisterMap(
+    groups=[
+        ('telemetry', [
+            field(fds.LABEL_RB_VB, 0, scale='v'),
+            field(fds.LABEL_RB_ADC_VCH_1, 1, scale='v'),
+            field(fds.LABEL_RB_ADC_VCH_2, 2, scale='v'),
+            field(fds.LABEL_RB_ADC_VCH_3, 3, scale='v'),
+            field(fds.LABEL_RB_ADC_VCH_4, 4, scale='v'),
+            field(fds.LABEL_RB_T_MOD, 5),
+            field(fds.LABEL_RB_HOURMETER_HI, 8),
+            field(fds.LABEL_RB_HOURMETER_LO, 9),
+        ]),
+        ('faults', [
+            field(fds.LABEL_RB_GLOBAL_FAULTS, 6),
+            field(fds.LABEL_RB_GLOBAL_ALARMS, 7),
+            field(fds.LABEL_RB_CH_FAULTS_1, 10),
+            field(fds.LABEL_RB_CH_FAULTS_2, 11),
+            field(fds.LABEL_RB_CH_FAULTS_3, 12),
+            field(fds.LABEL_RB_CH_FAULTS_4, 13),
+            field(fds.LABEL_RB_CH_ALARMS_1, 14),
+            field(fds.LABEL_RB_CH_ALARMS_2, 15),
+            field(fds.LABEL_RB_CH_ALARMS_3, 16),
+            field(fds.LABEL_RB_CH_ALARMS_4, 17),
+        ]),
+    ],
+    scales={
+        'v': '78.421 * 2 ** -15',
+    })
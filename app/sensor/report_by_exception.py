@@ -0,0 +1,106 @@
+import threading
+import time
+
+from ..fds.FdsCommon import FdsCommon as fds
+from .reader import SensorValue
+
+DEFAULT_HEARTBEAT_INTERVAL = 300
+
+# states, bitfields and the halves of 32-bit counters: any change matters, whatever the deadband
+DISCRETE_KEYS = frozenset([
+    fds.LABEL_CC_STATENUM, fds.LABEL_CC_DIPSWITCHES,
+    fds.LABEL_RB_GLOBAL_FAULTS, fds.LABEL_RB_GLOBAL_ALARMS,
+    fds.LABEL_RB_CH_FAULTS_1, fds.LABEL_RB_CH_FAULTS_2, fds.LABEL_RB_CH_FAULTS_3, fds.LABEL_RB_CH_FAULTS_4,
+    fds.LABEL_RB_CH_ALARMS_1, fds.LABEL_RB_CH_ALARMS_2, fds.LABEL_RB_CH_ALARMS_3, fds.LABEL_RB_CH_ALARMS_4,
+    fds.LABEL_RB_HOURMETER_HI, fds.LABEL_RB_HOURMETER_LO,
+    fds.LABEL_MCU_FLOODING_STATUS,
+])
+
+
+def parse_deadbands(value):
+    # "battsV=0.1, charge_controller_battsI=5%, *=0.5" -> {'battsV': (0.1, False), ..., '*': (0.5, False)}
+    deadbands = dict()
+    if not value:
+        return deadbands
+
+    for item in str(value).split(','):
+        if item.strip() == '':
+            continue
+        key, deadband = item.split('=')
+        deadband = deadband.strip()
+        if deadband.endswith('%'):
+            deadbands[key.strip()] = (float(deadband[:-1]), True)
+        else:
+            deadbands[key.strip()] = (float(deadband), False)
+
+    return deadbands
+
+
+# Drops the values that did not move since they were last published.
+# Numbers are compared against an absolute or percentage deadband, looked up by sensor name
+# ("<device_type>_<key>"), then by key, then "*", integers included; strings and the DISCRETE_KEYS
+# (states, bitfields) are sent on any change.
+# A value not sent for a heartbeat interval is sent anyway.
+class ReportByException:
+
+    def __init__(self, deadbands=None, heartbeat_interval=DEFAULT_HEARTBEAT_INTERVAL):
+        self.deadbands = deadbands or dict()
+        self.heartbeat_interval = float(heartbeat_interval)
+        # (device, key) -> [last published value, publish time]
+        self.last_values = dict()
+        self.lock = threading.Lock()
+
+        self.sent = 0
+        self.suppressed = 0
+
+    def get_deadband(self, device_type, key):
+        sensor = '{}_{}'.format(device_type, key)
+        if sensor in self.deadbands:
+            return self.deadbands[sensor]
+        if key in self.deadbands:
+            return self.deadbands[key]
+        return self.deadbands.get('*', (0, False))
+
+    def has_changed(self, device_type, key, last, value):
+        if isinstance(value, bool) or not isinstance(value, (int, float)) \
+                or not isinstance(last, (int, float)) or key in DISCRETE_KEYS:
+            return value != last
+
+        deadband, is_percentage = self.get_deadband(device_type, key)
+        if is_percentage:
+            deadband = abs(last) * deadband / 100.0
+        return abs(value - last) > deadband
+
+    def filter(self, data, now=None):
+        now = time.monotonic() if now is None else now
+        device_type = data.value['type']
+
+        values = {'type': device_type}
+        with self.lock:
+            for key, value in data.value.items():
+                if key == 'type':
+                    continue
+
+                # readers with the same device type (cc1, cc2) are tracked separately
+                name = (data.key, key)
+                last = self.last_values.get(name)
+                if last is None or now - last[1] >= self.heartbeat_interval \
+                        or self.has_changed(device_type, key, last[0], value):
+                    self.last_values[name] = [value, now]
+                    values[key] = value
+                    self.sent += 1
+                else:
+                    self.suppressed += 1
+
+        # a partial read goes out anyway, so that its missing channels are not taken for unchanged ones
+        if len(values) == 1 and not data.missing:
+            return None
+
+        return SensorValue(data.key, values, data.timestamp, data.missing)
+
+    def reset(self):
+        with self.lock:
+            self.last_values.clear()
+
+    def __str__(self):
+        return 'REPORT_BY_EXCEPTION: sent {}, suppressed {}'.format(self.sent, self.suppressed)
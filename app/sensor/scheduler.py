@@ -0,0 +1,152 @@
+import math
+import time
+from collections import OrderedDict
+
+OVERRUN_SKIP = 'skip'  # the missed ticks are dropped, the next read is on the next tick
+OVERRUN_CATCH_UP = 'catch_up'  # the missed ticks are read back to back, up to CATCH_UP_LIMIT of them
+OVERRUN_SHED = 'shed'  # as skip, and the shed readers are left out while the cycle is late
+OVERRUN_POLICIES = (OVERRUN_SKIP, OVERRUN_CATCH_UP, OVERRUN_SHED)
+
+CATCH_UP_LIMIT = 3
+
+
+def parse_intervals(value):
+    # "cc1=5, cc1.daily=3600, rb.faults=2" -> {'cc1': 5.0, 'cc1.daily': 3600.0, 'rb.faults': 2.0}
+    intervals = dict()
+    if not value:
+        return intervals
+
+    for item in str(value).split(','):
+        if item.strip() == '':
+            continue
+        key, interval = item.split('=')
+        intervals[key.strip()] = float(interval)
+
+    return intervals
+
+
+def format_intervals(intervals):
+    return ', '.join('{}={:g}'.format(key, interval) for key, interval in intervals.items())
+
+
+def parse_policy(value):
+    policy = str(value or OVERRUN_SKIP).strip()
+    if policy not in OVERRUN_POLICIES:
+        raise ValueError('Unsupported overrun policy {}. Choose among {}'.format(policy, ', '.join(OVERRUN_POLICIES)))
+    return policy
+
+
+def parse_shed(value):
+    # "mcu, cc1.daily" -> {'mcu', 'cc1.daily'}
+    return set(item.strip() for item in str(value or '').split(',') if item.strip())
+
+
+# Keeps one deadline per reader and per register group.
+# A group interval ("<reader>.<group>") wins over the reader interval ("<reader>"),
+# which wins over the global READING_INTERVAL.
+# Deadlines advance by whole intervals from the previous one, so the period does not drift with the read
+# time; aligned, they fall on the multiples of the interval on the wall clock (:00, :10, :20 for 10 s),
+# so that the sites sharing an interval sample together.
+class PollingScheduler:
+
+    def __init__(self, default_interval, intervals=None, align=False, policy=OVERRUN_SKIP, shed=()):
+        self.default_interval = float(default_interval)
+        self.intervals = intervals or dict()
+        self.align = align
+        self.policy = policy
+        # "<reader>" or "<reader>.<group>" left out on the late cycles with the shed policy
+        self.shed = set(shed)
+        self.tasks = OrderedDict()
+        # late cycles, a cycle missing the ticks of several tasks counts once
+        self.overruns = 0
+        self.shed_reads = 0
+        # how late the last due tasks were popped, in seconds
+        self.lateness = 0.0
+        # wall clock minus monotonic clock, taken once per call so that the tasks of a tick share it
+        self.offset = time.time() - time.monotonic()
+
+    def get_interval(self, reader_id, group=None):
+        if group is not None and '{}.{}'.format(reader_id, group) in self.intervals:
+            return self.intervals['{}.{}'.format(reader_id, group)]
+        return self.intervals.get(reader_id, self.default_interval)
+
+    def set_intervals(self, default_interval, intervals=None):
+        self.default_interval = float(default_interval)
+        self.intervals = intervals or dict()
+
+    def set_policy(self, align, policy=OVERRUN_SKIP, shed=()):
+        self.align = align
+        self.policy = policy
+        self.shed = set(shed)
+
+    def get_next_deadline(self, deadline, interval):
+        # the tick following deadline
+        if not self.align:
+            return deadline + interval
+        tick = math.floor((deadline + self.offset) / interval + 1e-6) + 1
+        return tick * interval - self.offset
+
+    def get_first_deadline(self, now, interval):
+        # now, aligned the first tick from now
+        if not self.align:
+            return now
+        tick = math.ceil((now + self.offset) / interval - 1e-6)
+        return tick * interval - self.offset
+
+    def is_shed(self, reader_id, group):
+        return reader_id in self.shed or (group is not None and '{}.{}'.format(reader_id, group) in self.shed)
+
+    def set_readers(self, readers, now=None, reset=()):
+        # everything is due on the first tick, and so are the readers in reset;
+        # the others keep their deadline, brought forward when their interval got shorter
+        now = time.monotonic() if now is None else now
+        self.offset = time.time() - time.monotonic()
+        previous = self.tasks
+        self.tasks = OrderedDict()
+        for reader in readers:
+            for group in reader.get_groups() or [None]:
+                interval = self.get_interval(reader.id, group)
+                task = previous.get((reader.id, group))
+                if task is None or reader.id in reset:
+                    deadline = self.get_first_deadline(now, interval)
+                else:
+                    deadline = min(task[1], self.get_next_deadline(now, interval))
+                self.tasks[(reader.id, group)] = [interval, deadline]
+
+    def pop_due(self, now=None):
+        now = time.monotonic() if now is None else now
+        self.offset = time.time() - time.monotonic()
+        due = list()
+        late = False
+        self.lateness = 0.0
+
+        for (reader_id, group), task in self.tasks.items():
+            interval, deadline = task
+            if deadline > now:
+                continue
+            self.lateness = max(self.lateness, now - deadline)
+            task[1] = self.get_next_deadline(deadline, interval)
+            if task[1] <= now:
+                # a tick was missed
+                late = True
+                if self.policy != OVERRUN_CATCH_UP or now - task[1] >= CATCH_UP_LIMIT * interval:
+                    task[1] = self.get_next_deadline(now, interval)
+            due.append((reader_id, group))
+        if late:
+            self.overruns += 1
+
+        selected = OrderedDict()
+        for reader_id, group in due:
+            if late and self.policy == OVERRUN_SHED and self.is_shed(reader_id, group):
+                self.shed_reads += 1
+                continue
+            groups = selected.setdefault(reader_id, [])
+            if group is not None:
+                groups.append(group)
+        return selected
+
+    def get_wait_time(self, now=None):
+        now = time.monotonic() if now is None else now
+        if not self.tasks:
+            return self.default_interval
+        return max(0.0, min(task[1] for task in self.tasks.values()) - now)
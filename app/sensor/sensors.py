@@ -3,10 +3,24 @@ import json
 import os
 import threading
 import pprint
-
-from . import modbus_reader, mcu_arduino_reader
-from ..utils import IIoT
+import socket
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+
+from pymodbus.exceptions import ModbusIOException
+
+from . import actuators, analytics, circuit_breaker, commands, devices, modbus_reader, mcu_arduino_reader, \
+    modbus_pool, modbus_rtu, scheduler, publisher, report_by_exception
+from .reader import get_timestamp
+from ..fds import Boards
+from ..utils import IIoT, outbox, timeseries
 from ..utils.connector import MqttLocalClient
+from ..utils.metrics import metrics
+
+MODBUS_READERS = (modbus_reader.ModbusChargeControllerReader, modbus_reader.ModbusRelayBoxReader)
+READER_TYPES = {reader.DEVICE_TYPE: reader for reader in MODBUS_READERS}
 
 
 class Sensors(threading.Thread):
@@ -15,10 +29,39 @@ class Sensors(threading.Thread):
         super().__init__()
 
         self.configurations = {}
-        self.charge_controller = None
-        self.charge_controller_2 = None
-        self.relay_box = None
+        self.modbus_readers = []
         self.mcu = None
+        # Board resetting the MCU once the reader gave up on it
+        self.board = None
+        self.resetting = None
+        self.modbus_pool = modbus_pool.default_pool
+        self.rtu_buses = None
+        self.executor = None
+        self.executor_workers = 0
+        self.scheduler = None
+        self.publisher = None
+        self.report_by_exception = None
+        self.store_and_forward = None
+        self.history = None
+        self.analytics = None
+        self.commands = None
+        # relay box reader id -> RelayActuator
+        self.actuators = dict()
+        # reader id -> CircuitBreaker
+        self.breakers = dict()
+        self.reading_times = dict()
+        # reader id -> settings the reader was built with
+        self.reader_specs = dict()
+        # configuration changes waiting for the end of the cycle, and when the first one arrived
+        self.pending_changes = OrderedDict()
+        self.pending_futures = []
+        self.pending_since = None
+        self.reconfigured_at = None
+        self.config_lock = threading.Lock()
+        self.last_telemetry = time.monotonic()
+        self.last_published = 0
+        self.last_replayed = 0
+        self.last_analytics = time.monotonic()
         self.event = threading.Event()
 
         self.mqtt_client = mqtt_client
@@ -40,178 +83,766 @@ class Sensors(threading.Thread):
         self.configurations['READING_INTERVAL'] = int(os.getenv('READING_INTERVAL', 10))
         self.configurations['DUMMY_DATA'] = int(os.getenv('DUMMY_DATA', 0))
         self.configurations['MODBUS_IP'] = os.getenv('MODBUS_IP', '192.168.2.253')
+        self.configurations['MODBUS_PORT'] = int(os.getenv('MODBUS_PORT', 502))
+        # "<id>=<charge_controller|relay_box>@<ip>[:<port>]/<unit>, ...", when empty the *_MODBUS_UNIT behind MODBUS_IP
+        self.configurations['MODBUS_DEVICES'] = os.getenv('MODBUS_DEVICES', '')
+        self.configurations['RS485_BAUDRATE'] = int(os.getenv('RS485_BAUDRATE', 9600))
+        self.configurations['RS485_PARITY'] = os.getenv('RS485_PARITY', 'N')  # N, E, O
+        self.configurations['MODBUS_MAX_GAP'] = int(os.getenv('MODBUS_MAX_GAP', 10))
+        self.configurations['REGISTER_CACHE_TTL'] = int(os.getenv('REGISTER_CACHE_TTL', 3600))
         self.configurations['CHARGE_CONTROLLER_1_MODBUS_UNIT'] = int(os.getenv('CHARGE_CONTROLLER_1_MODBUS_UNIT',  1)) # 0x1
         self.configurations['CHARGE_CONTROLLER_2_MODBUS_UNIT'] = int(os.getenv('CHARGE_CONTROLLER_2_MODBUS_UNIT', 0))
         self.configurations['RELAY_BOX_MODBUS_UNIT'] = int(os.getenv('RELAY_BOX_MODBUS_UNIT', 0x9))  # 0x09
         self.configurations['MCU_I2C_CHANNEL'] = int(os.getenv('MCU_I2C_CHANNEL', 1))
         self.configurations['MCU_ARDUINO_I2C_ADDRESS'] = int(os.getenv('MCU_ARDUINO_I2C_ADDRESS', 0x27))  # 0x27
+        self.configurations['CONCURRENT_READING'] = int(os.getenv('CONCURRENT_READING', 0))
+        self.configurations['READING_WORKERS'] = int(os.getenv('READING_WORKERS', 4))
+        self.configurations['READ_TIMEOUT'] = float(os.getenv('READ_TIMEOUT', 5))
+        self.configurations['POLLING_INTERVALS'] = os.getenv('POLLING_INTERVALS', '')
+        # reads on the multiples of their interval on the wall clock, so that the sites sample together
+        self.configurations['SCHEDULE_ALIGN'] = int(os.getenv('SCHEDULE_ALIGN', 1))
+        self.configurations['OVERRUN_POLICY'] = os.getenv('OVERRUN_POLICY', 'skip')  # skip, catch_up, shed
+        # "<reader>[.<group>], ..." left out of the late cycles with the shed policy
+        self.configurations['SHED_READERS'] = os.getenv('SHED_READERS', '')
+        self.configurations['MCU_I2C_MODE'] = os.getenv('MCU_I2C_MODE', 'byte')  # byte | block | rdwr
+        # milliseconds per MCU read, the channels left are counted as missing
+        self.configurations['MCU_READ_BUDGET'] = int(os.getenv('MCU_READ_BUDGET', 500))
+        self.configurations['MCU_RETRIES'] = int(os.getenv('MCU_RETRIES', 1))  # per register, before reopening the bus
+        self.configurations['MCU_BOARD'] = os.getenv('MCU_BOARD', '')  # C23 | NEO, resets the MCU when unavailable
+        self.configurations['PUBLISH_MODE'] = os.getenv('PUBLISH_MODE', 'field')  # field, device, cycle, binary
+        # seconds between two announcements of an unchanged binary schema
+        self.configurations['SCHEMA_INTERVAL'] = int(os.getenv('SCHEMA_INTERVAL', 300))
+        self.configurations['REPORT_BY_EXCEPTION'] = int(os.getenv('REPORT_BY_EXCEPTION', 0))
+        self.configurations['DEADBANDS'] = os.getenv('DEADBANDS', '')
+        self.configurations['HEARTBEAT_INTERVAL'] = int(os.getenv('HEARTBEAT_INTERVAL', 300))
+        self.configurations['TELEMETRY_INTERVAL'] = int(os.getenv('TELEMETRY_INTERVAL', 60))
+        # failed reads in a row before a reader is left out of the cycles and probed with backoff, 0 to disable
+        self.configurations['BREAKER_FAILURES'] = int(os.getenv('BREAKER_FAILURES', 3))
+        self.configurations['BREAKER_BACKOFF'] = float(os.getenv('BREAKER_BACKOFF', 10))  # seconds to the first probe
+        self.configurations['BREAKER_MAX_BACKOFF'] = float(os.getenv('BREAKER_MAX_BACKOFF', 600))
+        self.configurations['BREAKER_JITTER'] = float(os.getenv('BREAKER_JITTER', 0.2))  # fraction of the backoff
+        # /configurations, /actuators and /data requests, handled off the MQTT thread
+        self.configurations['COMMAND_WORKERS'] = int(os.getenv('COMMAND_WORKERS', 1))
+        self.configurations['COMMAND_QUEUE_SIZE'] = int(os.getenv('COMMAND_QUEUE_SIZE', 100))
+        self.configurations['COMMAND_TIMEOUT'] = float(os.getenv('COMMAND_TIMEOUT', 10))  # seconds
+        # milliseconds a relay command waits for the following ones, written together
+        self.configurations['RELAY_COALESCE_WINDOW'] = int(os.getenv('RELAY_COALESCE_WINDOW', 20))
+        # SQLite file buffering the messages while the broker is unreachable, empty to disable
+        self.configurations['OUTBOX_PATH'] = os.getenv('OUTBOX_PATH', './outbox.sqlite')
+        self.configurations['OUTBOX_MAX_MB'] = int(os.getenv('OUTBOX_MAX_MB', 50))
+        self.configurations['OUTBOX_REPLAY_RATE'] = int(os.getenv('OUTBOX_REPLAY_RATE', 100))  # messages per second
+        self.configurations['OUTBOX_BATCH_SIZE'] = int(os.getenv('OUTBOX_BATCH_SIZE', 50))
+        self.configurations['OUTBOX_MAX_QUEUE'] = int(os.getenv('OUTBOX_MAX_QUEUE', 1000))
+        # directory of the local history queried on /data, empty to disable
+        self.configurations['HISTORY_PATH'] = os.getenv('HISTORY_PATH', './history')
+        self.configurations['HISTORY_SERIES'] = int(os.getenv('HISTORY_SERIES', 128))
+        self.configurations['HISTORY_RAW_SLOTS'] = int(os.getenv('HISTORY_RAW_SLOTS', 720))  # samples per series
+        self.configurations['HISTORY_MINUTE_SLOTS'] = int(os.getenv('HISTORY_MINUTE_SLOTS', 1440))  # 1 day
+        self.configurations['HISTORY_HOUR_SLOTS'] = int(os.getenv('HISTORY_HOUR_SLOTS', 2160))  # 90 days
+        # seconds between two publications of the integrals and rolling statistics on /data, 0 to disable
+        self.configurations['ANALYTICS_INTERVAL'] = int(os.getenv('ANALYTICS_INTERVAL', 60))
+        self.configurations['ANALYTICS_PATH'] = os.getenv('ANALYTICS_PATH', './analytics.json')  # saved integrals and windows
+        self.configurations['ANALYTICS_INTEGRALS'] = os.getenv('ANALYTICS_INTEGRALS', 'inPower=kWh, outPower=kWh, battsI=Ah')
+        self.configurations['ANALYTICS_STATS'] = os.getenv('ANALYTICS_STATS', 'battsV, battsI, inPower, outPower')
+        self.configurations['ANALYTICS_WINDOWS'] = os.getenv('ANALYTICS_WINDOWS', '300, 3600')  # seconds
+        # seconds without samples over which nothing is integrated
+        self.configurations['ANALYTICS_MAX_GAP'] = int(os.getenv('ANALYTICS_MAX_GAP', 300))
         self.config_file = './config.ini'
         self.save_properties()
 
-    def save_properties(self):
+    def get_config_parser(self):
         configs = configparser.ConfigParser()
         for key in self.configurations.keys():
             configs['DEFAULT'][key] = str(self.configurations[key])
-        # save to file
-        with open(self.config_file, 'w') as configfile:
+        return configs
+
+    def save_properties(self):
+        configs = self.get_config_parser()
+        # written aside then renamed, config.ini is never seen half written
+        temporary = self.config_file + '.tmp'
+        with open(temporary, 'w') as configfile:
             configs.write(configfile)
+            configfile.flush()
+            os.fsync(configfile.fileno())
+        os.replace(temporary, self.config_file)
 
-    def read_properties(self):
-        configs = configparser.ConfigParser()
-        configs.read(self.config_file)
+    def read_properties(self, configs=None):
+        if configs is None:
+            configs = configparser.ConfigParser()
+            configs.read(self.config_file)
 
         default = configs['DEFAULT']
         self.configurations['READING_INTERVAL'] = int(default['READING_INTERVAL'])
         self.configurations['MODBUS_IP'] = default['MODBUS_IP']
+        self.configurations['MODBUS_PORT'] = int(default.get('MODBUS_PORT', 502))
+        self.configurations['MODBUS_DEVICES'] = default.get('MODBUS_DEVICES', '')
+        self.configurations['RS485_BAUDRATE'] = int(default.get('RS485_BAUDRATE', 9600))
+        self.configurations['RS485_PARITY'] = default.get('RS485_PARITY', 'N')
+        self.configurations['MODBUS_MAX_GAP'] = int(default.get('MODBUS_MAX_GAP', 10))
+        self.configurations['REGISTER_CACHE_TTL'] = int(default.get('REGISTER_CACHE_TTL', 3600))
         self.configurations['CHARGE_CONTROLLER_1_MODBUS_UNIT'] = int(default['CHARGE_CONTROLLER_1_MODBUS_UNIT'])
         self.configurations['CHARGE_CONTROLLER_2_MODBUS_UNIT'] = int(default['CHARGE_CONTROLLER_2_MODBUS_UNIT'])
         self.configurations['RELAY_BOX_MODBUS_UNIT'] = int(default['RELAY_BOX_MODBUS_UNIT'])
         self.configurations['MCU_I2C_CHANNEL'] = int(default['MCU_I2C_CHANNEL'])
-        self.configurations['MCU_ARDUINO_I2C_ADDRESS'] = int(default['MCU_ARDUINO_I2C_ADDRESS'])
+        self.configurations['MCU_ARDUINO_I2C_ADDRESS'] = int(default['MCU_ARDUINO_I2C_ADDRESS'], 0)
         self.configurations['DUMMY_DATA'] = int(default['DUMMY_DATA'])
+        self.configurations['CONCURRENT_READING'] = int(default.get('CONCURRENT_READING', 0))
+        self.configurations['READING_WORKERS'] = int(default.get('READING_WORKERS', 4))
+        self.configurations['READ_TIMEOUT'] = float(default.get('READ_TIMEOUT', 5))
+        self.configurations['POLLING_INTERVALS'] = default.get('POLLING_INTERVALS', '')
+        self.configurations['SCHEDULE_ALIGN'] = int(default.get('SCHEDULE_ALIGN', 1))
+        self.configurations['OVERRUN_POLICY'] = scheduler.parse_policy(default.get('OVERRUN_POLICY', 'skip'))
+        self.configurations['SHED_READERS'] = default.get('SHED_READERS', '')
+        self.configurations['MCU_I2C_MODE'] = default.get('MCU_I2C_MODE', 'byte')
+        self.configurations['MCU_READ_BUDGET'] = int(default.get('MCU_READ_BUDGET', 500))
+        self.configurations['MCU_RETRIES'] = int(default.get('MCU_RETRIES', 1))
+        self.configurations['MCU_BOARD'] = default.get('MCU_BOARD', '')
+        if self.configurations['MCU_BOARD'] and self.configurations['MCU_BOARD'] not in Boards.BOARDS:
+            raise ValueError('Unsupported board {}. Choose among {}'.format(
+                self.configurations['MCU_BOARD'], ', '.join(Boards.BOARDS)))
+        self.configurations['PUBLISH_MODE'] = default.get('PUBLISH_MODE', 'field')
+        self.configurations['SCHEMA_INTERVAL'] = int(default.get('SCHEMA_INTERVAL', 300))
+        self.configurations['REPORT_BY_EXCEPTION'] = int(default.get('REPORT_BY_EXCEPTION', 0))
+        self.configurations['DEADBANDS'] = default.get('DEADBANDS', '')
+        self.configurations['HEARTBEAT_INTERVAL'] = int(default.get('HEARTBEAT_INTERVAL', 300))
+        self.configurations['TELEMETRY_INTERVAL'] = int(default.get('TELEMETRY_INTERVAL', 60))
+        self.configurations['BREAKER_FAILURES'] = int(default.get('BREAKER_FAILURES', 3))
+        self.configurations['BREAKER_BACKOFF'] = float(default.get('BREAKER_BACKOFF', 10))
+        self.configurations['BREAKER_MAX_BACKOFF'] = float(default.get('BREAKER_MAX_BACKOFF', 600))
+        self.configurations['BREAKER_JITTER'] = float(default.get('BREAKER_JITTER', 0.2))
+        self.configurations['COMMAND_WORKERS'] = int(default.get('COMMAND_WORKERS', 1))
+        self.configurations['COMMAND_QUEUE_SIZE'] = int(default.get('COMMAND_QUEUE_SIZE', 100))
+        self.configurations['COMMAND_TIMEOUT'] = float(default.get('COMMAND_TIMEOUT', 10))
+        self.configurations['RELAY_COALESCE_WINDOW'] = int(default.get('RELAY_COALESCE_WINDOW', 20))
+        self.configurations['OUTBOX_PATH'] = default.get('OUTBOX_PATH', './outbox.sqlite')
+        self.configurations['OUTBOX_MAX_MB'] = int(default.get('OUTBOX_MAX_MB', 50))
+        self.configurations['OUTBOX_REPLAY_RATE'] = int(default.get('OUTBOX_REPLAY_RATE', 100))
+        self.configurations['OUTBOX_BATCH_SIZE'] = int(default.get('OUTBOX_BATCH_SIZE', 50))
+        self.configurations['OUTBOX_MAX_QUEUE'] = int(default.get('OUTBOX_MAX_QUEUE', 1000))
+        self.configurations['HISTORY_PATH'] = default.get('HISTORY_PATH', './history')
+        self.configurations['HISTORY_SERIES'] = int(default.get('HISTORY_SERIES', 128))
+        self.configurations['HISTORY_RAW_SLOTS'] = int(default.get('HISTORY_RAW_SLOTS', 720))
+        self.configurations['HISTORY_MINUTE_SLOTS'] = int(default.get('HISTORY_MINUTE_SLOTS', 1440))
+        self.configurations['HISTORY_HOUR_SLOTS'] = int(default.get('HISTORY_HOUR_SLOTS', 2160))
+        self.configurations['ANALYTICS_INTERVAL'] = int(default.get('ANALYTICS_INTERVAL', 60))
+        self.configurations['ANALYTICS_PATH'] = default.get('ANALYTICS_PATH', './analytics.json')
+        self.configurations['ANALYTICS_INTEGRALS'] = default.get('ANALYTICS_INTEGRALS', 'inPower=kWh, outPower=kWh, battsI=Ah')
+        self.configurations['ANALYTICS_STATS'] = default.get('ANALYTICS_STATS', 'battsV, battsI, inPower, outPower')
+        self.configurations['ANALYTICS_WINDOWS'] = default.get('ANALYTICS_WINDOWS', '300, 3600')
+        self.configurations['ANALYTICS_MAX_GAP'] = int(default.get('ANALYTICS_MAX_GAP', 300))
+        # rejected here rather than when the analytics are rebuilt
+        analytics.parse_integrals(self.configurations['ANALYTICS_INTEGRALS'])
+        analytics.parse_windows(self.configurations['ANALYTICS_WINDOWS'])
+        devices.check_serial_lines(devices.parse_devices(self.configurations['MODBUS_DEVICES']),
+                                   self.configurations['RS485_BAUDRATE'])
 
     def get_properties(self):
         return self.configurations
 
     def init_sensors(self):
-        if self.configurations['CHARGE_CONTROLLER_1_MODBUS_UNIT']:
-            try:
-                self.charge_controller = modbus_reader.ModbusChargeControllerReader(
-                    'cc1',
-                    ip_address=self.configurations['MODBUS_IP'],
-                    unit_id=int(self.configurations['CHARGE_CONTROLLER_1_MODBUS_UNIT']),
-                    produce_dummy_data=self.configurations['DUMMY_DATA']
-                )
-            except Exception as e:
-                print(e)
-                self.charge_controller = None
-        else:
-            self.charge_controller = None
-
-        if self.configurations['CHARGE_CONTROLLER_2_MODBUS_UNIT']:
-            try:
-                self.charge_controller_2 = modbus_reader.ModbusChargeControllerReader(
-                    'cc2',
-                    ip_address=self.configurations['MODBUS_IP'],
-                    unit_id=int(self.configurations['CHARGE_CONTROLLER_2_MODBUS_UNIT']),
-                    produce_dummy_data=self.configurations['DUMMY_DATA']
-                )
-            except Exception as e:
-                print(e)
-                self.charge_controller_2 = None
-        else:
-            self.charge_controller_2 = None
-
-        if self.configurations['RELAY_BOX_MODBUS_UNIT']:
-            try:
-                self.relay_box = modbus_reader.ModbusRelayBoxReader(
-                    'rb',
-                    ip_address=self.configurations['MODBUS_IP'],
-                    unit_id=int(self.configurations['RELAY_BOX_MODBUS_UNIT']),
-                    produce_dummy_data=self.configurations['DUMMY_DATA']
-                )
-            except Exception as e:
-                print(e)
-                self.relay_box = None
-        else:
-            self.relay_box = None
-
+        modbus_devices = devices.parse_devices(self.configurations['MODBUS_DEVICES'], self.configurations['MODBUS_PORT']) \
+            or devices.legacy_devices(self.configurations)
+        devices.check_serial_lines(modbus_devices, self.configurations['RS485_BAUDRATE'])
+
+        # the serial ports are reopened when their settings change, with every reader on them
+        rtu_settings = (self.configurations['RS485_BAUDRATE'], self.configurations['RS485_PARITY'])
+        if self.rtu_buses is None or (self.rtu_buses.baudrate, self.rtu_buses.parity) != rtu_settings:
+            if self.rtu_buses is not None:
+                self.rtu_buses.close_all()
+            self.rtu_buses = modbus_rtu.RtuBusPool(*rtu_settings)
+
+        # readers are only rebuilt when the settings they were built with change
+        readers = {reader.id: reader for reader in self.get_readers()}
+        specs = dict()
+        modbus_readers = []
+        for device in modbus_devices.values():
+            pool = self.modbus_pool if device.transport == devices.TRANSPORT_TCP else self.rtu_buses
+            spec = (device, self.configurations['DUMMY_DATA'], self.configurations['MODBUS_MAX_GAP'],
+                    self.configurations['REGISTER_CACHE_TTL'], pool)
+            reader = readers.get(device.id)
+            if reader is None or self.reader_specs.get(device.id) != spec:
+                try:
+                    reader = READER_TYPES[device.type](
+                        device.id,
+                        ip_address=device.address,
+                        port=device.port,
+                        unit_id=device.unit_id,
+                        produce_dummy_data=self.configurations['DUMMY_DATA'],
+                        pool=pool,
+                        max_gap=self.configurations['MODBUS_MAX_GAP'],
+                        cache_ttl=self.configurations['REGISTER_CACHE_TTL']
+                    )
+                except Exception as e:
+                    print(e)
+                    continue
+            specs[device.id] = spec
+            modbus_readers.append(reader)
+
+        mcu = None
         if self.configurations['MCU_ARDUINO_I2C_ADDRESS']:
-            try:
-                self.mcu = mcu_arduino_reader.McuArduinoReader(
-                    'mcu',
-                    produce_dummy_data=self.configurations['DUMMY_DATA']
+            spec = (int(self.configurations['MCU_I2C_CHANNEL']), int(self.configurations['MCU_ARDUINO_I2C_ADDRESS']),
+                    self.configurations['DUMMY_DATA'])
+            if self.mcu is not None and self.reader_specs.get(self.mcu.id) == spec:
+                mcu = self.mcu
+            else:
+                try:
+                    mcu = mcu_arduino_reader.McuArduinoReader(
+                        'mcu',
+                        i2c_bus=int(self.configurations['MCU_I2C_CHANNEL']),
+                        i2c_address=int(self.configurations['MCU_ARDUINO_I2C_ADDRESS']),
+                        produce_dummy_data=self.configurations['DUMMY_DATA'],
+                        i2c_mode=self.configurations['MCU_I2C_MODE']
+                    )
+                except Exception as e:
+                    print(e)
+            if mcu is not None:
+                specs[mcu.id] = spec
+                # the transfer mode, budget and retries do not need a new bus
+                mcu.i2c_mode = self.configurations['MCU_I2C_MODE']
+                mcu.budget = self.configurations['MCU_READ_BUDGET'] / 1000.0
+                mcu.retries = self.configurations['MCU_RETRIES']
+
+        board = self.configurations['MCU_BOARD']
+        if not board or self.configurations['DUMMY_DATA']:
+            self.board = None
+        elif self.board is None or self.board.BOARD_TYPE != board:
+            self.board = Boards.BOARDS[board](open_sensor=False)
+
+        # swapped between two cycles, the polling loop never sees a half-built set of readers
+        previous = self.get_readers()
+        self.modbus_readers, self.mcu, self.reader_specs = modbus_readers, mcu, specs
+        current = self.get_readers()
+        for reader in previous:
+            if reader not in current:
+                self.close_reader(reader)
+        rebuilt = set(reader.id for reader in current if reader not in previous)
+        self.init_breakers(current, rebuilt)
+
+        workers = 0
+        if self.configurations['CONCURRENT_READING']:
+            # at least one worker per bus, so that every gateway is polled at the same time
+            buses = set(reader.get_bus_id() or reader.id for reader in current)
+            workers = max(1, int(self.configurations['READING_WORKERS']), len(buses))
+        if workers != self.executor_workers:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='reader') if workers else None
+            self.executor_workers = workers
+
+        intervals = scheduler.parse_intervals(self.configurations['POLLING_INTERVALS'])
+        if self.scheduler is None:
+            self.scheduler = scheduler.PollingScheduler(self.configurations['READING_INTERVAL'], intervals)
+        else:
+            self.scheduler.set_intervals(self.configurations['READING_INTERVAL'], intervals)
+        self.scheduler.set_policy(bool(self.configurations['SCHEDULE_ALIGN']), self.configurations['OVERRUN_POLICY'],
+                                  scheduler.parse_shed(self.configurations['SHED_READERS']))
+        self.scheduler.set_readers(current, reset=rebuilt)
+
+        if self.configurations['REPORT_BY_EXCEPTION']:
+            deadbands = report_by_exception.parse_deadbands(self.configurations['DEADBANDS'])
+            if self.report_by_exception is None or self.report_by_exception.deadbands != deadbands or \
+                    self.report_by_exception.heartbeat_interval != float(self.configurations['HEARTBEAT_INTERVAL']):
+                self.report_by_exception = report_by_exception.ReportByException(
+                    deadbands,
+                    self.configurations['HEARTBEAT_INTERVAL']
                 )
-            except Exception as e:
-                print(e)
-                self.mcu = None
         else:
-            self.mcu = None
-
-        print("CG_1: {}".format(self.charge_controller))
-        print("CG_2: {}".format(self.charge_controller_2))
-        print("RB: {}".format(self.relay_box))
+            self.report_by_exception = None
+
+        self.init_outbox()
+        self.init_history()
+        self.init_analytics()
+        self.init_commands()
+        self.init_actuators()
+
+        modes = publisher.parse_modes(self.configurations['PUBLISH_MODE'])
+        if self.publisher is None or self.publisher.modes != modes or self.publisher.mqtt_client is not self.get_output() \
+                or self.publisher.report_by_exception is not self.report_by_exception \
+                or self.publisher.encoder.schema_interval != self.configurations['SCHEMA_INTERVAL']:
+            self.publisher = publisher.Publisher(
+                self.get_output(),
+                modes,
+                self.report_by_exception,
+                self.configurations['SCHEMA_INTERVAL']
+            )
+
+        print("MODBUS DEVICES: {}".format(devices.format_devices(modbus_devices)))
+        for reader in self.modbus_readers:
+            print("{}: {}".format(reader.id.upper(), reader))
         print("MCU: {}".format(self.mcu))
+        print("POLLING INTERVALS: {}".format(
+            ', '.join('{}{}={:g}s'.format(reader_id, '' if group is None else '.' + group, task[0])
+                      for (reader_id, group), task in self.scheduler.tasks.items())))
+
+    def close_reader(self, reader):
+        if isinstance(reader, mcu_arduino_reader.McuArduinoReader):
+            if reader.bus is not None and hasattr(reader.bus, 'close'):
+                reader.bus.close()
+        elif isinstance(reader, modbus_reader.ModbusReader):
+            # the gateway connection is shared with the other readers
+            reader.cache.clear()
+
+    def init_commands(self):
+        if self.commands is None:
+            self.commands = commands.CommandProcessor({
+                IIoT.MqttChannels.configurations: self.handle_configuration,
+                IIoT.MqttChannels.actuators: self.handle_actuator,
+                IIoT.MqttChannels.data: self.handle_data,
+            }, self.publish_response)
+        self.commands.timeout = self.configurations['COMMAND_TIMEOUT']
+        self.commands.resize(self.configurations['COMMAND_WORKERS'], self.configurations['COMMAND_QUEUE_SIZE'])
+
+    def init_breakers(self, readers, rebuilt):
+        # a rebuilt reader starts healthy
+        self.breakers = {reader.id: self.breakers[reader.id] for reader in readers
+                         if reader.id in self.breakers and reader.id not in rebuilt}
+        for reader in readers:
+            breaker = self.breakers.setdefault(reader.id, circuit_breaker.CircuitBreaker())
+            breaker.failures = self.configurations['BREAKER_FAILURES']
+            breaker.backoff = self.configurations['BREAKER_BACKOFF']
+            breaker.max_backoff = self.configurations['BREAKER_MAX_BACKOFF']
+            breaker.jitter = self.configurations['BREAKER_JITTER']
+            if not breaker.failures:
+                breaker.record_success()
+
+    def init_actuators(self):
+        # one per relay box, kept with its reader
+        relay_boxes = {reader.id: reader for reader in self.modbus_readers
+                       if isinstance(reader, modbus_reader.ModbusRelayBoxReader)}
+        for reader_id, actuator in list(self.actuators.items()):
+            if relay_boxes.get(reader_id) is not actuator.reader:
+                actuator.stop()
+                del self.actuators[reader_id]
+        for reader_id, reader in relay_boxes.items():
+            if reader_id not in self.actuators:
+                self.actuators[reader_id] = actuators.RelayActuator(reader, on_state=self.publish_relay_state,
+                                                                      write_relays=self.write_relays)
+            self.actuators[reader_id].window = self.configurations['RELAY_COALESCE_WINDOW'] / 1000.0
+
+    def write_relays(self, reader, start, values):
+        # on the relay thread, through the pooled connection of the reads
+        return reader.write_relays(start, values)
+
+    def get_relay_name(self, actuator, coil):
+        # relay_<N> on the first relay box, <reader id>.relay_<N> on the others
+        name = 'relay_{}'.format(coil + 1)
+        if actuator is next(iter(self.actuators.values()), None):
+            return name
+        return '{}.{}'.format(actuator.reader.id, name)
+
+    def get_relay(self, name):
+        # relay name -> (actuator, coil), relay_<N> or relay<N>
+        reader_id, _, relay = name.rpartition('.')
+        actuator = self.actuators.get(reader_id) if reader_id else next(iter(self.actuators.values()), None)
+        number = relay[len('relay'):].lstrip('_')
+        if actuator is None or not relay.startswith('relay') or not number.isdigit():
+            raise ValueError('Unknown relay {}'.format(name))
+        return actuator, int(number) - 1
+
+    def publish_response(self, topic, payload):
+        # from the command workers and the threads resolving their futures
+        self.mqtt_client.publish(topic, payload)
+
+    def publish_relay_state(self, actuator, coil, state):
+        topic = '{}/{}/{}/state'.format(IIoT.MqttChannels.actuators, self.mqtt_client.client_id,
+                                        self.get_relay_name(actuator, coil))
+        self.get_output().publish(topic, json.dumps({'value': state, 'timestamp': int(datetime.now().timestamp())}))
+
+    def init_outbox(self):
+        path = self.configurations['OUTBOX_PATH']
+        if self.store_and_forward is not None and self.store_and_forward.outbox.path != path:
+            self.store_and_forward.stop()
+            self.store_and_forward = None
+        if not path:
+            return
+
+        if self.store_and_forward is None:
+            self.store_and_forward = outbox.StoreAndForward(self.mqtt_client, outbox.Outbox(path))
+            self.start_outbox()
+        self.store_and_forward.outbox.max_bytes = self.configurations['OUTBOX_MAX_MB'] * 1024 * 1024
+        self.store_and_forward.replay_rate = self.configurations['OUTBOX_REPLAY_RATE']
+        self.store_and_forward.batch_size = self.configurations['OUTBOX_BATCH_SIZE']
+        self.store_and_forward.max_queue = self.configurations['OUTBOX_MAX_QUEUE']
+        print(self.store_and_forward.outbox)
+
+    def start_outbox(self):
+        self.store_and_forward.start()
+
+    def init_history(self):
+        path = self.configurations['HISTORY_PATH']
+        layout = {'capacity': self.configurations['HISTORY_SERIES'], 'raw': self.configurations['HISTORY_RAW_SLOTS'],
+                  timeseries.RESOLUTION_MINUTE: self.configurations['HISTORY_MINUTE_SLOTS'],
+                  timeseries.RESOLUTION_HOUR: self.configurations['HISTORY_HOUR_SLOTS']}
+        if self.history is not None:
+            if self.history.path == path and self.history.layout == layout:
+                return
+            self.history.close()
+            self.history = None
+
+        if path:
+            self.history = timeseries.TimeSeriesStore(path, layout['capacity'], layout['raw'],
+                                                      layout[timeseries.RESOLUTION_MINUTE],
+                                                      layout[timeseries.RESOLUTION_HOUR])
+            print(self.history)
+
+    def init_analytics(self):
+        path = self.configurations['ANALYTICS_PATH']
+        integrals = analytics.parse_integrals(self.configurations['ANALYTICS_INTEGRALS'])
+        stats = analytics.parse_keys(self.configurations['ANALYTICS_STATS'])
+        windows = analytics.parse_windows(self.configurations['ANALYTICS_WINDOWS'])
+        max_gap = float(self.configurations['ANALYTICS_MAX_GAP'])
+        if self.analytics is not None:
+            if (self.analytics.path, self.analytics.integrals, self.analytics.stats, self.analytics.windows,
+                    self.analytics.max_gap) == (path, integrals, stats, windows, max_gap) \
+                    and self.configurations['ANALYTICS_INTERVAL']:
+                return
+            # the integrals go on from the saved totals
+            self.analytics.save()
+            self.analytics = None
+
+        if self.configurations['ANALYTICS_INTERVAL']:
+            self.analytics = analytics.StreamingAnalytics(path, integrals, stats, windows, max_gap)
+            print(self.analytics)
+
+    def get_output(self):
+        # the outbox when enabled, it publishes through the MQTT client while the broker is reachable
+        return self.store_and_forward or self.mqtt_client
+
+    def get_readers(self):
+        return self.modbus_readers + ([self.mcu] if self.mcu is not None else [])
+
+    def get_due_readers(self):
+        # (reader, register groups) pairs whose interval has elapsed, the unavailable readers only when probed
+        due = self.scheduler.pop_due()
+        return [(reader, due[reader.id]) for reader in self.get_readers()
+                if reader.id in due and self.is_allowed(reader)]
+
+    def is_allowed(self, reader):
+        breaker = self.breakers.get(reader.id)
+        if breaker is None or breaker.allow():
+            return True
+        metrics.increment('{}/skipped'.format(reader.id))
+        return False
+
+    def record_health(self, reader, error=None):
+        # called after every read, error is None on success
+        breaker = self.breakers.get(reader.id)
+        if breaker is None:
+            return
+        if error is None:
+            if breaker.record_success():
+                print('{}: AVAILABLE'.format(reader.id.upper()))
+                self.publish_availability(reader, breaker)
+        elif breaker.failures:
+            if breaker.record_failure():
+                print('{}: UNAVAILABLE after {} failures, next probe in {:.1f}s'.format(
+                    reader.id.upper(), breaker.consecutive_failures, breaker.get_retry_in()))
+                self.publish_availability(reader, breaker)
+            elif breaker.state == circuit_breaker.STATE_OPEN:
+                print('{}: probe failed, next one in {:.1f}s'.format(reader.id.upper(), breaker.get_retry_in()))
+            if breaker.state == circuit_breaker.STATE_OPEN and reader is self.mcu:
+                # the register retries and the bus reopening did not help: last resort before the next probe
+                self.reset_mcu()
+
+    def reset_mcu(self):
+        # the reset line is held for seconds, off the polling loop
+        if self.board is None or (self.resetting is not None and self.resetting.is_alive()):
+            return
+        metrics.increment('{}/resets'.format(self.mcu.id))
+        print('MCU RESET: {} reset pin {}'.format(self.board.BOARD_TYPE, self.board.reset_pin))
+        self.resetting = threading.Thread(target=self.board.reset_mcu, name='mcu-reset', daemon=True)
+        self.resetting.start()
+
+    def publish_availability(self, reader, breaker):
+        topic = '{}/{}/availability/{}'.format(IIoT.MqttChannels.sensors, self.mqtt_client.client_id, reader.id)
+        self.get_output().publish(topic, json.dumps({
+            'value': 'online' if breaker.is_available() else 'offline',
+            'state': breaker.state,
+            'failures': breaker.consecutive_failures,
+            'retry_in': round(breaker.get_retry_in(), 3),
+            'timestamp': int(datetime.now().timestamp())
+        }))
 
     def read_and_publish(self, data):
-        single_values_data = data.stocazzo_format()
-        for value in single_values_data:
-            topic = '{}/{}/{}'.format(IIoT.MqttChannels.sensors, self.mqtt_client.client_id, value['sensor'])
-            self.mqtt_client.publish(topic, json.dumps(value))
+        if self.reconfigured_at is not None:
+            self.observe_reconfiguration()
+        if self.history is not None:
+            self.history.record(data)
+        if self.analytics is not None:
+            self.analytics.record(data)
+        self.publisher.publish(data)
+
+    def read_reader(self, reader, groups=None):
+        start = time.monotonic()
+        try:
+            data = reader.read(groups or None)
+            self.record_health(reader)
+            self.read_and_publish(data)
+        except (ModbusIOException, socket.timeout) as e:
+            metrics.increment('{}/timeouts'.format(reader.id))
+            self.record_health(reader, e)
+            print(e)
+        except Exception as e:
+            metrics.increment('{}/errors'.format(reader.id))
+            self.record_health(reader, e)
+            print(e)
+        finally:
+            self.reading_times[reader.id] = time.monotonic() - start
+            metrics.observe('{}/total'.format(reader.id), self.reading_times[reader.id] * 1000.0)
+
+    def read_bus(self, tasks):
+        for reader, groups in tasks:
+            self.read_reader(reader, groups)
 
     def read(self):
-        # Read the data
-        if self.charge_controller is not None:
-            try:
-                self.read_and_publish(self.charge_controller.read())
-            except Exception as e:
-                print(e)
-
-        if self.charge_controller_2 is not None:
-            try:
-                self.read_and_publish(self.charge_controller_2.read())
-            except Exception as e:
-                print(e)
-
-        if self.relay_box is not None:
-            try:
-                self.read_and_publish(self.relay_box.read())
-            except Exception as e:
-                print(e)
-
-        if self.mcu is not None:
-            try:
-                self.read_and_publish(self.mcu.read())
-            except Exception as e:
-                print(e)
+        self.apply_changes()
+        start = time.monotonic()
+        tasks = self.get_due_readers()
+        executor = self.executor
 
-    def change_property(self, key, value, value_type):
-        self.configurations[str(key)] = value
+        if not tasks:
+            return
+        metrics.observe('cycle/lateness', self.scheduler.lateness * 1000.0)
 
-        self.save_properties()
+        if executor is None:
+            self.read_bus(tasks)
+        else:
+            # readers sharing a bus are polled one after the other, different buses at the same time
+            buses = OrderedDict()
+            for reader, groups in tasks:
+                bus_id = reader.get_bus_id() or reader.id
+                buses.setdefault(bus_id, []).append((reader, groups))
+
+            futures = [executor.submit(self.read_bus, bus_tasks) for bus_tasks in buses.values()]
+            for future in futures:
+                future.result()
+
+        self.publisher.flush()
+
+        cycle_time = time.monotonic() - start
+        metrics.observe('cycle/duration', cycle_time * 1000.0)
+        print('READING TIMES: {} cycle={:.3f}s'.format(
+            ' '.join('{}={:.3f}s'.format(reader.id, self.reading_times.get(reader.id, 0)) for reader, _ in tasks),
+            cycle_time))
+        self.observe_wire_bytes(tasks)
+        print(self.modbus_pool)
+        if self.rtu_buses.buses:
+            print(self.rtu_buses)
+        if self.report_by_exception is not None:
+            print(self.report_by_exception)
+        if self.store_and_forward is not None and self.store_and_forward.outbox.count:
+            print(self.store_and_forward.outbox)
+        if self.history is not None:
+            print(self.history)
+
+        self.publish_telemetry()
+        self.publish_analytics()
+
+    def observe_wire_bytes(self, tasks):
+        # RS485 bytes of the planned Modbus requests, and those saved by the planner and the register cache
+        plans = [reader.last_plan for reader, _ in tasks
+                 if isinstance(reader, modbus_reader.ModbusReader) and reader.last_plan is not None]
+        if not plans:
+            return
+
+        metrics.observe('modbus/wire_bytes', sum(plan.bytes for plan in plans))
+        metrics.observe('modbus/bytes_saved', sum(plan.saved for plan in plans))
+        print('MODBUS REQUESTS: {} bytes={} saved={}'.format(
+            sum(len(plan.ranges) for plan in plans),
+            sum(plan.bytes for plan in plans),
+            sum(plan.saved for plan in plans)))
+
+    def publish_telemetry(self):
+        interval = self.configurations['TELEMETRY_INTERVAL']
+        now = time.monotonic()
+        if not interval or now - self.last_telemetry < interval:
+            return
+
+        metrics.set_gauge('cycle/overruns', self.scheduler.overruns)
+        metrics.set_gauge('cycle/shed', self.scheduler.shed_reads)
+        if self.commands is not None:
+            metrics.set_gauge('commands/queue_depth', self.commands.get_queue_depth())
+        metrics.set_gauge('mqtt/queue_depth', self.mqtt_client.get_queue_depth())
+        for gateway, stats in self.modbus_pool.stats().items():
+            for name, value in stats.items():
+                metrics.set_gauge('modbus/{}/{}'.format(gateway, name), value)
+        for port, stats in self.rtu_buses.stats().items():
+            for name, value in stats.items():
+                metrics.set_gauge('rtu{}/{}'.format(port, name), value)
+        for reader in self.get_readers():
+            if isinstance(reader, modbus_reader.ModbusReader) and reader.cache.rules:
+                metrics.set_gauge('{}/cache_hits'.format(reader.id), reader.cache.hits)
+                metrics.set_gauge('{}/cache_misses'.format(reader.id), reader.cache.misses)
+        if self.report_by_exception is not None:
+            metrics.set_gauge('publish/sent', self.report_by_exception.sent)
+            metrics.set_gauge('publish/suppressed', self.report_by_exception.suppressed)
+        if self.store_and_forward is not None:
+            metrics.set_gauge('outbox/backlog', self.store_and_forward.outbox.count)
+            metrics.set_gauge('outbox/bytes', self.store_and_forward.outbox.bytes)
+            metrics.set_gauge('outbox/evicted', self.store_and_forward.outbox.evicted)
+        for reader_id, breaker in self.breakers.items():
+            metrics.set_gauge('{}/available'.format(reader_id), int(breaker.is_available()))
+        if self.history is not None:
+            metrics.set_gauge('history/series', len(self.history.series))
+            metrics.set_gauge('history/dropped', self.history.dropped)
+
+        collected = metrics.collect()
+        published = collected.get('mqtt/published', 0)
+        replayed = collected.get('outbox/replayed', 0)
+        collected['mqtt/publish_rate'] = round((published - self.last_published) / (now - self.last_telemetry), 3)
+        if self.store_and_forward is not None:
+            collected['outbox/drain_rate'] = round((replayed - self.last_replayed) / (now - self.last_telemetry), 3)
+        self.last_published = published
+        self.last_replayed = replayed
+        self.last_telemetry = now
+
+        output = self.get_output()
+        timestamp = int(datetime.now().timestamp())
+        for name, value in collected.items():
+            topic = '{}/{}/{}'.format(IIoT.MqttChannels.telemetry, self.mqtt_client.client_id, name)
+            output.publish(topic, json.dumps({'value': value, 'timestamp': timestamp}))
+
+    def publish_analytics(self):
+        interval = self.configurations['ANALYTICS_INTERVAL']
+        now = time.monotonic()
+        if self.analytics is None or now - self.last_analytics < interval:
+            return
+        self.last_analytics = now
+
+        timestamp = get_timestamp()
+        output = self.get_output()
+        for device, report in self.analytics.get_report(timestamp).items():
+            topic = '{}/{}/analytics/{}'.format(IIoT.MqttChannels.data, self.mqtt_client.client_id, device)
+            report['timestamp'] = timestamp
+            output.publish(topic, json.dumps(report))
+        try:
+            self.analytics.save()
+        except OSError as e:
+            print('ANALYTICS: {}'.format(e))
 
-        # reinitialize the objects
-        self.init_properties()
-        self.init_sensors()
+    def change_property(self, key, value, value_type):
+        # queued for the polling loop, the future gives the keys changed once applied
+        future = Future()
+        with self.config_lock:
+            self.pending_changes[str(key).upper()] = value
+            self.pending_futures.append(future)
+            if self.pending_since is None:
+                self.pending_since = time.monotonic()
         self.event.set()
-
-    def on_message_callback(self, message):
-        message_payload = json.loads(message.payload)
-        message_topic = message.topic
-
-        print(message_topic)
-        print(message_payload)
-
+        return future
+
+    def apply_changes(self):
+        # between two cycles: every change received meanwhile, one write of config.ini, the affected objects rebuilt
+        with self.config_lock:
+            changes, futures, since = self.pending_changes, self.pending_futures, self.pending_since
+            self.pending_changes, self.pending_futures, self.pending_since = OrderedDict(), [], None
+        if not changes:
+            return
+
+        previous = dict(self.configurations)
+        self.configurations.update(changes)
         try:
-            _, mqtt_channel, module, configuration, direction = message_topic.split('/')
+            # parsed as if read back from config.ini
+            self.read_properties(self.get_config_parser())
         except Exception as e:
-            print(e)
-            return None
-
-        message_payload = json.loads(message.payload)
-        value_type = message_payload['value_type']
-        value = message_payload['value']
+            print('CONFIGURATION REJECTED: {} {}'.format(dict(changes), e))
+            self.configurations = previous
+            for future in futures:
+                future.set_exception(ValueError('Rejected {}: {}'.format(', '.join(changes), e)))
+            return
+
+        changed = [key for key in self.configurations if self.configurations[key] != previous.get(key)]
+        if changed:
+            self.save_properties()
+            self.init_sensors()
+        for future in futures:
+            future.set_result(changed)
+        if not changed:
+            return
+
+        elapsed = (time.monotonic() - since) * 1000.0
+        metrics.observe('config/apply', elapsed)
+        print('CONFIGURATION CHANGED: {} applied after {:.1f}ms'.format(
+            ', '.join('{}={}'.format(key, self.configurations[key]) for key in changed), elapsed))
+        self.reconfigured_at = since
+
+    def observe_reconfiguration(self):
+        # first sample read with the new settings
+        with self.config_lock:
+            since, self.reconfigured_at = self.reconfigured_at, None
+        if since is not None:
+            elapsed = (time.monotonic() - since) * 1000.0
+            metrics.observe('config/first_sample', elapsed)
+            print('CONFIGURATION: first sample {:.1f}ms after the change'.format(elapsed))
+
+    def query_history(self, request):
+        # {"id": ..., "series": ["cc1/battsV", "rb"], "start": <epoch s>, "end": <epoch s>, "resolution": "raw|1m|1h"}
+        if self.history is None:
+            raise ValueError('History is disabled')
+        start = time.monotonic()
+        response = self.history.query(request.get('series'), request.get('start'), request.get('end'),
+                                      request.get('resolution'))
+        elapsed = (time.monotonic() - start) * 1000.0
+        metrics.observe('history/query', elapsed)
+        response['elapsed_ms'] = round(elapsed, 3)
+        return response
+
+    def handle_configuration(self, command):
+        # answered once applied by the polling loop, without holding the worker meanwhile
+        change = self.change_property(command.name, command.payload['value'], command.payload['value_type'])
+        future = Future()
+
+        def applied(change):
+            if change.exception() is not None:
+                commands.resolve(future, exception=change.exception())
+            else:
+                commands.resolve(future, {'changed': change.result()})
+
+        change.add_done_callback(applied)
+        return future
+
+    def handle_actuator(self, command):
+        # {"id": ..., "value": true|false}, answered once read back from the relay box
+        actuator, coil = self.get_relay(command.name)
+        return actuator.command(coil, command.payload['value'], command.received)
+
+    def handle_data(self, command):
+        # /data/<client>/analytics/request answers the current integrals and statistics, the rest the history
+        if command.name == 'analytics':
+            if self.analytics is None:
+                raise ValueError('Analytics are disabled')
+            return {'devices': self.analytics.get_report(get_timestamp())}
+        return self.query_history(command.payload)
 
-        if mqtt_channel == 'configurations':
-            try:
-                self.change_property(configuration, value, value_type)
-            except Exception as e:
-                # publish back
-                print(e)
-        elif mqtt_channel == 'actuators':
-            print(message_payload)
-
-        response_topic = "/{}/{}/{}/response".format(mqtt_channel, module, configuration)
-        self.mqtt_client.publish(response_topic, json.dumps(message_payload))
+    def on_message_callback(self, message):
+        # on the paho network thread: queued for the command workers
+        print(message.topic)
+        if self.commands is not None:
+            self.commands.submit(message)
 
     def start(self):
         self.mqtt_client.start()
         while True:
             self.read()
-            self.event.wait(int(self.get_properties()['READING_INTERVAL']))
+            self.event.wait(self.scheduler.get_wait_time())
             self.event.clear()
 
     def stop(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        self.modbus_pool.close_all()
+        if self.rtu_buses is not None:
+            self.rtu_buses.close_all()
+        if self.commands is not None:
+            self.commands.stop()
+        for actuator in self.actuators.values():
+            actuator.stop()
+        if self.store_and_forward is not None:
+            self.store_and_forward.stop()
+        if self.history is not None:
+            self.history.close()
+        if self.analytics is not None:
+            self.analytics.save()
         self.mqtt_client.stop()
         self.mqtt_client.join()
         self.join()
@@ -1,14 +1,18 @@
+import asyncio
 import queue
 import threading
 import time
 
 import paho.mqtt.client as mqtt
 
+from .metrics import metrics
+
 
 class MqttLocalClient(threading.Thread):
 
-    def __init__(self, client_id=None, host='localhost', port=1883, subscription_paths=None):
+    def __init__(self, client_id=None, host='localhost', port=1883, subscription_paths=None, log_publish=True):
         threading.Thread.__init__(self)
+        self.log_publish = log_publish
         self.host = host
         self.port = port
         self.client_id = client_id
@@ -18,8 +22,18 @@ class MqttLocalClient(threading.Thread):
         self.callback = None
 
     def publish(self, topic, payload, ):
-        print('[MQTT_CLIENT] publish to ' + topic + ' payload: ' + payload)
-        self.client.publish(topic, payload)
+        if self.log_publish:
+            print('[MQTT_CLIENT] publish to {} payload: {}'.format(topic, payload))
+        info = self.client.publish(topic, payload)
+        metrics.increment('mqtt/published')
+        return info
+
+    def is_connected(self):
+        return self.client.is_connected()
+
+    def get_queue_depth(self):
+        # packets handed to paho and not yet written, messages not yet acknowledged
+        return len(getattr(self.client, '_out_packet', ())) + len(getattr(self.client, '_out_messages', ()))
 
     def publish_on_many_topics(self, topics, payload):
         for topic in topics:
@@ -48,6 +62,29 @@ class MqttLocalClient(threading.Thread):
             self.client.subscribe(path, qos=qos)
             time.sleep(1)
 
+    # Runs the paho network loop on an asyncio event loop instead of the loop_start() thread
+    def start_asyncio(self, loop):
+        print('[MQTT_CLIENT] connecting to mqtt (asyncio) -> ' + self.host + ':' + str(self.port))
+        self.client.on_message = self.on_message
+        self.client.on_socket_open = lambda client, userdata, sock: loop.add_reader(sock, client.loop_read)
+        self.client.on_socket_close = lambda client, userdata, sock: loop.remove_reader(sock)
+        self.client.on_socket_register_write = lambda client, userdata, sock: loop.add_writer(sock, client.loop_write)
+        self.client.on_socket_unregister_write = lambda client, userdata, sock: loop.remove_writer(sock)
+        self.client.connect(self.host, self.port, 60)
+        for path in self.subscription_paths or []:
+            print('[MQTT_CLIENT] subscribe to ' + path)
+            self.client.subscribe(path, qos=1)
+        return loop.create_task(self.loop_misc_async())
+
+    async def loop_misc_async(self):
+        while True:
+            if self.client.loop_misc() == mqtt.MQTT_ERR_NO_CONN:
+                try:
+                    self.client.reconnect()
+                except Exception as e:
+                    print('[MQTT_CLIENT] reconnect failed: ' + str(e))
+            await asyncio.sleep(1)
+
     def set_callback(self, callback):
         self.callback = callback
 
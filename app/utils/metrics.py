@@ -0,0 +1,101 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# histogram bucket upper bounds, in milliseconds
+DEFAULT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+class Histogram:
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        # upper bound of the bucket holding the percentile, the max for the overflow bucket
+        if self.count == 0:
+            return None
+        rank = self.count * percent / 100.0
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count > 0:
+                return self.buckets[index] if index < len(self.buckets) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 3),
+            'min': None if self.min is None else round(self.min, 3),
+            'max': None if self.max is None else round(self.max, 3),
+            'mean': round(self.sum / self.count, 3) if self.count else None,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99)
+        }
+
+
+# In-process aggregation of the polling loop metrics.
+# Names are "/" separated ("cc1/read", "cycle/duration") and become the telemetry topic suffix.
+class Metrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = dict()
+        self.counters = dict()
+        self.gauges = dict()
+
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, (time.perf_counter() - start) * 1000.0)
+
+    def collect(self):
+        # histograms restart on every collection, counters are cumulative
+        with self.lock:
+            histograms = self.histograms
+            self.histograms = dict()
+            collected = {name: histogram.snapshot() for name, histogram in histograms.items()}
+            for name, value in self.counters.items():
+                collected[name] = value
+            for name, value in self.gauges.items():
+                collected[name] = value
+        return collected
+
+
+# shared by the readers, the MQTT client and the polling loop
+metrics = Metrics()
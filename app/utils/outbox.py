@@ -0,0 +1,162 @@
+import sqlite3
+import threading
+import time
+
+from .metrics import metrics
+
+DEFAULT_MAX_BYTES = 50 * 1024 * 1024
+DEFAULT_REPLAY_RATE = 100  # messages per second
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_MAX_QUEUE = 1000  # messages waiting in paho before the client counts as backlogged
+
+
+# Append-only SQLite (WAL) queue of the messages that could not be published.
+# Payloads are kept verbatim, so the samples are replayed with their original timestamps.
+class Outbox:
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS messages ('
+                                'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                                'created REAL NOT NULL, '
+                                'topic TEXT NOT NULL, '
+                                'payload TEXT NOT NULL, '
+                                'size INTEGER NOT NULL)')
+        self.count, self.bytes = self.connection.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM messages').fetchone()
+
+        self.stored = 0
+        self.evicted = 0
+
+    def put(self, topic, payload):
+        size = len(topic) + len(payload)
+        with self.lock:
+            self.connection.execute('INSERT INTO messages (created, topic, payload, size) VALUES (?, ?, ?, ?)',
+                                    (time.time(), topic, payload, size))
+            self.count += 1
+            self.bytes += size
+            self.stored += 1
+            if self.bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        # oldest first, until the backlog fits again; freed pages are reused by the next inserts
+        while self.bytes > self.max_bytes and self.count > 0:
+            rows = self.connection.execute('SELECT id, size FROM messages ORDER BY id LIMIT 100').fetchall()
+            freed = 0
+            last_id = None
+            for message_id, size in rows:
+                if self.bytes - freed <= self.max_bytes:
+                    break
+                freed += size
+                last_id = message_id
+            deleted = self.connection.execute('DELETE FROM messages WHERE id <= ?', (last_id,)).rowcount
+            self.count -= deleted
+            self.bytes -= freed
+            self.evicted += deleted
+
+    def peek(self, limit):
+        # [(id, topic, payload)], oldest first
+        with self.lock:
+            return self.connection.execute('SELECT id, topic, payload FROM messages ORDER BY id LIMIT ?',
+                                           (limit,)).fetchall()
+
+    def delete(self, last_id):
+        # drops the messages up to last_id included, once they are published
+        with self.lock:
+            count, size = self.connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM messages '
+                                                  'WHERE id <= ?', (last_id,)).fetchone()
+            self.connection.execute('DELETE FROM messages WHERE id <= ?', (last_id,))
+            self.count -= count
+            self.bytes -= size
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def __str__(self):
+        return 'OUTBOX: backlog={} bytes={} stored={} evicted={}'.format(self.count, self.bytes, self.stored,
+                                                                        self.evicted)
+
+
+# Publishes through the MQTT client while the broker is reachable and the client keeps up,
+# into the outbox otherwise. Once something is buffered every new message follows it,
+# and the replay drains the outbox in order, in batches, at most at replay_rate messages per second.
+class StoreAndForward:
+
+    def __init__(self, mqtt_client, outbox, replay_rate=DEFAULT_REPLAY_RATE, batch_size=DEFAULT_BATCH_SIZE,
+                 max_queue=DEFAULT_MAX_QUEUE):
+        self.mqtt_client = mqtt_client
+        self.outbox = outbox
+        self.replay_rate = replay_rate
+        self.batch_size = batch_size
+        self.max_queue = max_queue
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    @property
+    def client_id(self):
+        return self.mqtt_client.client_id
+
+    def is_available(self):
+        return self.mqtt_client.is_connected() and self.mqtt_client.get_queue_depth() < self.max_queue
+
+    def publish(self, topic, payload):
+        with self.lock:
+            if self.outbox.count == 0 and self.is_available():
+                info = self.mqtt_client.publish(topic, payload)
+                if info is None or info.rc == 0:
+                    return
+            self.outbox.put(topic, payload)
+            metrics.increment('outbox/stored')
+
+    def get_queue_depth(self):
+        return self.mqtt_client.get_queue_depth()
+
+    def replay(self):
+        # one batch, stops at the first message the client refuses
+        with self.lock:
+            sent = 0
+            last_id = None
+            for message_id, topic, payload in self.outbox.peek(self.batch_size):
+                if not self.is_available():
+                    break
+                info = self.mqtt_client.publish(topic, payload)
+                if info is not None and info.rc != 0:
+                    break
+                sent += 1
+                last_id = message_id
+
+            if last_id is not None:
+                self.outbox.delete(last_id)
+                metrics.increment('outbox/replayed', sent)
+            return sent
+
+    def step(self):
+        # replays a batch if possible, returns the seconds to wait before the next one
+        sent = 0
+        if self.outbox.count > 0 and self.is_available():
+            sent = self.replay()
+        return sent / float(self.replay_rate) if sent else 1.0
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.stopped.wait(self.step())
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='outbox', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.outbox.close()
@@ -0,0 +1,244 @@
+import json
+import mmap
+import os
+import threading
+import time
+
+RESOLUTION_RAW = 'raw'
+RESOLUTION_MINUTE = '1m'
+RESOLUTION_HOUR = '1h'
+RESOLUTIONS = (RESOLUTION_RAW, RESOLUTION_MINUTE, RESOLUTION_HOUR)
+
+DEFAULT_CAPACITY = 128  # series
+DEFAULT_RAW_SLOTS = 720  # samples per series, 2 hours at 10 s
+DEFAULT_MINUTE_SLOTS = 1440  # 1 day
+DEFAULT_HOUR_SLOTS = 2160  # 90 days
+
+DOUBLE_SIZE = 8
+# bucket start, min, max, sum, count
+ROLLUP_WIDTH = 5
+
+
+def open_array(path, size):
+    # zero-filled file of size doubles mapped in memory, a file of another size is reset
+    with open(path, 'a+b') as f:
+        if os.fstat(f.fileno()).st_size != size * DOUBLE_SIZE:
+            f.truncate(0)
+            f.truncate(size * DOUBLE_SIZE)
+        memory = mmap.mmap(f.fileno(), size * DOUBLE_SIZE)
+    return memory, memoryview(memory).cast('d')
+
+
+# Last raw samples of every series, one ring per series: [head, t0, v0, t1, v1, ...]
+class RawTier:
+
+    def __init__(self, path, capacity, slots):
+        self.slots = slots
+        self.width = 1 + 2 * slots
+        self.memory, self.values = open_array(path, capacity * self.width)
+
+    def add(self, row, timestamp, value):
+        values = self.values
+        base = row * self.width
+        head = int(values[base])
+        index = base + 1 + 2 * (head % self.slots)
+        values[index] = timestamp
+        values[index + 1] = value
+        values[base] = head + 1
+
+    def query(self, row, start, end):
+        # [[timestamp, value]], oldest first
+        values = self.values
+        base = row * self.width
+        head = int(values[base])
+        samples = list()
+        for position in range(max(0, head - self.slots), head):
+            index = base + 1 + 2 * (position % self.slots)
+            if start <= values[index] <= end:
+                samples.append([values[index], values[index + 1]])
+        return samples
+
+    def close(self):
+        self.values.release()
+        self.memory.close()
+
+
+# Fixed-size buckets of min/max/sum/count, slot = bucket number modulo slots.
+# A slot holding an older bucket start is stale and restarted by the next sample; a late sample of
+# a bucket older than the one in its slot is not kept.
+class RollupTier:
+
+    def __init__(self, path, capacity, slots, resolution):
+        self.slots = slots
+        self.resolution = resolution
+        self.width = ROLLUP_WIDTH * slots
+        self.memory, self.values = open_array(path, capacity * self.width)
+
+    def add(self, row, timestamp, value):
+        values = self.values
+        bucket = int(timestamp // self.resolution)
+        index = row * self.width + ROLLUP_WIDTH * (bucket % self.slots)
+        start = bucket * self.resolution
+        if values[index + 4] and start < values[index]:
+            # out of order or replayed, its bucket was overwritten already
+            return
+        if values[index] != start or values[index + 4] == 0:
+            values[index] = start
+            values[index + 1] = value
+            values[index + 2] = value
+            values[index + 3] = value
+            values[index + 4] = 1
+            return
+        if value < values[index + 1]:
+            values[index + 1] = value
+        if value > values[index + 2]:
+            values[index + 2] = value
+        values[index + 3] += value
+        values[index + 4] += 1
+
+    def query(self, row, start, end):
+        # [[bucket start, min, max, mean, count]], oldest first, empty buckets skipped
+        values = self.values
+        base = row * self.width
+        last = int(end // self.resolution)
+        first = max(int(start // self.resolution), last - self.slots + 1)
+        buckets = list()
+        for bucket in range(first, last + 1):
+            index = base + ROLLUP_WIDTH * (bucket % self.slots)
+            count = values[index + 4]
+            if count and values[index] == bucket * self.resolution:
+                buckets.append([values[index], values[index + 1], values[index + 2],
+                                values[index + 3] / count, int(count)])
+        return buckets
+
+    def close(self):
+        self.values.release()
+        self.memory.close()
+
+
+# Local history of the numeric values read by Sensors: the last raw samples, then 1-minute and
+# 1-hour rollups kept up to date sample by sample. Each tier is a memory-mapped file of doubles
+# sized from the series capacity and its slot count, so the disk usage is fixed upfront.
+class TimeSeriesStore:
+
+    def __init__(self, path, capacity=DEFAULT_CAPACITY, raw_slots=DEFAULT_RAW_SLOTS,
+                 minute_slots=DEFAULT_MINUTE_SLOTS, hour_slots=DEFAULT_HOUR_SLOTS):
+        self.path = path
+        self.capacity = capacity
+        self.layout = {'capacity': capacity, 'raw': raw_slots, RESOLUTION_MINUTE: minute_slots,
+                       RESOLUTION_HOUR: hour_slots}
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+        # series name -> row, the files are reset when the layout changes
+        self.series = dict()
+        index = self.read_index()
+        if index.get('layout') == self.layout:
+            self.series = {name: row for row, name in enumerate(index['series'])}
+        else:
+            for name in ('raw', 'minute', 'hour'):
+                if os.path.exists(self.get_tier_path(name)):
+                    os.remove(self.get_tier_path(name))
+
+        self.raw = RawTier(self.get_tier_path('raw'), capacity, raw_slots)
+        self.rollups = {
+            RESOLUTION_MINUTE: RollupTier(self.get_tier_path('minute'), capacity, minute_slots, 60),
+            RESOLUTION_HOUR: RollupTier(self.get_tier_path('hour'), capacity, hour_slots, 3600),
+        }
+        self.tiers = list(self.rollups.values())
+
+        self.samples = 0
+        self.dropped = 0
+
+    def get_tier_path(self, name):
+        return os.path.join(self.path, '{}.bin'.format(name))
+
+    def read_index(self):
+        try:
+            with open(os.path.join(self.path, 'index.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    def write_index(self):
+        names = sorted(self.series, key=self.series.get)
+        temporary = os.path.join(self.path, 'index.json.tmp')
+        with open(temporary, 'w') as f:
+            json.dump({'layout': self.layout, 'series': names}, f)
+        os.replace(temporary, os.path.join(self.path, 'index.json'))
+
+    def get_row(self, name):
+        row = self.series.get(name)
+        if row is None and len(self.series) < self.capacity:
+            row = self.series[name] = len(self.series)
+            self.write_index()
+        return row
+
+    def add(self, name, timestamp, value):
+        row = self.get_row(name)
+        if row is None:
+            self.dropped += 1
+            return
+        self.raw.add(row, timestamp, value)
+        for tier in self.tiers:
+            tier.add(row, timestamp, value)
+        self.samples += 1
+
+    def record(self, data):
+        # every number of a SensorValue, as "<device>/<key>"
+        with self.lock:
+            for key, value in data.value.items():
+                if isinstance(value, (int, float)) and key != 'type':
+                    self.add('{}/{}'.format(data.key, key), data.timestamp, value)
+
+    def get_names(self, names=None):
+        # "<device>/<key>" or "<device>" for all its series, everything when None
+        if names is None:
+            return sorted(self.series)
+        if isinstance(names, str):
+            names = [names]
+        selected = list()
+        for name in names:
+            if name in self.series:
+                selected.append(name)
+            elif '/' not in name:
+                selected.extend(sorted(series for series in self.series if series.startswith(name + '/')))
+        return selected
+
+    def get_resolution(self, start, now):
+        # the finest rollup still covering start
+        for resolution in (RESOLUTION_MINUTE, RESOLUTION_HOUR):
+            tier = self.rollups[resolution]
+            if start >= now - tier.resolution * tier.slots:
+                return resolution
+        return RESOLUTION_HOUR
+
+    def query(self, names=None, start=None, end=None, resolution=None):
+        # {'resolution': ..., 'series': {name: rows}}, rows of [t, value] for raw,
+        # of [bucket start, min, max, mean, count] for the rollups
+        now = time.time()
+        end = now if end is None else float(end)
+        start = end - 3600 if start is None else float(start)
+        if not resolution:
+            resolution = self.get_resolution(start, now)
+        if resolution not in RESOLUTIONS:
+            raise ValueError('Unsupported resolution {}. Choose among {}'.format(resolution, ', '.join(RESOLUTIONS)))
+        tier = self.raw if resolution == RESOLUTION_RAW else self.rollups[resolution]
+
+        with self.lock:
+            series = {name: tier.query(self.series[name], start, end) for name in self.get_names(names)}
+        return {'start': start, 'end': end, 'resolution': resolution, 'series': series}
+
+    def flush(self):
+        with self.lock:
+            for tier in [self.raw] + self.tiers:
+                tier.memory.flush()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            for tier in [self.raw] + self.tiers:
+                tier.close()
+
+    def __str__(self):
+        return 'HISTORY: series={} samples={} dropped={}'.format(len(self.series), self.samples, self.dropped)
@@ -0,0 +1,78 @@
+# Offline benchmark of the local history.
+#
+# Fills a store with days of samples of charge-controller-like series, then times the recording
+# of one more reading and the queries served on /data:
+#
+#   python -m benchmarks.bench_history
+#   python -m benchmarks.bench_history --days 7 --series 60 --interval 10
+import argparse
+import math
+import random
+import tempfile
+import time
+
+from app.sensor.reader import SensorValue
+from app.utils import timeseries
+
+
+def build_readings(devices, fields, interval, days, end):
+    start = end - days * 86400
+    steps = int(days * 86400 / interval)
+    rng = random.Random(1)
+    for step in range(steps):
+        timestamp = start + step * interval
+        for device in devices:
+            values = {'type': 'charge_controller'}
+            for index, field in enumerate(fields):
+                values[field] = round(24 + 4 * math.sin(timestamp / 3600.0 + index) + rng.random(), 2)
+            yield SensorValue(device, values, timestamp)
+
+
+def timed(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function()
+    return (time.perf_counter() - start) * 1000.0 / repeat, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the local time-series store')
+    parser.add_argument('--days', type=float, default=7)
+    parser.add_argument('--series', type=int, default=60, help='numeric values per polling cycle')
+    parser.add_argument('--interval', type=float, default=10, help='seconds between readings')
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    devices = ['cc1', 'cc2']
+    fields = ['field{}'.format(index) for index in range(max(1, args.series // len(devices)))]
+    end = int(time.time())
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = timeseries.TimeSeriesStore(directory)
+        start = time.perf_counter()
+        for data in build_readings(devices, fields, args.interval, args.days, end):
+            store.record(data)
+        elapsed = time.perf_counter() - start
+        print('recorded {} samples in {:.1f}s, {:.1f} us per sample'.format(
+            store.samples, elapsed, elapsed * 1e6 / store.samples))
+
+        reading = next(build_readings(devices, fields, args.interval, args.interval / 86400.0, end + args.interval))
+        ms, _ = timed(lambda: store.record(reading), args.repeat)
+        print('{:<34} {:>9.3f} ms'.format('record one reading', ms))
+
+        week = end - 7 * 86400
+        for label, names, start, resolution in (
+                ('one series, 1 week at 1h', ['cc1/field0'], week, timeseries.RESOLUTION_HOUR),
+                ('one device, 1 week at 1h', ['cc1'], week, timeseries.RESOLUTION_HOUR),
+                ('all series, 1 week at 1h', None, week, timeseries.RESOLUTION_HOUR),
+                ('one series, 1 day at 1m', ['cc1/field0'], end - 86400, timeseries.RESOLUTION_MINUTE),
+                ('one series, raw window', ['cc1/field0'], end - 7200, timeseries.RESOLUTION_RAW)):
+            ms, result = timed(lambda: store.query(names, start, end, resolution), args.repeat)
+            rows = sum(len(rows) for rows in result['series'].values())
+            print('{:<34} {:>9.3f} ms {:>7} rows'.format(label, ms, rows))
+
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
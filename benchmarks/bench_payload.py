@@ -0,0 +1,141 @@
+# Offline benchmark of the payload encodings.
+#
+# Decodes the simulator registers and a fake SMBus reading into SensorValue snapshots, then compares
+# the bytes on the wire (topics included), the encoding time and, with tracemalloc, the memory allocated
+# per cycle by the JSON and binary publish modes:
+#
+#   python -m benchmarks.bench_payload
+#   python -m benchmarks.bench_payload --repeat 20000
+import argparse
+import json
+import time
+import tracemalloc
+
+from app.sensor import mcu_arduino_reader, publisher
+from app.sensor.binary_payload import BinaryDecoder
+from app.sensor.reader import SensorValue
+from app.sensor.register_map import CHARGE_CONTROLLER_MAP, RELAY_BOX_MAP
+from benchmarks.fake_smbus import FakeSMBus
+from benchmarks.simulator import CHARGE_CONTROLLER_REGISTERS, RELAY_BOX_REGISTERS
+
+TIMESTAMP = 1700000000
+
+
+class RecordingClient:
+    # keeps the last messages instead of sending them
+
+    def __init__(self, client_id='CHARGE_CONTROLLER'):
+        self.client_id = client_id
+        self.messages = list()
+
+    def publish(self, topic, payload):
+        self.messages.append((topic, payload))
+
+
+class CountingClient:
+    # keeps nothing, so that tracemalloc only sees the publish path
+
+    def __init__(self, client_id='CHARGE_CONTROLLER'):
+        self.client_id = client_id
+        self.published_bytes = 0
+
+    def publish(self, topic, payload):
+        self.published_bytes += len(payload)
+
+
+class LegacyPublisher(publisher.Publisher):
+    # field mode as it was: a list of dicts per reading, json.dumps and a formatted topic per field
+
+    def publish_fields(self, data):
+        for value in data.stocazzo_format():
+            self.mqtt_client.publish(self.get_field_topic(value['sensor']), json.dumps(value))
+
+
+def build_readings():
+    cc = {'type': 'charge_controller'}
+    CHARGE_CONTROLLER_MAP.decode(CHARGE_CONTROLLER_REGISTERS, cc)
+    rb = {'type': 'relay_box'}
+    RELAY_BOX_MAP.decode(RELAY_BOX_REGISTERS, rb)
+    mcu = mcu_arduino_reader.McuArduinoReader('mcu', bus=FakeSMBus(seed=1)).read()
+    return [SensorValue('cc1', cc, TIMESTAMP), SensorValue('rb', rb, TIMESTAMP),
+            SensorValue('mcu', mcu.value, TIMESTAMP)]
+
+
+def measure(mode, readings, repeat, publisher_class=publisher.Publisher, label=None):
+    client = RecordingClient()
+    publisher_ = publisher_class(client, [mode])
+
+    # first cycle: schema announcements, then the steady state
+    for data in readings:
+        publisher_.publish(data)
+    publisher_.flush()
+    announced = sum(len(topic) + len(payload) for topic, payload in client.messages if '/schemas/' in topic)
+
+    client.messages = list()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        client.messages.clear()
+        for data in readings:
+            publisher_.publish(data)
+        publisher_.flush()
+    elapsed = (time.perf_counter() - start) * 1e6 / repeat
+
+    payload_bytes = sum(len(payload) for _, payload in client.messages)
+    wire_bytes = sum(len(topic) + len(payload) for topic, payload in client.messages)
+    print('{:<13} {:>9} {:>9} {:>11} {:>10.1f} {:>10} {:>10.1f} {:>9}'.format(
+        label or mode, len(client.messages), payload_bytes, wire_bytes, elapsed, announced or '-',
+        *measure_allocations(publisher_class, mode, readings, repeat)))
+    return client.messages
+
+
+def measure_allocations(publisher_class, mode, readings, cycles):
+    # (peak KiB allocated while publishing a cycle, bytes still held after all the cycles)
+    publisher_ = publisher_class(CountingClient(), [mode])
+    for data in readings:
+        publisher_.publish(data)
+    publisher_.flush()
+
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    for _ in range(cycles):
+        for data in readings:
+            publisher_.publish(data)
+        publisher_.flush()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (peak - baseline) / 1024.0, current - baseline
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the JSON and binary payloads of one polling cycle')
+    parser.add_argument('--repeat', type=int, default=5000)
+    args = parser.parse_args()
+
+    readings = build_readings()
+    print('{} values in {} devices per cycle'.format(sum(len(data.value) - 1 for data in readings), len(readings)))
+    print('{:<13} {:>9} {:>9} {:>11} {:>10} {:>10} {:>10} {:>9}'.format(
+        'mode', 'messages', 'payload B', 'with topic', 'encode us', 'schemas B', 'peak KiB', 'held B'))
+    legacy = measure(publisher.PUBLISH_MODE_FIELD, readings, args.repeat, LegacyPublisher, 'field-legacy')
+    for mode in publisher.PUBLISH_MODES:
+        messages = measure(mode, readings, args.repeat)
+        if mode == publisher.PUBLISH_MODE_FIELD and messages != legacy:
+            print('  field payloads differ from the legacy ones')
+
+    # the decoder gives back the device snapshots
+    decoder = BinaryDecoder()
+    client = RecordingClient()
+    publisher_ = publisher.Publisher(client, [publisher.PUBLISH_MODE_BINARY])
+    for data in readings:
+        publisher_.publish(data)
+    for topic, payload in client.messages:
+        if '/schemas/' in topic:
+            decoder.add_schema(payload)
+    for topic, payload in messages:
+        snapshot = decoder.decode(payload)
+        expected = publisher_.get_snapshot([data for data in readings if data.key == snapshot['device']][0])
+        status = 'ok' if json.dumps(snapshot, sort_keys=True) == json.dumps(expected, sort_keys=True) else 'MISMATCH'
+        print('decoded {} {} bytes: {}'.format(snapshot['device'], len(payload), status))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+# Offline benchmark of the acquisition pipeline.
+#
+# Starts a local pymodbus server with the charge controller and relay box register maps and a fake
+# SMBus serving the Arduino map, then drives the readers and Sensors.read end to end:
+#
+#   python -m benchmarks.bench_pipeline --cycles 500
+#   python -m benchmarks.bench_pipeline --modbus-latency 0.02 --i2c-latency 0.0005 --set CONCURRENT_READING=1
+#   python -m benchmarks.bench_pipeline --target cc --modbus-baudrate 9600 --set MODBUS_MAX_GAP=80 --set REGISTER_CACHE_TTL=0
+#   python -m benchmarks.bench_pipeline --transport rtu --modbus-baudrate 9600
+#   python -m benchmarks.bench_pipeline --target mcu --set MCU_I2C_MODE=block --i2c-failure-rate 0.01
+import argparse
+import configparser
+import contextlib
+import os
+import tempfile
+import time
+import tracemalloc
+
+from app.sensor import mcu_arduino_reader, modbus_reader, read_planner
+from app.sensor.modbus_pool import ModbusConnectionPool
+from app.sensor.modbus_rtu import RtuBusPool
+from app.sensor.sensors import Sensors
+from benchmarks.fake_smbus import FakeSMBus
+from benchmarks.rtu_slave import PtyRtuSlave
+from benchmarks.simulator import ModbusSimulator, DEFAULT_SIMULATOR_HOST, DEFAULT_SIMULATOR_PORT
+
+TARGETS = ('cc', 'rb', 'mcu', 'sensors')
+
+
+class NullMqttClient:
+    # counts what Sensors would publish, without a broker
+
+    def __init__(self, client_id='BENCH'):
+        self.client_id = client_id
+        self.published = 0
+        self.published_bytes = 0
+
+    def set_callback(self, callback):
+        pass
+
+    def publish(self, topic, payload):
+        self.published += 1
+        self.published_bytes += len(topic) + len(payload)
+
+    def is_connected(self):
+        return True
+
+    def get_queue_depth(self):
+        return 0
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+def percentile(values, percent):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(len(ordered) * percent / 100.0 + 0.5)) - 1)
+    return ordered[max(0, index)]
+
+
+def run_cycle(cycle):
+    try:
+        cycle()
+        return True
+    except Exception:
+        return False
+
+
+def measure(name, cycle, cycles, warmup=5):
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(warmup):
+            run_cycle(cycle)
+
+        failures = 0
+        latencies = list()
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        for _ in range(cycles):
+            start = time.perf_counter()
+            if not run_cycle(cycle):
+                failures += 1
+            latencies.append(time.perf_counter() - start)
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+
+        # separate pass: tracing slows the cycle down and must not skew the timings.
+        # The blocks allocated by a cycle and still held after it are counted once the cycle is done
+        peaks = list()
+        retained = list()
+        tracemalloc.start()
+        for _ in range(min(cycles, 50)):
+            tracemalloc.clear_traces()
+            run_cycle(cycle)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            retained.append(len(tracemalloc.take_snapshot().traces))
+        tracemalloc.stop()
+
+    print('{:<10} {:>9.1f} {:>9.3f} {:>9.3f} {:>9.3f} {:>11.1f} {:>12.1f} {:>9}'.format(
+        name,
+        cycles / wall,
+        percentile(latencies, 50) * 1000.0,
+        percentile(latencies, 99) * 1000.0,
+        cpu / cycles * 1000.0,
+        sum(peaks) / len(peaks) / 1024.0,
+        sum(retained) / len(retained),
+        failures))
+
+    return {
+        'cycles_per_sec': cycles / wall,
+        'p50_ms': percentile(latencies, 50) * 1000.0,
+        'p99_ms': percentile(latencies, 99) * 1000.0,
+        'cpu_ms': cpu / cycles * 1000.0,
+        'peak_kib': sum(peaks) / len(peaks) / 1024.0,
+        'retained_blocks': sum(retained) / len(retained),
+        'failures': failures
+    }
+
+
+def write_config(path, host, port, overrides):
+    configs = configparser.ConfigParser()
+    configs['DEFAULT'] = {
+        'READING_INTERVAL': '10',
+        'MODBUS_IP': host,
+        'MODBUS_PORT': str(port),
+        'CHARGE_CONTROLLER_1_MODBUS_UNIT': str(modbus_reader.DEFAULT_CHARGE_CONTROLLER_UNIT),
+        'CHARGE_CONTROLLER_2_MODBUS_UNIT': '0',
+        'RELAY_BOX_MODBUS_UNIT': str(modbus_reader.DEFAULT_RELAY_BOX_UNIT),
+        'MCU_I2C_CHANNEL': '1',
+        'MCU_ARDUINO_I2C_ADDRESS': '0',
+        'DUMMY_DATA': '0',
+        'TELEMETRY_INTERVAL': '0',
+        # the readers reset by each cycle are due at once, not on the next tick
+        'SCHEDULE_ALIGN': '0',
+        'OUTBOX_PATH': '',
+        'HISTORY_PATH': '',
+        'ANALYTICS_PATH': '',
+    }
+    for key, value in overrides.items():
+        configs['DEFAULT'][key] = value
+    with open(path, 'w') as configfile:
+        configs.write(configfile)
+
+
+def build_sensors(config_file, bus, overrides):
+    sensors = Sensors(config_file, NullMqttClient())
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        sensors.init_properties()
+        sensors.init_sensors()
+
+    sensors.mcu = mcu_arduino_reader.McuArduinoReader(
+        'mcu',
+        bus=bus,
+        i2c_mode=overrides.get('MCU_I2C_MODE', mcu_arduino_reader.I2C_MODE_BYTE)
+    )
+    return sensors
+
+
+def sensors_cycle(sensors):
+    def cycle():
+        # every reader and group is due on every cycle
+        readers = sensors.get_readers()
+        sensors.scheduler.set_readers(readers, reset=[reader.id for reader in readers])
+        sensors.read()
+    return cycle
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the acquisition pipeline against local simulators')
+    parser.add_argument('--cycles', type=int, default=200)
+    parser.add_argument('--target', choices=TARGETS, action='append')
+    parser.add_argument('--host', default=DEFAULT_SIMULATOR_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_SIMULATOR_PORT)
+    parser.add_argument('--transport', choices=('tcp', 'rtu'), default='tcp',
+                        help='Modbus TCP simulator or RTU slave on a pseudo terminal')
+    parser.add_argument('--modbus-latency', type=float, default=0.0, help='seconds per Modbus request')
+    parser.add_argument('--modbus-baudrate', type=int, default=None, help='RS485 speed behind the gateway, e.g. 9600')
+    parser.add_argument('--i2c-latency', type=float, default=0.0, help='seconds per I2C transaction')
+    parser.add_argument('--i2c-failure-rate', type=float, default=0.0, help='probability of an I2C error')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help='Sensors configuration override, e.g. CONCURRENT_READING=1')
+    args = parser.parse_args()
+
+    overrides = dict(item.split('=', 1) for item in args.set)
+    targets = args.target or list(TARGETS)
+
+    if args.transport == 'rtu':
+        simulator = PtyRtuSlave(baudrate=args.modbus_baudrate, response_delay=args.modbus_latency).start()
+        pool = RtuBusPool(args.modbus_baudrate or 9600)
+        # readers of the slave port, the sensors configuration points at it too
+        address, port = simulator.port, None
+        overrides.setdefault('MODBUS_DEVICES', 'cc1=charge_controller@{0}/{1}, rb=relay_box@{0}/{2}'.format(
+            simulator.port, modbus_reader.DEFAULT_CHARGE_CONTROLLER_UNIT, modbus_reader.DEFAULT_RELAY_BOX_UNIT))
+        overrides.setdefault('RS485_BAUDRATE', str(args.modbus_baudrate or 9600))
+    else:
+        simulator = ModbusSimulator(args.host, args.port, latency=args.modbus_latency,
+                                    baudrate=args.modbus_baudrate).start()
+        pool = ModbusConnectionPool()
+        address, port = args.host, args.port
+    bus = FakeSMBus(latency=args.i2c_latency, failure_rate=args.i2c_failure_rate, seed=1)
+
+    print('{:<10} {:>9} {:>9} {:>9} {:>9} {:>11} {:>12} {:>9}'.format(
+        'target', 'cycles/s', 'p50 ms', 'p99 ms', 'cpu ms', 'peak KiB', 'retained blk', 'failures'))
+
+    try:
+        max_gap = int(overrides.get('MODBUS_MAX_GAP', read_planner.DEFAULT_MAX_GAP))
+        cache_ttl = int(overrides.get('REGISTER_CACHE_TTL', modbus_reader.DEFAULT_CACHE_TTL))
+        if 'cc' in targets:
+            reader = modbus_reader.ModbusChargeControllerReader('cc1', address, port=port, pool=pool,
+                                                                max_gap=max_gap, cache_ttl=cache_ttl)
+            measure('cc', reader.read, args.cycles)
+            print('  requests {}, cache {}'.format(reader.last_plan, reader.cache))
+
+        if 'rb' in targets:
+            reader = modbus_reader.ModbusRelayBoxReader('rb', address, port=port, pool=pool, max_gap=max_gap,
+                                                 cache_ttl=cache_ttl)
+            measure('rb', reader.read, args.cycles)
+            print('  requests {}, cache {}'.format(reader.last_plan, reader.cache))
+
+        if 'mcu' in targets:
+            reader = mcu_arduino_reader.McuArduinoReader(
+                'mcu', bus=bus, i2c_mode=overrides.get('MCU_I2C_MODE', mcu_arduino_reader.I2C_MODE_BYTE))
+            measure('mcu', reader.read, args.cycles)
+
+        if 'sensors' in targets:
+            with tempfile.TemporaryDirectory() as directory:
+                config_file = os.path.join(directory, 'config.ini')
+                write_config(config_file, args.host, args.port, overrides)
+                sensors = build_sensors(config_file, bus, overrides)
+                measure('sensors', sensors_cycle(sensors), args.cycles)
+                print('published {} messages, {} bytes'.format(
+                    sensors.mqtt_client.published, sensors.mqtt_client.published_bytes))
+                sensors.modbus_pool.close_all()
+                sensors.rtu_buses.close_all()
+    finally:
+        pool.close_all()
+        simulator.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+# Offline benchmark of the relay actuation path.
+#
+# Sends bursts of /actuators requests to Sensors against the local Modbus simulator (or the RTU slave on a
+# pseudo terminal) and measures the time from the request to its confirmed response, with the number of
+# commands coalesced per write_coils:
+#
+#   python -m benchmarks.bench_relays
+#   python -m benchmarks.bench_relays --burst 8 --window 20 --modbus-latency 0.01
+#   python -m benchmarks.bench_relays --transport rtu --modbus-baudrate 9600
+import argparse
+import contextlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from app.sensor import modbus_reader
+from app.sensor.sensors import Sensors
+from app.utils.metrics import metrics
+from benchmarks.bench_pipeline import NullMqttClient, percentile, write_config
+from benchmarks.rtu_slave import PtyRtuSlave
+from benchmarks.simulator import ModbusSimulator, DEFAULT_SIMULATOR_HOST, DEFAULT_SIMULATOR_PORT
+
+
+class Message:
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class ResponseClient(NullMqttClient):
+    # wakes the benchmark up on the command responses
+
+    def __init__(self, client_id='BENCH'):
+        super().__init__(client_id)
+        self.condition = threading.Condition()
+        # id -> (monotonic time, response)
+        self.responses = dict()
+        self.states = 0
+
+    def publish(self, topic, payload):
+        super().publish(topic, payload)
+        if topic.endswith('/state'):
+            self.states += 1
+        elif topic.endswith('/response'):
+            response = json.loads(payload)
+            with self.condition:
+                self.responses[response['id']] = (time.monotonic(), response)
+                self.condition.notify_all()
+
+
+def run_burst(sensors, client, burst, number):
+    # burst commands on different relays, each one toggling its relay
+    sent = dict()
+    for index in range(burst):
+        command_id = '{}-{}'.format(number, index)
+        value = (number + index) % 2 == 0
+        sent[command_id] = time.monotonic()
+        sensors.on_message_callback(Message('/actuators/BENCH/relay_{}/request'.format(index % 8 + 1),
+                                            json.dumps({'id': command_id, 'value': value}).encode()))
+
+    with client.condition:
+        client.condition.wait_for(lambda: all(command_id in client.responses for command_id in sent), 5)
+    latencies = list()
+    failures = 0
+    for command_id, start in sent.items():
+        received, response = client.responses.pop(command_id, (None, None))
+        if response is None or response['status'] != 'ok':
+            failures += 1
+        else:
+            latencies.append(received - start)
+    return latencies, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the relay commands against local simulators')
+    parser.add_argument('--bursts', type=int, default=100)
+    parser.add_argument('--burst', type=int, default=4, help='commands sent at once')
+    parser.add_argument('--window', type=int, default=20, help='coalescing window in ms')
+    parser.add_argument('--host', default=DEFAULT_SIMULATOR_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_SIMULATOR_PORT)
+    parser.add_argument('--transport', choices=('tcp', 'rtu'), default='tcp')
+    parser.add_argument('--modbus-latency', type=float, default=0.0, help='seconds per Modbus request')
+    parser.add_argument('--modbus-baudrate', type=int, default=None)
+    args = parser.parse_args()
+
+    overrides = {'RELAY_COALESCE_WINDOW': str(args.window)}
+    if args.transport == 'rtu':
+        simulator = PtyRtuSlave(baudrate=args.modbus_baudrate, response_delay=args.modbus_latency).start()
+        overrides['MODBUS_DEVICES'] = 'rb=relay_box@{}/{}'.format(simulator.port, modbus_reader.DEFAULT_RELAY_BOX_UNIT)
+        overrides['RS485_BAUDRATE'] = str(args.modbus_baudrate or 9600)
+    else:
+        simulator = ModbusSimulator(args.host, args.port, latency=args.modbus_latency,
+                                    baudrate=args.modbus_baudrate).start()
+        overrides['MODBUS_DEVICES'] = 'rb=relay_box@{}:{}/{}'.format(args.host, args.port,
+                                                                     modbus_reader.DEFAULT_RELAY_BOX_UNIT)
+
+    client = ResponseClient()
+    with tempfile.TemporaryDirectory() as directory:
+        config_file = os.path.join(directory, 'config.ini')
+        write_config(config_file, args.host, args.port, overrides)
+        sensors = Sensors(config_file, client)
+        latencies = list()
+        failures = 0
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            sensors.init_properties()
+            sensors.init_sensors()
+            metrics.collect()
+            for number in range(args.bursts):
+                burst_latencies, burst_failures = run_burst(sensors, client, args.burst, number)
+                latencies.extend(burst_latencies)
+                failures += burst_failures
+            sensors.commands.stop()
+            for actuator in sensors.actuators.values():
+                actuator.stop()
+        collected = metrics.collect()
+    simulator.stop()
+
+    actuator = list(sensors.actuators.values())[0]
+    print('{} bursts of {} commands, {}ms window, {}'.format(args.bursts, args.burst, args.window, args.transport))
+    print('{:<28} {:>9.2f} ms'.format('request to confirmed p50', percentile(latencies, 50) * 1000.0))
+    print('{:<28} {:>9.2f} ms'.format('request to confirmed p99', percentile(latencies, 99) * 1000.0))
+    print('{:<28} {:>9.2f} ms'.format('write + read back mean', collected.get('relays/write', {}).get('mean', 0)))
+    print('{:<28} {:>9.2f}'.format('commands per write', actuator.commands / max(1, actuator.batches)))
+    print('{:<28} {:>9}'.format('state messages', client.states))
+    print('{:<28} {:>9}'.format('failures', failures))
+
+
+if __name__ == '__main__':
+    main()
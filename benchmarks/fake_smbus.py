@@ -0,0 +1,69 @@
+import ctypes
+import random
+import struct
+import time
+
+from app.sensor import mcu_arduino_reader as mcu
+
+# plausible values for the Arduino register map
+DEFAULT_VALUES = {
+    mcu.TEMP_1_REGISTER: 21.5,
+    mcu.TEMP_2_REGISTER: 22.5,
+    mcu.TEMP_3_REGISTER: 23.5,
+    mcu.PRESSURE_IN_REGISTER: 2.1,
+    mcu.PRESSURE_OUT_REGISTER: 1.9,
+    mcu.PRESSURE_MIDDLE_REGISTER: 2.0,
+    mcu.CC_CURRENT_REGISTER: 4.2,
+    mcu.AC1_CURRENT_REGISTER: 1.1,
+    mcu.AC2_CURRENT_REGISTER: 0.9,
+    mcu.DHT11_AIR_REGISTER: 27.0,
+    mcu.DHT11_HUMIDITY_REGISTER: 55.0,
+}
+
+
+# SMBus stand-in serving the Arduino register map, with a per-transaction latency
+# and a random failure rate to exercise the retry and fallback paths
+class FakeSMBus:
+
+    def __init__(self, latency=0.0, failure_rate=0.0, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.transactions = 0
+        self.failures = 0
+
+        self.memory = bytearray(256)
+        for register, value in DEFAULT_VALUES.items():
+            struct.pack_into('<f', self.memory, register, value)
+        struct.pack_into('<h', self.memory, mcu.FLUX_IN_REGISTER, 301)
+        struct.pack_into('<h', self.memory, mcu.FLUX_OUT_REGISTER, 298)
+        struct.pack_into('<h', self.memory, mcu.WATER_LEVEL_REGISTER, 120)
+        self.memory[mcu.FLOODING_STATUS_REGISTER] = 0
+
+    def transaction(self):
+        self.transactions += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            self.failures += 1
+            raise OSError(121, 'Remote I/O error')
+
+    def read_byte_data(self, i2c_addr, register, force=None):
+        self.transaction()
+        return self.memory[register]
+
+    def read_i2c_block_data(self, i2c_addr, register, length, force=None):
+        self.transaction()
+        return list(self.memory[register:register + length])
+
+    def i2c_rdwr(self, *i2c_msgs):
+        self.transaction()
+        register = 0
+        for msg in i2c_msgs:
+            if msg.flags & 0x0001:  # I2C_M_RD
+                ctypes.memmove(msg.buf, bytes(self.memory[register:register + msg.len]), msg.len)
+            else:
+                register = list(msg)[0]
+
+    def close(self):
+        pass
@@ -0,0 +1,118 @@
+import os
+import select
+import struct
+import threading
+import time
+import tty
+
+from pymodbus.utilities import computeCRC
+
+from app.sensor.modbus_reader import DEFAULT_CHARGE_CONTROLLER_UNIT, DEFAULT_RELAY_BOX_UNIT
+from app.sensor.modbus_rtu import get_char_time
+from benchmarks.simulator import CHARGE_CONTROLLER_REGISTERS, RELAY_BOX_REGISTERS
+
+REQUEST_SIZE = 8  # unit, function, address, count, CRC of the read requests and of write_coil
+
+
+def get_request_size(buffer):
+    # write_coils: unit, function, address, count, byte count, the packed coils, CRC
+    if len(buffer) >= 7 and buffer[1] == 0x0F:
+        return 9 + buffer[6]
+    return REQUEST_SIZE
+
+
+def build_response(unit, payload):
+    frame = struct.pack('>B', unit) + payload
+    return frame + struct.pack('>H', computeCRC(frame))
+
+
+# Modbus RTU slave behind a pseudo terminal, serving the simulator register maps.
+# The RtuBusArbiter opens self.port as if it were the RS485 adapter; with a baud rate the slave
+# answers after the time both frames would take on the wire.
+class PtyRtuSlave:
+
+    def __init__(self, baudrate=None, response_delay=0.0, units=None):
+        self.units = units or {
+            DEFAULT_CHARGE_CONTROLLER_UNIT: {'hr': list(CHARGE_CONTROLLER_REGISTERS), 'co': []},
+            DEFAULT_RELAY_BOX_UNIT: {'hr': list(RELAY_BOX_REGISTERS), 'co': [False] * 8},
+        }
+        self.char_time = get_char_time(baudrate) if baudrate else 0.0
+        self.response_delay = response_delay
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+
+        self.requests = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def serve(self):
+        buffer = b''
+        while self.running:
+            if not select.select([self.master], [], [], 0.1)[0]:
+                continue
+            buffer += os.read(self.master, 256)
+
+            while len(buffer) >= REQUEST_SIZE and len(buffer) >= get_request_size(buffer):
+                size = get_request_size(buffer)
+                frame, buffer = buffer[:size], buffer[size:]
+                if struct.unpack('>H', frame[-2:])[0] != computeCRC(frame[:-2]):
+                    # resynchronise on the next byte
+                    buffer = frame[1:] + buffer
+                    continue
+
+                self.requests += 1
+                response = self.respond(frame)
+                if response is None:
+                    continue
+
+                delay = self.response_delay + self.char_time * (len(frame) + len(response))
+                if delay:
+                    time.sleep(delay)
+                os.write(self.master, response)
+
+    def respond(self, frame):
+        unit, function_code, address, count = struct.unpack('>BBHH', frame[:6])
+        if unit not in self.units:
+            # nobody on the bus answers
+            return None
+        tables = self.units[unit]
+
+        if function_code == 0x03 and address + count <= len(tables['hr']):
+            values = tables['hr'][address:address + count]
+            return build_response(unit, struct.pack('>BB', function_code, 2 * count) + struct.pack(
+                '>{}H'.format(count), *values))
+
+        if function_code == 0x01 and address + count <= len(tables['co']):
+            bits = tables['co'][address:address + count]
+            packed = bytes(sum(1 << i for i, bit in enumerate(bits[byte:byte + 8]) if bit)
+                           for byte in range(0, count, 8))
+            return build_response(unit, struct.pack('>BB', function_code, len(packed)) + packed)
+
+        if function_code == 0x05 and address < len(tables['co']):
+            # count holds the value, 0xFF00 on, 0x0000 off; the request is echoed
+            tables['co'][address] = count == 0xFF00
+            return build_response(unit, frame[1:6])
+
+        if function_code == 0x0F and address + count <= len(tables['co']):
+            packed = frame[7:-2]
+            for index in range(count):
+                tables['co'][address + index] = bool(packed[index >> 3] & (1 << (index & 7)))
+            return build_response(unit, frame[1:6])
+
+        # illegal data address
+        return build_response(unit, struct.pack('>BB', function_code | 0x80, 0x02))
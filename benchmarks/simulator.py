@@ -0,0 +1,85 @@
+import threading
+import time
+
+from pymodbus.datastore import ModbusSequentialDataBlock, ModbusSlaveContext, ModbusServerContext
+from pymodbus.server.sync import ModbusTcpServer
+
+from app.sensor.modbus_reader import DEFAULT_CHARGE_CONTROLLER_UNIT, DEFAULT_RELAY_BOX_UNIT
+from app.sensor.read_planner import REQUEST_BYTES, RESPONSE_BYTES
+
+DEFAULT_SIMULATOR_HOST = '127.0.0.1'
+DEFAULT_SIMULATOR_PORT = 5020
+
+# Morningstar holding registers 0-79: V_PU = 180 V, I_PU = 80 A
+CHARGE_CONTROLLER_REGISTERS = [0] * 80
+CHARGE_CONTROLLER_REGISTERS[0:4] = [180, 0, 80, 0]
+CHARGE_CONTROLLER_REGISTERS[24] = 2403  # battsV 13.2 V
+CHARGE_CONTROLLER_REGISTERS[26] = 2400  # battsSensedV
+CHARGE_CONTROLLER_REGISTERS[27] = 3277  # arrayV 18 V
+CHARGE_CONTROLLER_REGISTERS[28] = 4096  # battsI 10 A
+CHARGE_CONTROLLER_REGISTERS[29] = 2867  # arrayI 7 A
+CHARGE_CONTROLLER_REGISTERS[35] = 30  # hsTemp
+CHARGE_CONTROLLER_REGISTERS[36] = 25  # rtsTemp
+CHARGE_CONTROLLER_REGISTERS[48] = 0x02  # dipswitches
+CHARGE_CONTROLLER_REGISTERS[50] = 5  # statenum
+CHARGE_CONTROLLER_REGISTERS[58] = 1000  # outPower
+CHARGE_CONTROLLER_REGISTERS[59] = 1183  # inPower 130 W
+CHARGE_CONTROLLER_REGISTERS[64] = 2300  # minVb_daily
+CHARGE_CONTROLLER_REGISTERS[65] = 2600  # maxVb_daily
+CHARGE_CONTROLLER_REGISTERS[71] = 18  # minTb_daily
+CHARGE_CONTROLLER_REGISTERS[72] = 31  # maxTb_daily
+
+# relay box holding registers 0-17
+RELAY_BOX_REGISTERS = [5474, 5470, 5468, 5466, 5464, 30, 0, 0, 0, 1234, 0, 0, 0, 0, 0, 0, 0, 0]
+
+
+class LatencyDataBlock(ModbusSequentialDataBlock):
+    # emulates the RS485 round trip behind the gateway: a fixed latency per request
+    # plus the time on the wire of the RTU frames at the given baud rate
+
+    def __init__(self, address, values, latency=0.0, baudrate=None):
+        super().__init__(address, values)
+        self.latency = latency
+        # 11 bits per character: start, 8 data, parity, stop
+        self.byte_time = 11.0 / baudrate if baudrate else 0.0
+
+    def getValues(self, address, count=1):
+        delay = self.latency + self.byte_time * (REQUEST_BYTES + RESPONSE_BYTES + 2 * count)
+        if delay:
+            time.sleep(delay)
+        return super().getValues(address, count)
+
+
+class ModbusSimulator:
+
+    def __init__(self, host=DEFAULT_SIMULATOR_HOST, port=DEFAULT_SIMULATOR_PORT, latency=0.0, baudrate=None,
+                 charge_controller_units=(DEFAULT_CHARGE_CONTROLLER_UNIT,), relay_box_units=(DEFAULT_RELAY_BOX_UNIT,)):
+        self.host = host
+        self.port = port
+
+        slaves = dict()
+        for unit in charge_controller_units:
+            slaves[unit] = ModbusSlaveContext(
+                hr=LatencyDataBlock(0, list(CHARGE_CONTROLLER_REGISTERS), latency, baudrate),
+                zero_mode=True)
+        for unit in relay_box_units:
+            slaves[unit] = ModbusSlaveContext(
+                hr=LatencyDataBlock(0, list(RELAY_BOX_REGISTERS), latency, baudrate),
+                co=ModbusSequentialDataBlock(0, [False] * 8),
+                zero_mode=True)
+
+        self.context = ModbusServerContext(slaves=slaves, single=False)
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        self.server = ModbusTcpServer(self.context, address=(self.host, self.port))
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
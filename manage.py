@@ -7,6 +7,8 @@ from app.utils import connector, IIoT
 MQTT_HOSTNAME = os.getenv('MQTT_HOSTNAME', 'localhost')
 MQTT_PORT = os.getenv('MQTT_PORT', '1883')
 MQTT_CLIENT_ID = os.getenv('MQTT_CLIENT_ID', 'CHARGE_CONTROLLER')
+POLLING_ENGINE = os.getenv('POLLING_ENGINE', 'thread')  # thread | asyncio
+MQTT_LOG_PUBLISH = int(os.getenv('MQTT_LOG_PUBLISH', 1))  # print every published message
 
 
 def run(config):
@@ -25,10 +27,16 @@ def run(config):
 
     topics = [
         '{}/{}/+/request'.format(IIoT.MqttChannels.configurations, MQTT_CLIENT_ID),
-        '{}/{}/+/request'.format(IIoT.MqttChannels.actuators, MQTT_CLIENT_ID)
+        '{}/{}/+/request'.format(IIoT.MqttChannels.actuators, MQTT_CLIENT_ID),
+        '{}/{}/+/request'.format(IIoT.MqttChannels.data, MQTT_CLIENT_ID)
     ]
-    mqtt_client = connector.MqttLocalClient(MQTT_CLIENT_ID, MQTT_HOSTNAME, int(MQTT_PORT), topics)
-    sensors = Sensors(config, mqtt_client)
+    mqtt_client = connector.MqttLocalClient(MQTT_CLIENT_ID, MQTT_HOSTNAME, int(MQTT_PORT), topics,
+                                            log_publish=bool(MQTT_LOG_PUBLISH))
+    if POLLING_ENGINE == 'asyncio':
+        from app.sensor.async_sensors import AsyncSensors
+        sensors = AsyncSensors(config, mqtt_client)
+    else:
+        sensors = Sensors(config, mqtt_client)
     sensors.init_properties()
     sensors.init_sensors()
     sensors.daemon = True
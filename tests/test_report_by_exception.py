@@ -0,0 +1,37 @@
+import unittest
+
+from app.sensor.reader import SensorValue
+from app.sensor.report_by_exception import ReportByException, parse_deadbands
+
+
+def reading(**values):
+    return SensorValue('cc1', dict(type='charge_controller', **values), 0)
+
+
+class ReportByExceptionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.filter = ReportByException(parse_deadbands('hsTemp=2, *=0.5'), heartbeat_interval=300)
+
+    def test_int16_temperature_inside_its_deadband_is_suppressed(self):
+        self.assertEqual(self.filter.filter(reading(hsTemp=25), now=0).value['hsTemp'], 25)
+        self.assertIsNone(self.filter.filter(reading(hsTemp=26), now=1))
+        self.assertIsNone(self.filter.filter(reading(hsTemp=23), now=2))
+        self.assertEqual(self.filter.filter(reading(hsTemp=28), now=3).value['hsTemp'], 28)
+
+    def test_default_deadband_applies_to_integers(self):
+        self.filter.filter(reading(rtsTemp=-5), now=0)
+        self.assertIsNone(self.filter.filter(reading(rtsTemp=-5), now=1))
+        self.assertEqual(self.filter.filter(reading(rtsTemp=-4), now=2).value['rtsTemp'], -4)
+
+    def test_states_are_sent_on_any_change(self):
+        self.filter.filter(reading(statenum=3), now=0)
+        self.assertEqual(self.filter.filter(reading(statenum=4), now=1).value['statenum'], 4)
+
+    def test_heartbeat_sends_unchanged_values(self):
+        self.filter.filter(reading(hsTemp=25), now=0)
+        self.assertEqual(self.filter.filter(reading(hsTemp=25), now=300).value['hsTemp'], 25)
+
+
+if __name__ == '__main__':
+    unittest.main()